@@ -0,0 +1,84 @@
+"""
+Caches of numpy arrays on disk, used to skip slow loading steps such as
+decoding images or reading HDF5 files.
+
+A cache is a directory holding one .npy file per array and a manifest.json
+recording a fingerprint of the sources the arrays were built from. Loading
+gives memory maps of the arrays if the fingerprint matches, so the arrays are
+only read as they are used. A cache is built in two steps, start_array_cache
+and finish_array_cache, so that arrays can be written into the directory as
+memory maps while they are computed.
+
+Example usage:
+
+fingerprint = {'version': ARRAY_CACHE_VERSION, 'sources': [...]}
+data = load_array_cache(cache_dir, fingerprint)
+if data is None:
+  start_array_cache(cache_dir)
+  data = {'X': compute_X()}
+  finish_array_cache(cache_dir, fingerprint, data)
+  data = load_array_cache(cache_dir, fingerprint)
+"""
+
+import os, json
+import numpy as np
+
+
+# Bump this whenever the layout of the files in the array caches changes
+ARRAY_CACHE_VERSION = 1
+
+
+def load_array_cache(cache_dir, fingerprint, mmap_mode='r'):
+  """
+  Load the arrays of a cache written by finish_array_cache as memory maps
+  (read-only unless another mmap_mode is given), if its manifest matches
+  fingerprint; otherwise return None.
+  """
+  manifest_file = os.path.join(cache_dir, 'manifest.json')
+  if not os.path.isfile(manifest_file):
+    return None
+  with open(manifest_file, 'r') as f:
+    manifest = json.load(f)
+  if manifest['fingerprint'] != json.loads(json.dumps(fingerprint)):
+    return None
+  data = {}
+  for k in manifest['arrays']:
+    data[k] = np.load(os.path.join(cache_dir, '%s.npy' % k),
+                      mmap_mode=mmap_mode)
+  for k in manifest['missing']:
+    data[k] = None
+  return data
+
+
+def start_array_cache(cache_dir):
+  """
+  Prepare cache_dir for writing a new cache, invalidating any old one.
+  """
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  manifest_file = os.path.join(cache_dir, 'manifest.json')
+  if os.path.isfile(manifest_file):
+    os.remove(manifest_file)
+
+
+def finish_array_cache(cache_dir, fingerprint, data):
+  """
+  Save the arrays of data that are not already .npy files in cache_dir, then
+  write the manifest. Since the manifest is written last, an interrupted
+  build is never mistaken for a complete one.
+  """
+  arrays, missing = [], []
+  for k, v in data.iteritems():
+    if v is None:
+      missing.append(k)
+      continue
+    if not isinstance(v, np.memmap):
+      np.save(os.path.join(cache_dir, '%s.npy' % k), v)
+    arrays.append(k)
+  manifest = {'fingerprint': fingerprint, 'arrays': arrays,
+              'missing': missing}
+  manifest_file = os.path.join(cache_dir, 'manifest.json')
+  tmp_file = manifest_file + '.tmp'
+  with open(tmp_file, 'w') as f:
+    json.dump(manifest, f)
+  os.rename(tmp_file, manifest_file)
@@ -0,0 +1,287 @@
+"""
+Corpus-level BLEU for captions stored as integer arrays.
+
+Everything here works directly on the padded (N, T) integer captions used
+throughout the captioning code, so we never build strings. An n-gram of word
+indices is encoded as a single int64 key (base-V digits), which lets us count
+and clip n-grams for a whole corpus with sorting instead of Python dicts.
+
+The usual workflow is:
+
+index = build_reference_index(data['val_captions'], data['val_image_idxs'],
+                              data['word_to_idx'])
+bleu = corpus_bleu(sampled_captions, image_idxs, index)
+
+where sampled_captions[i] is the caption generated for image image_idxs[i];
+bleu[n - 1] is BLEU-n.
+"""
+
+import numpy as np
+from multiprocessing import Pool
+
+
+def lengths_before_stop(captions, stop_idxs):
+  """
+  Find the number of tokens in each caption before the first stop token.
+
+  Inputs:
+  - captions: Integer array of shape (N, T)
+  - stop_idxs: Sequence of word indices that terminate a caption (for example
+    <END> and <NULL>).
+
+  Returns:
+  - lengths: Integer array of shape (N,)
+  """
+  N, T = captions.shape
+  stop = np.zeros((N, T + 1), dtype=np.bool_)
+  stop[:, T] = True
+  for idx in stop_idxs:
+    stop[:, :T] |= (captions == idx)
+  return np.argmax(stop, axis=1)
+
+
+def ngram_keys(captions, lengths, n, base):
+  """
+  Encode every n-gram of every caption as a single integer.
+
+  Inputs:
+  - captions: Integer array of shape (N, T)
+  - lengths: Integer array of shape (N,) giving the number of valid tokens
+  - n: n-gram order
+  - base: Integer larger than every word index (the vocabulary size)
+
+  Returns a tuple of:
+  - rows: Array giving the caption that each valid n-gram came from
+  - keys: int64 array of the same shape as rows giving the n-gram keys
+  """
+  N, T = captions.shape
+  if T < n:
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+  W = T - n + 1
+  keys = np.zeros((N, W), dtype=np.int64)
+  for k in xrange(n):
+    keys *= base
+    keys += captions[:, k:k + W]
+  valid = np.arange(W)[None] + n <= lengths[:, None]
+  rows = np.nonzero(valid)[0]
+  return rows, keys[valid]
+
+
+def _count_pairs(a, b, b_size):
+  """
+  Count the distinct (a, b) pairs of two parallel non-negative integer arrays,
+  where every element of b is smaller than b_size.
+
+  Returns a tuple (a_unique, b_unique, counts), sorted by a then b.
+  """
+  composite = a * b_size + b
+  composite, counts = np.unique(composite, return_counts=True)
+  return composite // b_size, composite % b_size, counts
+
+
+def build_reference_index(captions, image_idxs, word_to_idx, max_n=4):
+  """
+  Precompute the reference statistics needed to score candidates with BLEU.
+
+  For each image and each n-gram order we store the maximum number of times
+  every n-gram appears in any one of the reference captions for that image;
+  this is the clipping count used by BLEU. We also keep the reference lengths
+  so the brevity penalty can use the closest reference length.
+
+  Inputs:
+  - captions: Integer array of shape (N, T) of reference captions, in the
+    format returned by load_coco_data (starting with <START>, ending with
+    <END> and padded with <NULL>).
+  - image_idxs: Integer array of shape (N,) giving the image for each caption.
+  - word_to_idx: Dictionary mapping words to integers.
+  - max_n: Largest n-gram order to index.
+
+  Returns:
+  - index: A dictionary used by corpus_bleu_stats and corpus_bleu.
+  """
+  captions = np.asarray(captions)
+  image_idxs = np.asarray(image_idxs).astype(np.int64)
+  start = word_to_idx.get('<START>', None)
+  stop_idxs = [word_to_idx['<NULL>']]
+  if '<END>' in word_to_idx:
+    stop_idxs.append(word_to_idx['<END>'])
+  if start is not None and np.all(captions[:, 0] == start):
+    captions = captions[:, 1:]
+  base = len(word_to_idx)
+  lengths = lengths_before_stop(captions, stop_idxs)
+
+  index = {
+    'max_n': max_n,
+    'base': base,
+    'stop_idxs': stop_idxs,
+    'ref_image_idxs': image_idxs,
+    'ref_lengths': lengths,
+    'ngrams': [],
+  }
+  for n in xrange(1, max_n + 1):
+    rows, keys = ngram_keys(captions, lengths, n, base)
+    vocab, ranks = np.unique(keys, return_inverse=True)
+    V = max(vocab.shape[0], 1)
+    rows, ranks, counts = _count_pairs(rows, ranks, V)
+
+    # Reduce per-caption counts to the max count over captions of each image.
+    composite = image_idxs[rows] * V + ranks
+    order = np.argsort(composite)
+    composite, counts = composite[order], counts[order]
+    if composite.shape[0] > 0:
+      starts = np.ones(composite.shape[0], dtype=np.bool_)
+      starts[1:] = composite[1:] != composite[:-1]
+      starts = np.nonzero(starts)[0]
+      max_counts = np.maximum.reduceat(counts, starts)
+      composite = composite[starts]
+    else:
+      max_counts = counts
+    index['ngrams'].append((vocab, composite, max_counts))
+  return index
+
+
+def _closest_ref_lengths(cand_lengths, cand_image_idxs, index):
+  """
+  For each candidate find the length of the reference caption of its image
+  whose length is closest to the candidate length, breaking ties toward the
+  shorter reference.
+  """
+  ref_images = index['ref_image_idxs']
+  ref_lengths = index['ref_lengths']
+  order = np.argsort(ref_images, kind='mergesort')
+  sorted_images = ref_images[order]
+  lo = np.searchsorted(sorted_images, cand_image_idxs, side='left')
+  hi = np.searchsorted(sorted_images, cand_image_idxs, side='right')
+  if np.any(hi == lo):
+    raise ValueError('Some candidate images have no reference captions')
+
+  # Expand every candidate against every reference of its image.
+  num_refs = hi - lo
+  cand = np.repeat(np.arange(cand_lengths.shape[0]), num_refs)
+  offsets = np.arange(cand.shape[0]) - np.repeat(np.cumsum(num_refs) - num_refs, num_refs)
+  refs = ref_lengths[order][np.repeat(lo, num_refs) + offsets]
+  diff = np.abs(refs - cand_lengths[cand])
+  best = np.lexsort((refs, diff, cand))
+  firsts = np.ones(best.shape[0], dtype=np.bool_)
+  firsts[1:] = cand[best][1:] != cand[best][:-1]
+  return refs[best][firsts]
+
+
+def corpus_bleu_stats(captions, image_idxs, index):
+  """
+  Compute the additive sufficient statistics of corpus BLEU for a set of
+  candidate captions. Statistics for disjoint sets of candidates can be summed
+  and then passed to bleu_from_stats.
+
+  Inputs:
+  - captions: Integer array of shape (N, T) of candidate captions, such as
+    the output of CaptioningRNN.sample; everything from the first <END> or
+    <NULL> token on is ignored.
+  - image_idxs: Integer array of shape (N,) giving the image for each
+    candidate.
+  - index: Dictionary returned by build_reference_index.
+
+  Returns:
+  - stats: Array of shape (2 * max_n + 2,) holding the clipped n-gram
+    matches, the candidate n-gram totals, the candidate length and the
+    reference length.
+  """
+  max_n, base = index['max_n'], index['base']
+  captions = np.asarray(captions)
+  image_idxs = np.asarray(image_idxs).astype(np.int64)
+  stats = np.zeros(2 * max_n + 2, dtype=np.int64)
+  if captions.shape[0] == 0:
+    return stats
+
+  lengths = lengths_before_stop(captions, index['stop_idxs'])
+  for n in xrange(1, max_n + 1):
+    vocab, ref_composite, ref_counts = index['ngrams'][n - 1]
+    rows, keys = ngram_keys(captions, lengths, n, base)
+    stats[max_n + n - 1] = rows.shape[0]
+    if rows.shape[0] == 0 or vocab.shape[0] == 0:
+      continue
+
+    # Map candidate n-grams to reference vocabulary ranks; n-grams that never
+    # occur in any reference can't match and are dropped here.
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    unique_ranks = np.minimum(np.searchsorted(vocab, unique_keys),
+                              vocab.shape[0] - 1)
+    known = (vocab[unique_ranks] == unique_keys)[inverse]
+    V = vocab.shape[0]
+    rows, ranks, counts = _count_pairs(rows[known],
+                                       unique_ranks[inverse[known]], V)
+
+    composite = image_idxs[rows] * V + ranks
+    pos = np.minimum(np.searchsorted(ref_composite, composite),
+                     ref_composite.shape[0] - 1)
+    hit = ref_composite[pos] == composite
+    clipped = np.minimum(counts[hit], ref_counts[pos[hit]])
+    stats[n - 1] = clipped.sum()
+
+  stats[2 * max_n] = lengths.sum()
+  stats[2 * max_n + 1] = _closest_ref_lengths(lengths, image_idxs, index).sum()
+  return stats
+
+
+def bleu_from_stats(stats):
+  """
+  Turn statistics from corpus_bleu_stats into cumulative BLEU scores.
+
+  Returns:
+  - bleu: Array of shape (max_n,) where bleu[n - 1] is BLEU-n.
+  """
+  max_n = (stats.shape[0] - 2) / 2
+  matches = stats[:max_n].astype(np.float64)
+  totals = stats[max_n:2 * max_n].astype(np.float64)
+  c, r = float(stats[2 * max_n]), float(stats[2 * max_n + 1])
+  bleu = np.zeros(max_n)
+  if c == 0:
+    return bleu
+  bp = 1.0 if c > r else np.exp(1 - r / c)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    log_p = np.log(matches / totals)
+  for n in xrange(1, max_n + 1):
+    if np.all(matches[:n] > 0):
+      bleu[n - 1] = bp * np.exp(np.mean(log_p[:n]))
+  return bleu
+
+
+_worker_index = None
+
+
+def _init_worker(index):
+  global _worker_index
+  _worker_index = index
+
+
+def _worker_stats(args):
+  captions, image_idxs = args
+  return corpus_bleu_stats(captions, image_idxs, _worker_index)
+
+
+def corpus_bleu(captions, image_idxs, index, num_workers=1, chunk_size=5000):
+  """
+  Compute corpus-level BLEU-1 through BLEU-max_n for candidate captions.
+
+  Inputs:
+  - captions, image_idxs, index: Same as corpus_bleu_stats.
+  - num_workers: If greater than 1, score chunks of candidates in a process
+    pool of this size and sum their statistics.
+  - chunk_size: Number of candidates scored per pool task.
+
+  Returns:
+  - bleu: Array of shape (max_n,) where bleu[n - 1] is BLEU-n.
+  """
+  N = captions.shape[0]
+  if num_workers <= 1 or N <= chunk_size:
+    return bleu_from_stats(corpus_bleu_stats(captions, image_idxs, index))
+
+  chunks = [(captions[i:i + chunk_size], image_idxs[i:i + chunk_size])
+            for i in xrange(0, N, chunk_size)]
+  pool = Pool(num_workers, initializer=_init_worker, initargs=(index,))
+  try:
+    stats = pool.map(_worker_stats, chunks)
+  finally:
+    pool.close()
+    pool.join()
+  return bleu_from_stats(np.sum(stats, axis=0))
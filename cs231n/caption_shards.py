@@ -0,0 +1,299 @@
+"""
+A sharded on-disk format for captioning data that does not fit in memory.
+
+A shard directory holds a number of shards plus an index.json describing
+them. Each shard is a small self-contained dataset of image features and the
+captions of those images, stored as .npy files:
+
+- shard_XXXXX_features.npy: Image features, of shape (M, D)
+- shard_XXXXX_captions.npy: Captions, of shape (K, T)
+- shard_XXXXX_image_idxs.npy: Shape (K,); the row of the shard's features
+  for each caption.
+- shard_XXXXX_urls.npy: Optional; URLs of the M images.
+
+Shards are written with a CaptionShardWriter, or from a data dictionary with
+write_caption_shards, and read for training with a CaptionShardStream.
+"""
+
+import os, json, threading, Queue
+import numpy as np
+
+
+class CaptionShardWriter(object):
+  """
+  Writes shards one at a time, so a corpus can be converted without ever
+  holding more than one shard in memory.
+
+  Example usage:
+
+  writer = CaptionShardWriter('path/to/shards')
+  for features, captions, image_idxs in chunks:
+    writer.add_shard(features, captions, image_idxs)
+  writer.close()
+  """
+
+  def __init__(self, shard_dir):
+    self.shard_dir = shard_dir
+    self.shards = []
+    self.caption_width = None
+    self.feature_dim = None
+    if not os.path.isdir(shard_dir):
+      os.makedirs(shard_dir)
+
+
+  def add_shard(self, features, captions, image_idxs, urls=None):
+    """
+    Write one shard.
+
+    Inputs:
+    - features: Array of shape (M, D) of image features
+    - captions: Integer array of shape (K, T) of captions
+    - image_idxs: Integer array of shape (K,) giving the row of features for
+      each caption.
+    - urls: Optional array of shape (M,) of image URLs.
+    """
+    if self.caption_width is None:
+      self.caption_width = captions.shape[1]
+      self.feature_dim = features.shape[1]
+    if captions.shape[1] != self.caption_width:
+      raise ValueError('All shards must have captions of the same width')
+    if features.shape[1] != self.feature_dim:
+      raise ValueError('All shards must have features of the same dimension')
+
+    name = 'shard_%05d' % len(self.shards)
+    arrays = {'features': features, 'captions': captions,
+              'image_idxs': image_idxs}
+    if urls is not None:
+      arrays['urls'] = urls
+    for k, v in arrays.iteritems():
+      np.save(os.path.join(self.shard_dir, '%s_%s.npy' % (name, k)),
+              np.asarray(v))
+    self.shards.append({
+      'name': name,
+      'num_images': features.shape[0],
+      'num_captions': captions.shape[0],
+      'has_urls': urls is not None,
+    })
+
+
+  def close(self):
+    """
+    Write the index of the shards. Until this is called the shard directory
+    can't be read.
+    """
+    index = {
+      'shards': self.shards,
+      'num_captions': sum(s['num_captions'] for s in self.shards),
+      'num_images': sum(s['num_images'] for s in self.shards),
+      'caption_width': self.caption_width,
+      'feature_dim': self.feature_dim,
+    }
+    with open(os.path.join(self.shard_dir, 'index.json'), 'w') as f:
+      json.dump(index, f)
+
+
+def write_caption_shards(data, shard_dir, split='train', images_per_shard=10000):
+  """
+  Split one split of a data dictionary from load_coco_data into shards of
+  consecutive images with all of their captions. Features are read one shard
+  at a time, so this also works on a lazily loaded dictionary.
+
+  Inputs:
+  - data: Dictionary of data from load_coco_data
+  - shard_dir: Directory to write the shards to
+  - split: Which split of the data to write
+  - images_per_shard: Number of images in each shard
+  """
+  captions = np.asarray(data['%s_captions' % split])
+  image_idxs = np.asarray(data['%s_image_idxs' % split])
+  features = data['%s_features' % split]
+  urls = data.get('%s_urls' % split)
+
+  order = np.argsort(image_idxs, kind='mergesort')
+  sorted_idxs = image_idxs[order]
+  writer = CaptionShardWriter(shard_dir)
+  for start in xrange(0, features.shape[0], images_per_shard):
+    stop = min(start + images_per_shard, features.shape[0])
+    lo, hi = np.searchsorted(sorted_idxs, [start, stop])
+    rows = order[lo:hi]
+    shard_urls = None if urls is None else np.asarray(urls[start:stop])
+    writer.add_shard(np.asarray(features[start:stop]), captions[rows],
+                     image_idxs[rows] - start, shard_urls)
+  writer.close()
+
+
+class CaptionShardStream(object):
+  """
+  A CaptionShardStream reads minibatches from a shard directory in a single
+  streaming pass per epoch, using bounded memory.
+
+  At the start of every epoch the order of the shards is shuffled. Shards are
+  then read sequentially in groups of shards_per_buffer whole shards; the
+  captions of a group form a shuffle buffer, which is shuffled and served as
+  consecutive minibatches. While one group is being consumed, a background
+  thread reads the next one, so disk reads overlap with training. At most
+  three groups are in memory at once: the one being consumed, one ready and
+  one being read.
+
+  Every minibatch has exactly batch_size captions: the captions left over at
+  the end of a buffer are carried into the next one, also across epochs. An
+  epoch is therefore num_captions / batch_size minibatches on average, which
+  matches the iterations per epoch of CaptioningSolver, and each caption is
+  seen once per pass over the shards. self.epoch counts the passes that have
+  been completed. Larger buffers mix captions from more shards into each
+  minibatch at the cost of memory.
+
+  The stream can be passed to CaptioningSolver as its sampler.
+  """
+
+  def __init__(self, shard_dir, batch_size=100, shards_per_buffer=4,
+               prefetch=True, seed=None):
+    """
+    Inputs:
+    - shard_dir: Directory written by CaptionShardWriter
+    - batch_size: Number of captions per minibatch
+    - shards_per_buffer: Number of shards in each shuffle buffer
+    - prefetch: Whether to read the next buffer in a background thread
+    - seed: Seed for the shuffling; the global numpy random state is not used
+      so that the background thread does not interfere with it.
+    """
+    self.shard_dir = shard_dir
+    self.batch_size = batch_size
+    self.shards_per_buffer = shards_per_buffer
+    with open(os.path.join(shard_dir, 'index.json'), 'r') as f:
+      self.index = json.load(f)
+    self.num_captions = self.index['num_captions']
+    self.epoch = 0
+
+    self._rng = np.random.RandomState(seed)
+    self._groups = self._epoch_groups()
+    self._buffer = None
+    self._pos = 0
+    self._queue = None
+    self._thread = None
+    self._stop = threading.Event()
+    if prefetch:
+      self._queue = Queue.Queue(maxsize=1)
+      self._thread = threading.Thread(target=self._prefetch_loop)
+      self._thread.daemon = True
+      self._thread.start()
+
+
+  def _epoch_groups(self):
+    """
+    Shuffle the shards and cut them into groups of shards_per_buffer.
+    """
+    order = self._rng.permutation(len(self.index['shards']))
+    return [order[i:i + self.shards_per_buffer]
+            for i in xrange(0, order.shape[0], self.shards_per_buffer)]
+
+
+  def _next_group(self):
+    """
+    Return the shard numbers of the next buffer and whether it is the last
+    buffer of its epoch.
+    """
+    if not self._groups:
+      self._groups = self._epoch_groups()
+    group = self._groups.pop(0)
+    return group, not self._groups
+
+
+  def _load_buffer(self, group):
+    """
+    Read a group of shards and shuffle their captions.
+    """
+    features, captions, image_idxs, urls = [], [], [], []
+    offset = 0
+    for i in group:
+      shard = self.index['shards'][i]
+      prefix = os.path.join(self.shard_dir, shard['name'])
+      features.append(np.load(prefix + '_features.npy'))
+      captions.append(np.load(prefix + '_captions.npy'))
+      image_idxs.append(np.load(prefix + '_image_idxs.npy') + offset)
+      if shard['has_urls']:
+        urls.append(np.load(prefix + '_urls.npy'))
+      offset += shard['num_images']
+    perm = self._rng.permutation(sum(c.shape[0] for c in captions))
+    return {
+      'features': np.concatenate(features),
+      'captions': np.concatenate(captions)[perm],
+      'image_idxs': np.concatenate(image_idxs)[perm],
+      'urls': np.concatenate(urls) if len(urls) == len(group) else None,
+    }
+
+
+  def _prefetch_loop(self):
+    while not self._stop.is_set():
+      group, last = self._next_group()
+      self._queue.put((self._load_buffer(group), last))
+
+
+  def sample(self):
+    """
+    Read the next minibatch.
+
+    Returns a tuple of captions, image_features, urls like
+    sample_coco_minibatch; urls is None if the shards have no URLs.
+    """
+    while (self._buffer is None or
+           self._pos + self.batch_size > self._buffer['captions'].shape[0]):
+      if self._buffer is not None and self._last:
+        self.epoch += 1
+      leftover = self._buffer
+      if self._queue is not None:
+        self._buffer, self._last = self._queue.get()
+      else:
+        group, self._last = self._next_group()
+        self._buffer = self._load_buffer(group)
+      if leftover is not None:
+        self._buffer = _carry_over(leftover, self._pos, self._buffer)
+      self._pos = 0
+
+    buf = self._buffer
+    start, stop = self._pos, self._pos + self.batch_size
+    self._pos = stop
+    captions = buf['captions'][start:stop]
+    image_idxs = buf['image_idxs'][start:stop]
+    features = buf['features'][image_idxs]
+    urls = None if buf['urls'] is None else buf['urls'][image_idxs]
+    return captions, features, urls
+
+
+  def close(self):
+    """
+    Stop the prefetching thread and wait for it to finish, releasing the
+    buffer it holds.
+    """
+    self._stop.set()
+    if self._thread is None:
+      return
+    # Keep taking buffers so that the thread is never stuck putting one
+    while self._thread.is_alive():
+      try:
+        self._queue.get(timeout=0.1)
+      except Queue.Empty:
+        pass
+    self._thread.join()
+    self._thread = None
+    while not self._queue.empty():
+      self._queue.get_nowait()
+
+
+def _carry_over(old, pos, new):
+  """
+  Put the captions of buffer old from position pos onwards in front of the
+  captions of buffer new, along with the features of their images.
+  """
+  image_idxs = old['image_idxs'][pos:]
+  k = image_idxs.shape[0]
+  urls = None
+  if old['urls'] is not None and new['urls'] is not None:
+    urls = np.concatenate([old['urls'][image_idxs], new['urls']])
+  return {
+    'features': np.concatenate([old['features'][image_idxs], new['features']]),
+    'captions': np.concatenate([old['captions'][pos:], new['captions']]),
+    'image_idxs': np.concatenate([np.arange(k, dtype=new['image_idxs'].dtype),
+                                  new['image_idxs'] + k]),
+    'urls': urls,
+  }
@@ -1,7 +1,11 @@
+import json, resource
+from timeit import default_timer as timer
+
 import numpy as np
 
 from cs231n import optim
-from cs231n.coco_utils import sample_coco_minibatch
+from cs231n.bleu import build_reference_index, corpus_bleu
+from cs231n.coco_utils import sample_coco_minibatch, BucketedCaptionSampler
 
 
 class CaptioningSolver(object):
@@ -11,7 +15,7 @@ class CaptioningSolver(object):
   descent using different update rules defined in optim.py.
 
   The solver accepts both training and validataion data and labels so it can
-  periodically check classification accuracy on both training and validation
+  periodically check caption quality (BLEU) on both training and validation
   data to watch out for overfitting.
 
   To train a model, you will first construct a CaptioningSolver instance,
@@ -19,12 +23,14 @@ class CaptioningSolver(object):
   etc) to the constructor. You will then call the train() method to run the 
   optimization procedure and train the model.
   
-  After the train() method returns, model.params will contain the parameters
-  that performed best on the validation set over the course of training.
-  In addition, the instance variable solver.loss_history will contain a list
-  of all losses encountered during training and the instance variables
+  After the train() method returns, the instance variable solver.loss_history
+  will contain a list of all losses encountered during training. If the
+  solver was constructed with check_bleu=True, the instance variables
   solver.train_acc_history and solver.val_acc_history will be lists containing
-  the accuracies of the model on the training and validation set at each epoch.
+  the BLEU-1 through BLEU-4 scores of the model on the training and validation
+  set at each epoch, and with restore_best=True model.params will contain the
+  parameters that performed best on the validation set over the course of
+  training.
   
   Example usage might look something like this:
   
@@ -58,7 +64,14 @@ class CaptioningSolver(object):
     Returns:
     - loss: Scalar giving the loss
     - grads: Dictionary with the same keys as self.params mapping parameter
-      names to gradients of the loss with respect to those parameters.
+      names to gradients of the loss with respect to those parameters. A
+      gradient may also be a tuple (rows, drows) giving only its nonzero rows,
+      in which case the sparse version of the update rule is used if optim.py
+      has one.
+
+  - Optionally, the model can split model.loss into model.forward(features,
+    captions), returning (loss, cache), and model.backward(cache), returning
+    grads. In that case the solver times the two passes separately.
   """
 
   def __init__(self, model, data, **kwargs):
@@ -71,7 +84,9 @@ class CaptioningSolver(object):
 
     Optional arguments:
     - update_rule: A string giving the name of an update rule in optim.py.
-      Default is 'sgd'.
+      Default is 'sgd'. Sparse rules such as 'sparse_adam' can't be given
+      here; the sparse version of update_rule, if there is one, is used
+      automatically for sparse gradients (see self.sparse_update_rule).
     - optim_config: A dictionary containing hyperparameters that will be
       passed to the chosen update rule. Each update rule requires different
       hyperparameters (see optim.py) but all update rules require a
@@ -80,9 +95,48 @@ class CaptioningSolver(object):
       rate is multiplied by this value.
     - batch_size: Size of minibatches used to compute loss and gradient during
       training.
+    - num_buckets: If not None, draw each minibatch from one of this many
+      buckets of captions of similar length, trimming the captions to the
+      longest one in the minibatch; see BucketedCaptionSampler.
+    - sampler: If not None, an object whose sample() method returns a
+      minibatch (captions, features, urls) in the format of
+      sample_coco_minibatch, used instead of sampling data['train_*']; for
+      example a CaptionShardStream for training sets that don't fit in memory.
+      A sampler may also return (captions, features, urls, image_idxs) with
+      one feature row per distinct image, like ImageGroupedCaptionSampler;
+      image_idxs is then passed on to the model.
+      If it has a num_captions attribute, that is used as the size of an
+      epoch, and data then only needs the vocabulary and the validation split.
+    - micro_batch_size: If not None, split each minibatch into micro-batches
+      of this size, run model.loss on them one at a time, and accumulate their
+      gradients before making a single update. The loss and gradients are the
+      same as for the whole minibatch, but the model only holds the
+      intermediate values of one micro-batch at a time.
     - num_epochs: The number of epochs to run for during training.
     - print_every: Integer; training losses will be printed every print_every
       iterations.
+    - check_bleu: Boolean; if True, compute train and val BLEU on the first
+      iteration, the last iteration and at the end of each epoch. Default is
+      False, since captioning images is slow compared to small training runs.
+    - restore_best: Boolean; if True (and check_bleu is True), copy the
+      parameters with the best validation BLEU-4 back into the model at the
+      end of training. Default is False, which leaves the final parameters.
+    - num_train_samples: Number of training images used to compute training
+      BLEU; default is 1000. Set to None to use the entire training set.
+    - num_val_samples: Number of validation images used to compute validation
+      BLEU; default is 1000. Set to None to use the entire validation set.
+    - eval_batch_size: Number of images captioned at once when computing BLEU.
+    - num_workers: Number of processes used to score BLEU; default is 1,
+      which scores in the current process.
+    - flat_params: Boolean; if True, move all of model.params into a single
+      contiguous array (model.params then holds views into it) and gather the
+      gradients into a matching array, so that each update is a single call
+      of the update rule over all parameters. Rules that update the weights in
+      place, as all rules in optim.py do, avoid copying them back.
+    - metrics_file: Path of a file to which per-iteration training metrics
+      (see _step) are appended as JSON lines.
+    - metrics_callback: Function called with the dictionary of training
+      metrics after every iteration.
     - verbose: Boolean; if set to false then no output will be printed during
       training.
     """
@@ -94,9 +148,21 @@ class CaptioningSolver(object):
     self.optim_config = kwargs.pop('optim_config', {})
     self.lr_decay = kwargs.pop('lr_decay', 1.0)
     self.batch_size = kwargs.pop('batch_size', 100)
+    self.num_buckets = kwargs.pop('num_buckets', None)
+    self.sampler = kwargs.pop('sampler', None)
+    self.micro_batch_size = kwargs.pop('micro_batch_size', None)
+    self.flat_params = kwargs.pop('flat_params', False)
     self.num_epochs = kwargs.pop('num_epochs', 10)
 
     self.print_every = kwargs.pop('print_every', 10)
+    self.check_bleu = kwargs.pop('check_bleu', False)
+    self.restore_best = kwargs.pop('restore_best', False)
+    self.num_train_samples = kwargs.pop('num_train_samples', 1000)
+    self.num_val_samples = kwargs.pop('num_val_samples', 1000)
+    self.eval_batch_size = kwargs.pop('eval_batch_size', 1000)
+    self.num_workers = kwargs.pop('num_workers', 1)
+    self.metrics_file = kwargs.pop('metrics_file', None)
+    self.metrics_callback = kwargs.pop('metrics_callback', None)
     self.verbose = kwargs.pop('verbose', True)
 
     # Throw an error if there are extra keyword arguments
@@ -108,8 +174,23 @@ class CaptioningSolver(object):
     # name with the actual function
     if not hasattr(optim, self.update_rule):
       raise ValueError('Invalid update_rule "%s"' % self.update_rule)
+    if self.update_rule.startswith('sparse_'):
+      raise ValueError('Invalid update_rule "%s": sparse rules are only used '
+                       'for sparse gradients, as the sparse_update_rule of '
+                       'update_rule="%s"' % (self.update_rule,
+                                             self.update_rule[7:]))
+    self.sparse_update_rule = getattr(optim, 'sparse_%s' % self.update_rule,
+                                      None)
     self.update_rule = getattr(optim, self.update_rule)
 
+    self._null = data['word_to_idx']['<NULL>']
+    if self.num_buckets is not None:
+      if self.sampler is not None:
+        raise ValueError('num_buckets can\'t be used with a sampler')
+      self.sampler = BucketedCaptionSampler(data, batch_size=self.batch_size,
+                                            num_buckets=self.num_buckets)
+    self._metrics_f = None
+
     self._reset()
 
 
@@ -125,96 +206,285 @@ class CaptioningSolver(object):
     self.loss_history = []
     self.train_acc_history = []
     self.val_acc_history = []
+    self.bleu_indices = {}
+    self.metrics = {}
 
-    # Make a deep copy of the optim_config for each parameter
+    # Make a deep copy of the optim_config for each parameter; with flat
+    # parameters there is just one config for the whole flat array.
     self.optim_configs = {}
-    for p in self.model.params:
-      d = {k: v for k, v in self.optim_config.iteritems()}
-      self.optim_configs[p] = d
+    if self.flat_params:
+      self._flatten_params()
+      self.optim_configs['flat'] = dict(self.optim_config)
+    else:
+      for p in self.model.params:
+        d = {k: v for k, v in self.optim_config.iteritems()}
+        self.optim_configs[p] = d
+
+    # Preallocate buffers to accumulate the gradients of micro-batches; with
+    # flat parameters _flatten_params has already made them.
+    if not self.flat_params:
+      self.grad_buffers = {}
+      if self.micro_batch_size is not None:
+        for p, w in self.model.params.iteritems():
+          self.grad_buffers[p] = np.zeros_like(w)
+
+
+  def _flatten_params(self):
+    """
+    Copy all model parameters into one contiguous array and replace the
+    entries of model.params with views into it. Also allocate the matching
+    flat gradient array; self.grad_buffers holds views into it. Don't call
+    this manually.
+    """
+    params = self.model.params
+    names = sorted(params)
+    dtype = np.result_type(*[params[p] for p in names])
+    size = sum(params[p].size for p in names)
+    self.flat_w = np.empty(size, dtype=dtype)
+    self.flat_dw = np.zeros(size, dtype=dtype)
+    self.grad_buffers = {}
+    offset = 0
+    for p in names:
+      w = params[p]
+      view = self.flat_w[offset:offset + w.size].reshape(w.shape)
+      view[...] = w
+      params[p] = view
+      self.grad_buffers[p] = self.flat_dw[offset:offset + w.size].reshape(w.shape)
+      offset += w.size
 
 
   def _step(self):
     """
     Make a single gradient update. This is called by train() and should not
     be called manually.
+
+    Along the way we record the following metrics for the step in
+    self.metrics:
+    - time_sample, time_forward, time_backward, time_update: Wall-clock
+      seconds spent sampling the minibatch, in the forward pass, in the
+      backward pass and in the parameter update. If the model only provides
+      model.loss then its time is reported as time_forward and time_backward
+      is zero.
+    - time_step: Total wall-clock seconds of the step.
+    - samples_per_sec, tokens_per_sec: Throughput of the step, counting
+      captions and non-<NULL> target words.
+    - array_bytes: Bytes of numpy arrays held at the peak of the step; that
+      is, the forward cache plus the gradients.
+    - max_rss: Peak resident set size of the process so far, in kilobytes.
     """
-    # Make a minibatch of training data
-    minibatch = sample_coco_minibatch(self.data,
-                  batch_size=self.batch_size,
-                  split='train')
-    captions, features, urls = minibatch
+    t0 = timer()
 
-    # Compute loss and gradient
-    loss, grads = self.model.loss(features, captions)
+    # Make a minibatch of training data
+    if self.sampler is not None:
+      minibatch = self.sampler.sample()
+    else:
+      minibatch = sample_coco_minibatch(self.data,
+                    batch_size=self.batch_size,
+                    split='train')
+    captions, features, urls = minibatch[:3]
+    image_idxs = minibatch[3] if len(minibatch) > 3 else None
+    t1 = timer()
+
+    # Compute loss and gradient. When using micro-batches, each one's loss and
+    # gradients are averages over its own captions, so we weight them by the
+    # micro-batch's share of the minibatch to recover the minibatch averages.
+    N = captions.shape[0]
+    M = self.micro_batch_size
+    accumulate = M is not None and M < N
+    if not accumulate:
+      M = N
+    loss = 0.0
+    time_forward, time_backward, array_bytes = 0.0, 0.0, 0
+    for start in xrange(0, N, M):
+      micro_captions = captions[start:start + M]
+      args = ()
+      if image_idxs is None:
+        micro_features = features[start:start + M]
+      elif accumulate:
+        # Keep only the images of this micro-batch's captions
+        images, micro_idxs = np.unique(image_idxs[start:start + M],
+                                       return_inverse=True)
+        micro_features = features[images]
+        args = (micro_idxs,)
+      else:
+        micro_features = features
+        args = (image_idxs,)
+      tf = timer()
+      if hasattr(self.model, 'forward') and hasattr(self.model, 'backward'):
+        micro_loss, cache = self.model.forward(micro_features, micro_captions,
+                                               *args)
+        tb = timer()
+        micro_grads = self.model.backward(cache)
+      else:
+        micro_loss, micro_grads = self.model.loss(micro_features,
+                                                  micro_captions, *args)
+        cache = None
+        tb = timer()
+      time_forward += tb - tf
+      time_backward += timer() - tb
+      array_bytes = max(array_bytes, _array_bytes((cache, micro_grads)))
+      del cache
+
+      if not accumulate:
+        loss, grads = micro_loss, micro_grads
+        continue
+      scale = float(micro_captions.shape[0]) / N
+      loss += scale * micro_loss
+      for p, dw in micro_grads.iteritems():
+        if isinstance(dw, tuple):
+          # Sparse gradients are accumulated into the dense buffer
+          rows, drows = dw
+          if start == 0:
+            self.grad_buffers[p].fill(0)
+          self.grad_buffers[p][rows] += scale * drows
+        elif start == 0:
+          np.multiply(dw, scale, out=self.grad_buffers[p])
+        else:
+          dw *= scale
+          self.grad_buffers[p] += dw
+      del micro_grads
+    if accumulate:
+      grads = self.grad_buffers
+      array_bytes += _array_bytes(grads)
     self.loss_history.append(loss)
+    t2 = timer()
 
     # Perform a parameter update
-    for p, w in self.model.params.iteritems():
-      dw = grads[p]
-      config = self.optim_configs[p]
-      next_w, next_config = self.update_rule(w, dw, config)
-      self.model.params[p] = next_w
-      self.optim_configs[p] = next_config
+    if self.flat_params:
+      # Accumulated gradients are already in the flat array
+      if not accumulate:
+        for p, dw in grads.iteritems():
+          _copy_grad(dw, self.grad_buffers[p])
+      config = self.optim_configs['flat']
+      next_w, self.optim_configs['flat'] = self.update_rule(self.flat_w,
+                                                            self.flat_dw, config)
+      # Rules that return new weights are copied back, so that model.params
+      # stay views of the flat array
+      if next_w is not self.flat_w:
+        self.flat_w[...] = next_w
+    else:
+      for p, w in self.model.params.iteritems():
+        dw = grads[p]
+        config = self.optim_configs[p]
+        update_rule = self.update_rule
+        if isinstance(dw, tuple):
+          if self.sparse_update_rule is not None:
+            update_rule = self.sparse_update_rule
+          else:
+            dw = _copy_grad(dw, np.zeros_like(w))
+        next_w, next_config = update_rule(w, dw, config)
+        self.model.params[p] = next_w
+        self.optim_configs[p] = next_config
+    t3 = timer()
+
+    num_tokens = np.sum(captions[:, 1:] != self._null)
+    self.metrics = {
+      'iteration': len(self.loss_history),
+      'epoch': self.epoch,
+      'loss': float(loss),
+      'time_sample': t1 - t0,
+      'time_forward': time_forward,
+      'time_backward': time_backward,
+      'time_update': t3 - t2,
+      'time_step': t3 - t0,
+      'samples_per_sec': N / (t3 - t0),
+      'tokens_per_sec': num_tokens / (t3 - t0),
+      'array_bytes': array_bytes,
+      'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if self._metrics_f is not None:
+      self._metrics_f.write(json.dumps(self.metrics) + '\n')
+    if self.metrics_callback is not None:
+      self.metrics_callback(self.metrics)
 
   
-  # TODO: This does nothing right now; maybe implement BLEU?
-  def check_accuracy(self, X, y, num_samples=None, batch_size=100):
+  def _get_bleu_index(self, split):
     """
-    Check accuracy of the model on the provided data.
-    
+    Build (once) and return the BLEU reference index for a data split.
+    """
+    if split not in self.bleu_indices:
+      self.bleu_indices[split] = build_reference_index(
+                                    self.data['%s_captions' % split],
+                                    self.data['%s_image_idxs' % split],
+                                    self.data['word_to_idx'])
+    return self.bleu_indices[split]
+
+
+  def check_accuracy(self, split='val', num_samples=None, batch_size=1000):
+    """
+    Check the quality of the captions the model generates for a data split,
+    measured as corpus-level BLEU against all reference captions of each
+    image.
+
     Inputs:
-    - X: Array of data, of shape (N, d_1, ..., d_k)
-    - y: Array of labels, of shape (N,)
-    - num_samples: If not None, subsample the data and only test the model
-      on num_samples datapoints.
-    - batch_size: Split X and y into batches of this size to avoid using too
-      much memory.
-      
+    - split: Which split of self.data to evaluate; either 'train' or 'val'.
+    - num_samples: If not None, subsample the images and only test the model
+      on num_samples images.
+    - batch_size: Number of images captioned by each call to model.sample.
+
     Returns:
-    - acc: Scalar giving the fraction of instances that were correctly
-      classified by the model.
+    - bleu: Array of shape (4,) where bleu[n - 1] is the BLEU-n score.
     """
-    return 0.0
-    
-    # Maybe subsample the data
-    N = X.shape[0]
+    index = self._get_bleu_index(split)
+
+    # Each image is captioned once and scored against all of its references
+    image_idxs = np.unique(self.data['%s_image_idxs' % split])
+    N = image_idxs.shape[0]
     if num_samples is not None and N > num_samples:
-      mask = np.random.choice(N, num_samples)
+      image_idxs = np.sort(np.random.choice(image_idxs, num_samples,
+                                            replace=False))
       N = num_samples
-      X = X[mask]
-      y = y[mask]
 
-    # Compute predictions in batches
-    num_batches = N / batch_size
-    if N % batch_size != 0:
-      num_batches += 1
-    y_pred = []
-    for i in xrange(num_batches):
-      start = i * batch_size
-      end = (i + 1) * batch_size
-      scores = self.model.loss(X[start:end])
-      y_pred.append(np.argmax(scores, axis=1))
-    y_pred = np.hstack(y_pred)
-    acc = np.mean(y_pred == y)
+    # Generate captions in batches
+    features = self.data['%s_features' % split]
+    captions = []
+    for start in xrange(0, N, batch_size):
+      batch_idxs = image_idxs[start:start + batch_size]
+      captions.append(self.model.sample(features[batch_idxs]))
+    captions = np.concatenate(captions, axis=0)
 
-    return acc
+    return corpus_bleu(captions, image_idxs, index,
+                       num_workers=self.num_workers)
 
 
   def train(self):
     """
     Run optimization to train the model.
     """
-    num_train = self.data['train_captions'].shape[0]
+    num_train = getattr(self.sampler, 'num_captions', None)
+    if num_train is None:
+      num_train = self.data['train_captions'].shape[0]
     iterations_per_epoch = max(num_train / self.batch_size, 1)
     num_iterations = self.num_epochs * iterations_per_epoch
 
+    if self.metrics_file is not None:
+      self._metrics_f = open(self.metrics_file, 'a')
+    try:
+      self._train(num_iterations, iterations_per_epoch)
+    finally:
+      if self._metrics_f is not None:
+        self._metrics_f.close()
+        self._metrics_f = None
+
+
+  def _train(self, num_iterations, iterations_per_epoch):
+    """
+    The training loop of train(). Don't call this manually.
+    """
     for t in xrange(num_iterations):
       self._step()
 
-      # Maybe print training loss
+      # Maybe print training loss, and where the time of the step went
       if self.verbose and t % self.print_every == 0:
-        print '(Iteration %d / %d) loss: %f' % (
-               t + 1, num_iterations, self.loss_history[-1])
+        m = self.metrics
+        print ('(Iteration %d / %d) loss: %f (sample %.1f%%, forward %.1f%%, '
+               'backward %.1f%%, update %.1f%%; %.1f samples/sec)') % (
+               t + 1, num_iterations, self.loss_history[-1],
+               100 * m['time_sample'] / m['time_step'],
+               100 * m['time_forward'] / m['time_step'],
+               100 * m['time_backward'] / m['time_step'],
+               100 * m['time_update'] / m['time_step'],
+               m['samples_per_sec'])
 
       # At the end of every epoch, increment the epoch counter and decay the
       # learning rate.
@@ -224,10 +494,78 @@ class CaptioningSolver(object):
         for k in self.optim_configs:
           self.optim_configs[k]['learning_rate'] *= self.lr_decay
 
-      # Check train and val accuracy on the first iteration, the last
-      # iteration, and at the end of each epoch.
-      # TODO: Implement some logic to check Bleu on validation set periodically
+      # Maybe check train and val BLEU on the first iteration, the last
+      # iteration, and at the end of each epoch. Train BLEU is skipped when
+      # training data is only available through the sampler.
+      first_it = (t == 0)
+      last_it = (t == num_iterations - 1)
+      if self.check_bleu and (first_it or last_it or epoch_end):
+        val_acc = self.check_accuracy('val',
+                                      num_samples=self.num_val_samples,
+                                      batch_size=self.eval_batch_size)
+        self.val_acc_history.append(val_acc)
+        if 'train_captions' in self.data:
+          train_acc = self.check_accuracy('train',
+                                          num_samples=self.num_train_samples,
+                                          batch_size=self.eval_batch_size)
+          self.train_acc_history.append(train_acc)
+          if self.verbose:
+            print '(Epoch %d / %d) train BLEU-4: %f; val BLEU-4: %f' % (
+                   self.epoch, self.num_epochs, train_acc[-1], val_acc[-1])
+        elif self.verbose:
+          print '(Epoch %d / %d) val BLEU-4: %f' % (
+                 self.epoch, self.num_epochs, val_acc[-1])
+
+        # Keep track of the best model, ranked by validation BLEU-4
+        if val_acc[-1] > self.best_val_acc:
+          self.best_val_acc = val_acc[-1]
+          self.best_params = {}
+          for k, v in self.model.params.iteritems():
+            self.best_params[k] = v.copy()
+
+    # At the end of training maybe swap the best params into the model; flat
+    # parameters are copied back so that they stay views of the flat array.
+    if self.restore_best and self.best_params:
+      if self.flat_params:
+        for k, v in self.best_params.iteritems():
+          self.model.params[k][...] = v
+      else:
+        self.model.params = self.best_params
+
+
+def _copy_grad(dw, out):
+  """
+  Copy a gradient, which is either an array or a tuple (rows, drows) of
+  nonzero rows, into the dense array out and return out.
+  """
+  if isinstance(dw, tuple):
+    rows, drows = dw
+    out.fill(0)
+    out[rows] = drows
+  else:
+    out[...] = dw
+  return out
 
-    # At the end of training swap the best params into the model
-    # self.model.params = self.best_params
 
+def _array_bytes(obj):
+  """
+  Count the bytes of all distinct numpy arrays reachable from obj through
+  tuples, lists and dicts. Views are charged to the array that owns their
+  memory, so each buffer is only counted once.
+  """
+  seen = set()
+  total = 0
+  stack = [obj]
+  while stack:
+    o = stack.pop()
+    if isinstance(o, np.ndarray):
+      while isinstance(o.base, np.ndarray):
+        o = o.base
+      if id(o) not in seen:
+        seen.add(id(o))
+        total += o.nbytes
+    elif isinstance(o, (tuple, list)):
+      stack.extend(o)
+    elif isinstance(o, dict):
+      stack.extend(o.itervalues())
+  return total
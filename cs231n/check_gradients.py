@@ -0,0 +1,207 @@
+"""
+Numeric gradient checks and old-versus-new equality checks for the layers
+and update rules that have hand-derived fast paths:
+
+- conv_forward_nhwc and conv_backward_nhwc against the channels-first
+  conv_forward_strides and conv_backward_strides, and against numeric
+  gradients;
+- conv-batchnorm-relu run with need_param_grads=False, whose dx must match
+  both the full backward pass and numeric gradients;
+- word_embedding_backward_sparse against np.add.at and numeric gradients;
+- sparse_adam against adam, on rows that get a gradient at every step;
+- PretrainedCNN with batchnorm folded into its weights (fused=True) against
+  the unfolded test-mode forward pass.
+
+Everything runs in float64 on small random inputs. Each check returns a
+dictionary mapping the name of a comparison to its relative error.
+
+Run it from the assignment directory:
+
+python -m cs231n.check_gradients
+"""
+
+import numpy as np
+
+from cs231n.gradient_check import eval_numerical_gradient_array
+from cs231n.fast_layers import (conv_forward_strides, conv_backward_strides,
+                                conv_forward_nhwc, conv_backward_nhwc)
+from cs231n.layer_utils import conv_bn_relu_forward, conv_bn_relu_backward
+from cs231n.rnn_layers import (word_embedding_forward,
+                               word_embedding_backward_sparse)
+from cs231n.optim import adam, sparse_adam
+from cs231n.classifiers.pretrained_cnn import PretrainedCNN
+
+
+def rel_error(x, y):
+  """ returns relative error """
+  return np.max(np.abs(x - y) / (np.maximum(1e-8, np.abs(x) + np.abs(y))))
+
+
+def check_conv_nhwc(seed=0):
+  """
+  Compare the channels-last conv layer with the channels-first one, and the
+  gradients of the channels-last layer with numeric gradients.
+  """
+  rng = np.random.RandomState(seed)
+  x = rng.randn(2, 3, 7, 7)
+  w = rng.randn(4, 3, 3, 3)
+  b = rng.randn(4)
+  conv_param = {'stride': 2, 'pad': 1}
+  x_nhwc = np.ascontiguousarray(x.transpose(0, 2, 3, 1))
+
+  out, cache = conv_forward_strides(x, w, b, conv_param)
+  out_nhwc, cache_nhwc = conv_forward_nhwc(x_nhwc, w, b, conv_param)
+  dout = rng.randn(*out.shape)
+  dout_nhwc = np.ascontiguousarray(dout.transpose(0, 2, 3, 1))
+  dx, dw, db = conv_backward_strides(dout, cache)
+  dx_nhwc, dw_nhwc, db_nhwc = conv_backward_nhwc(dout_nhwc, cache_nhwc)
+
+  fx = lambda x: conv_forward_nhwc(x, w, b, conv_param)[0]
+  fw = lambda w: conv_forward_nhwc(x_nhwc, w, b, conv_param)[0]
+  fb = lambda b: conv_forward_nhwc(x_nhwc, w, b, conv_param)[0]
+  return {
+    'out vs NCHW': rel_error(out_nhwc, out.transpose(0, 2, 3, 1)),
+    'dx vs NCHW': rel_error(dx_nhwc, dx.transpose(0, 2, 3, 1)),
+    'dw vs NCHW': rel_error(dw_nhwc, dw),
+    'db vs NCHW': rel_error(db_nhwc, db),
+    'dx numeric': rel_error(dx_nhwc, eval_numerical_gradient_array(
+                                        fx, x_nhwc, dout_nhwc)),
+    'dw numeric': rel_error(dw_nhwc, eval_numerical_gradient_array(
+                                        fw, w, dout_nhwc)),
+    'db numeric': rel_error(db_nhwc, eval_numerical_gradient_array(
+                                        fb, b, dout_nhwc)),
+  }
+
+
+def check_input_grads_only(seed=0):
+  """
+  Compare dx of conv-batchnorm-relu run with need_param_grads=False, in both
+  layouts and both batchnorm modes, with the full backward pass and with
+  numeric gradients.
+  """
+  rng = np.random.RandomState(seed)
+  x = rng.randn(2, 3, 6, 6)
+  w = rng.randn(4, 3, 3, 3)
+  b = rng.randn(4)
+  gamma, beta = rng.rand(4) + 0.5, rng.randn(4)
+  conv_param = {'stride': 1, 'pad': 1}
+  errors = {}
+  for mode in ['train', 'test']:
+    for channels_last in [False, True]:
+      xl = x.transpose(0, 2, 3, 1).copy() if channels_last else x
+      def forward(xl, need_param_grads=True):
+        # Fixed running averages, so that train mode doesn't change them
+        bn_param = {'mode': mode, 'running_mean': np.zeros(4) + 0.1,
+                    'running_var': np.ones(4) * 2.0}
+        return conv_bn_relu_forward(xl, w, b, gamma, beta, conv_param,
+                                    bn_param, channels_last=channels_last,
+                                    need_param_grads=need_param_grads)
+      out, cache = forward(xl)
+      dout = rng.randn(*out.shape)
+      dx_full = conv_bn_relu_backward(dout, cache,
+                                      channels_last=channels_last)[0]
+      _, cache = forward(xl, need_param_grads=False)
+      dx, dw, _, dgamma, _ = conv_bn_relu_backward(
+          dout, cache, channels_last=channels_last, need_param_grads=False)
+      dx_num = eval_numerical_gradient_array(lambda xl: forward(xl)[0], xl,
+                                             dout)
+      name = '%s %s' % (mode, 'NHWC' if channels_last else 'NCHW')
+      errors[name + ' dx vs full'] = rel_error(dx, dx_full)
+      errors[name + ' dx numeric'] = rel_error(dx, dx_num)
+      errors[name + ' no param grads'] = float(dw is not None or
+                                               dgamma is not None)
+  return errors
+
+
+def check_sparse_embedding(seed=0):
+  """
+  Compare the sparse gradient of the word embedding with one summed with
+  np.add.at (not with word_embedding_backward, which is built on the sparse
+  gradient) and with numeric gradients. Words are repeated so that rows get
+  summed.
+  """
+  rng = np.random.RandomState(seed)
+  V, D = 7, 4
+  x = rng.randint(V - 2, size=(3, 5))
+  W = rng.randn(V, D)
+  out, cache = word_embedding_forward(x, W)
+  dout = rng.randn(*out.shape)
+  rows, drows = word_embedding_backward_sparse(dout, cache)
+  dW_sparse = np.zeros_like(W)
+  dW_sparse[rows] = drows
+  dW_add_at = np.zeros_like(W)
+  np.add.at(dW_add_at, x, dout)
+  dW_num = eval_numerical_gradient_array(
+      lambda W: word_embedding_forward(x, W)[0], W, dout)
+  return {
+    'rows are the distinct words': float(not np.array_equal(rows,
+                                                            np.unique(x))),
+    'dW vs np.add.at': rel_error(dW_sparse, dW_add_at),
+    'dW numeric': rel_error(dW_sparse, dW_num),
+  }
+
+
+def check_sparse_adam(seed=0, num_steps=20):
+  """
+  Compare sparse_adam with adam on the rows of a matrix that get a gradient
+  at every step; on those rows the two must agree.
+  """
+  rng = np.random.RandomState(seed)
+  x_dense = rng.randn(8, 3)
+  x_sparse = x_dense.copy()
+  rows = np.array([1, 4, 5])
+  dense_config = {'learning_rate': 1e-2}
+  sparse_config = {'learning_rate': 1e-2}
+  for _ in xrange(num_steps):
+    drows = rng.randn(rows.shape[0], 3)
+    dx = np.zeros_like(x_dense)
+    dx[rows] = drows
+    x_dense, dense_config = adam(x_dense, dx, dense_config)
+    x_sparse, sparse_config = sparse_adam(x_sparse, (rows, drows),
+                                          sparse_config)
+  return {
+    'x rows vs adam': rel_error(x_sparse[rows], x_dense[rows]),
+    'm rows vs adam': rel_error(sparse_config['m'][rows],
+                                dense_config['m'][rows]),
+    'v rows vs adam': rel_error(sparse_config['v'][rows],
+                                dense_config['v'][rows]),
+  }
+
+
+def check_folded_batchnorm(seed=0, N=2):
+  """
+  Compare the test-time scores of a randomly initialized PretrainedCNN with
+  random batchnorm parameters and running averages, run with batchnorm
+  folded into its weights and without, in both layouts.
+  """
+  rng = np.random.RandomState(seed)
+  model = PretrainedCNN(dtype=np.float64)
+  for i, bn_param in enumerate(model.bn_params):
+    dim = model.bn_dims[i]
+    model.params['gamma%d' % (i + 1)] = rng.rand(dim) + 0.5
+    model.params['beta%d' % (i + 1)] = rng.randn(dim)
+    bn_param['running_mean'] = rng.randn(dim)
+    bn_param['running_var'] = rng.rand(dim) + 0.5
+  X = rng.randn(N, 3, model.input_size, model.input_size)
+  scores, _ = model.forward(X, keep_cache=False)
+  errors = {}
+  for channels_last in [False, True]:
+    name = 'NHWC' if channels_last else 'NCHW'
+    fused, _ = model.forward(X, fused=True, channels_last=channels_last)
+    errors['%s scores vs unfolded' % name] = rel_error(fused, scores)
+  return errors
+
+
+if __name__ == '__main__':
+  checks = [check_conv_nhwc, check_input_grads_only, check_sparse_embedding,
+            check_sparse_adam, check_folded_batchnorm]
+  max_error = 0.0
+  for check in checks:
+    print check.__name__
+    errors = check()
+    for k in sorted(errors):
+      print '  %-32s %.2e' % (k, errors[k])
+      max_error = max(max_error, errors[k])
+  # Relative errors of correct float64 gradients are far below this
+  print 'max relative error %.2e: %s' % (max_error,
+                                         'ok' if max_error < 1e-6 else 'FAIL')
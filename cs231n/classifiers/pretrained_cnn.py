@@ -1,9 +1,12 @@
+import os
 import numpy as np
 import h5py
 
 from cs231n.layers import *
 from cs231n.fast_layers import *
 from cs231n.layer_utils import *
+from cs231n.array_cache import (ARRAY_CACHE_VERSION, load_array_cache,
+                                start_array_cache, finish_array_cache)
 
 
 class PretrainedCNN(object):
@@ -31,78 +34,163 @@ class PretrainedCNN(object):
 
     self.bn_params = []
     
+    # Record the shape and initialization of every parameter, in the order in
+    # which they are initialized; init is the std of a Gaussian, 0 or 1.
     cur_size = input_size
     prev_dim = 3
-    self.params = {}
+    self.param_specs = []
+    self.bn_dims = []
     for i, (f, next_dim) in enumerate(zip(self.filter_sizes, self.num_filters)):
       fan_in = f * f * prev_dim
-      self.params['W%d' % (i + 1)] = np.sqrt(2.0 / fan_in) * np.random.randn(next_dim, prev_dim, f, f)
-      self.params['b%d' % (i + 1)] = np.zeros(next_dim)
-      self.params['gamma%d' % (i + 1)] = np.ones(next_dim)
-      self.params['beta%d' % (i + 1)] = np.zeros(next_dim)
+      self.param_specs.append(('W%d' % (i + 1), (next_dim, prev_dim, f, f), np.sqrt(2.0 / fan_in)))
+      self.param_specs.append(('b%d' % (i + 1), (next_dim,), 'zeros'))
+      self.param_specs.append(('gamma%d' % (i + 1), (next_dim,), 'ones'))
+      self.param_specs.append(('beta%d' % (i + 1), (next_dim,), 'zeros'))
       self.bn_params.append({'mode': 'train'})
+      self.bn_dims.append(next_dim)
       prev_dim = next_dim
       if self.conv_params[i]['stride'] == 2: cur_size /= 2
     
     # Add a fully-connected layers
     fan_in = cur_size * cur_size * self.num_filters[-1]
-    self.params['W%d' % (i + 2)] = np.sqrt(2.0 / fan_in) * np.random.randn(fan_in, hidden_dim)
-    self.params['b%d' % (i + 2)] = np.zeros(hidden_dim)
-    self.params['gamma%d' % (i + 2)] = np.ones(hidden_dim)
-    self.params['beta%d' % (i + 2)] = np.zeros(hidden_dim)
+    self.param_specs.append(('W%d' % (i + 2), (fan_in, hidden_dim), np.sqrt(2.0 / fan_in)))
+    self.param_specs.append(('b%d' % (i + 2), (hidden_dim,), 'zeros'))
+    self.param_specs.append(('gamma%d' % (i + 2), (hidden_dim,), 'ones'))
+    self.param_specs.append(('beta%d' % (i + 2), (hidden_dim,), 'zeros'))
     self.bn_params.append({'mode': 'train'})
-    self.params['W%d' % (i + 3)] = np.sqrt(2.0 / hidden_dim) * np.random.randn(hidden_dim, num_classes)
-    self.params['b%d' % (i + 3)] = np.zeros(num_classes)
-    
-    for k, v in self.params.iteritems():
-      self.params[k] = v.astype(dtype)
+    self.bn_dims.append(hidden_dim)
+    self.param_specs.append(('W%d' % (i + 3), (hidden_dim, num_classes), np.sqrt(2.0 / hidden_dim)))
+    self.param_specs.append(('b%d' % (i + 3), (num_classes,), 'zeros'))
 
-    if h5_file is not None:
+    # Random initialization is skipped when the weights are loaded from a file
+    self.params = {}
+    self.folded_params = None
+    if h5_file is None:
+      self._init_params()
+    else:
       self.load_weights(h5_file)
 
+
+  def _init_params(self, names=None):
+    """
+    Randomly initialize the parameters called names, or all of them.
+    """
+    for k, shape, init in self.param_specs:
+      if names is not None and k not in names:
+        continue
+      if init == 'zeros':
+        self.params[k] = np.zeros(shape, dtype=self.dtype)
+      elif init == 'ones':
+        self.params[k] = np.ones(shape, dtype=self.dtype)
+      else:
+        self.params[k] = (init * np.random.randn(*shape)).astype(self.dtype)
+
   
-  def load_weights(self, h5_file, verbose=False):
+  def load_weights(self, h5_file, verbose=False, cache_dir=None):
     """
     Load pretrained weights from an HDF5 file.
 
+    Each dataset is read once, straight into a contiguous array of self.dtype;
+    weight matrices stored transposed are transposed once more. The batchnorm
+    running averages are initialized from the layer sizes, and parameters
+    that are missing from the file are randomly initialized.
+
     Inputs:
     - h5_file: Path to the HDF5 file where pretrained weights are stored.
     - verbose: Whether to print debugging info
+    - cache_dir: If not None, keep the converted weights as .npy files in this
+      directory, with a manifest.json recording the HDF5 file and dtype they
+      were converted from. Later loads memory-map them copy-on-write instead
+      of reading the HDF5 file, so the model only reads the pages it uses and
+      changes to the weights are never written back.
     """
+    shapes = dict((k, shape) for k, shape, _ in self.param_specs)
+    for i, dim in enumerate(self.bn_dims):
+      shapes['running_mean%d' % (i + 1)] = (dim,)
+      shapes['running_var%d' % (i + 1)] = (dim,)
+
+    weights = None
+    if cache_dir is not None:
+      fingerprint = {
+        'version': ARRAY_CACHE_VERSION,
+        'sources': [[os.path.basename(h5_file), os.path.getsize(h5_file),
+                     os.path.getmtime(h5_file)]],
+        'dtype': np.dtype(self.dtype).str,
+      }
+      weights = load_array_cache(cache_dir, fingerprint, mmap_mode='c')
+    if weights is None:
+      weights = self._read_weights(h5_file, shapes, verbose)
+      if cache_dir is not None:
+        start_array_cache(cache_dir)
+        finish_array_cache(cache_dir, fingerprint, weights)
+        weights = load_array_cache(cache_dir, fingerprint, mmap_mode='c')
+
+    for k, v in weights.iteritems():
+      if k.startswith('running_mean'):
+        self.bn_params[int(k[12:]) - 1]['running_mean'] = v
+      elif k.startswith('running_var'):
+        self.bn_params[int(k[11:]) - 1]['running_var'] = v
+      else:
+        self.params[k] = v
+    for i, dim in enumerate(self.bn_dims):
+      self.bn_params[i].setdefault('running_mean', np.zeros(dim, dtype=self.dtype))
+      self.bn_params[i].setdefault('running_var', np.zeros(dim, dtype=self.dtype))
+    missing = [k for k, _, _ in self.param_specs if k not in self.params]
+    if missing:
+      self._init_params(missing)
+    self.folded_params = None
 
-    # Before loading weights we need to make a dummy forward pass to initialize
-    # the running averages in the bn_pararams
-    x = np.random.randn(1, 3, self.input_size, self.input_size)
-    y = np.random.randint(self.num_classes, size=1)
-    loss, grads = self.loss(x, y)
 
+  def fold_batchnorm(self):
+    """
+    Fold the test-time batch normalization of every layer into the weights
+    and bias of its conv or affine layer, for forward with fused=True.
+
+    The folded weights are kept in self.folded_params. They are dropped
+    whenever the model runs forward in training mode or loads weights, and
+    are then computed again by the next fused forward pass; call this method
+    again yourself after changing self.params or self.bn_params directly.
+
+    Returns:
+    - folded_params: Dictionary mapping 'W%d' and 'b%d' for every layer to
+      the folded weights and biases.
+    """
+    folded = {}
+    for i in xrange(len(self.conv_params) + 2):
+      i1 = i + 1
+      w, b = self.params['W%d' % i1], self.params['b%d' % i1]
+      if i <= len(self.conv_params):
+        gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
+        w, b = fold_batchnorm(w, b, gamma, beta, self.bn_params[i])
+      folded['W%d' % i1], folded['b%d' % i1] = w, b
+    self.folded_params = folded
+    return folded
+
+
+  def _read_weights(self, h5_file, shapes, verbose=False):
+    """
+    Read the datasets of an HDF5 file whose names are keys of shapes into
+    contiguous arrays of self.dtype with those shapes.
+    """
+    weights = {}
     with h5py.File(h5_file, 'r') as f:
       for k, v in f.iteritems():
-        v = np.asarray(v)
-        if k in self.params:
-          if verbose: print k, v.shape, self.params[k].shape
-          if v.shape == self.params[k].shape:
-            self.params[k] = v.copy()
-          elif v.T.shape == self.params[k].shape:
-            self.params[k] = v.T.copy()
-          else:
-            raise ValueError('shapes for %s do not match' % k)
-        if k.startswith('running_mean'):
-          i = int(k[12:]) - 1
-          assert self.bn_params[i]['running_mean'].shape == v.shape
-          self.bn_params[i]['running_mean'] = v.copy()
-          if verbose: print k, v.shape
-        if k.startswith('running_var'):
-          i = int(k[11:]) - 1
-          assert v.shape == self.bn_params[i]['running_var'].shape
-          self.bn_params[i]['running_var'] = v.copy()
-          if verbose: print k, v.shape
-        
-    for k, v in self.params.iteritems():
-      self.params[k] = v.astype(self.dtype)
+        if k not in shapes:
+          continue
+        if verbose: print k, v.shape, shapes[k]
+        out = np.empty(v.shape, dtype=self.dtype)
+        v.read_direct(out)
+        if v.shape == shapes[k]:
+          weights[k] = out
+        elif v.shape[::-1] == shapes[k]:
+          weights[k] = np.ascontiguousarray(out.T)
+        else:
+          raise ValueError('shapes for %s do not match' % k)
+    return weights
 
   
-  def forward(self, X, start=None, end=None, mode='test'):
+  def forward(self, X, start=None, end=None, mode='test', fused=False,
+              keep_cache=True, channels_last=False, need_param_grads=True):
     """
     Run part of the model forward, starting and ending at an arbitrary layer,
     in either training mode or testing mode.
@@ -126,21 +214,50 @@ class PretrainedCNN(object):
       fully-connected layer, returning class scores. Default is 11.
     - mode: The mode to use, either 'test' or 'train'. We need this because
       batch normalization behaves differently at training time and test time.
+    - fused: In test mode, run every layer as a single conv or affine layer
+      with batchnorm folded into its weights (see fold_batchnorm), followed
+      by an in-place ReLU. Nothing is kept for a backward pass, so the cache
+      can't be passed to self.backward.
+    - keep_cache: In test mode, if False, drop the cache of every layer as soon
+      as the layer has run, including the im2col matrices of the conv layers,
+      so that only the current activations are ever held in memory. The
+      output is the same, but the cache can't be passed to self.backward.
+    - channels_last: Run the conv layers on activations of shape
+      (N, H, W, C), so that no layer transposes its activations. X and out
+      keep their usual (N, C, H, W) shapes; activations are converted only
+      when entering the first conv layer and when leaving the conv layers.
+    - need_param_grads: If False, the cache keeps only what is needed for
+      dX, leaving out the im2col matrices of the conv layers and the
+      normalized batchnorm inputs, and can only be passed to self.backward
+      with need_param_grads=False.
 
     Returns:
     - out: Output from the end layer.
     - cache: A cache object that can be passed to the backward method to run the
       network backward over the same range of layers.
     """
-    X = X.astype(self.dtype)
+    X = X.astype(self.dtype, copy=False)
     if start is None: start = 0
     if end is None: end = len(self.conv_params) + 1
+    if mode == 'train':
+      # Training changes the batchnorm running averages
+      self.folded_params = None
+    elif fused:
+      out = self._fused_forward(X, start, end, channels_last=channels_last)
+      return out, (start, end, None, channels_last, False)
     layer_caches = []
+    if mode == 'test' and not keep_cache:
+      layer_caches = None
 
     prev_a = X
+    del X
+    nhwc = False
     for i in xrange(start, end + 1):
       i1 = i + 1
-      if 0 <= i < len(self.conv_params):
+      is_conv = 0 <= i < len(self.conv_params)
+      prev_a = self._convert_layout(prev_a, nhwc, channels_last and is_conv)
+      nhwc = channels_last and is_conv
+      if is_conv:
         # This is a conv layer
         w, b = self.params['W%d' % i1], self.params['b%d' % i1]
         gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
@@ -148,14 +265,19 @@ class PretrainedCNN(object):
         bn_param = self.bn_params[i]
         bn_param['mode'] = mode
 
-        next_a, cache = conv_bn_relu_forward(prev_a, w, b, gamma, beta, conv_param, bn_param)
+        next_a, cache = conv_bn_relu_forward(prev_a, w, b, gamma, beta,
+                                             conv_param, bn_param,
+                                             channels_last=channels_last,
+                                             need_param_grads=need_param_grads)
       elif i == len(self.conv_params):
         # This is the fully-connected hidden layer
         w, b = self.params['W%d' % i1], self.params['b%d' % i1]
         gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
         bn_param = self.bn_params[i]
         bn_param['mode'] = mode
-        next_a, cache = affine_bn_relu_forward(prev_a, w, b, gamma, beta, bn_param)
+        next_a, cache = affine_bn_relu_forward(
+            prev_a, w, b, gamma, beta, bn_param,
+            need_param_grads=need_param_grads)
       elif i == len(self.conv_params) + 1:
         # This is the last fully-connected layer that produces scores
         w, b = self.params['W%d' % i1], self.params['b%d' % i1]
@@ -163,15 +285,105 @@ class PretrainedCNN(object):
       else:
         raise ValueError('Invalid layer index %d' % i)
 
-      layer_caches.append(cache)
+      # Dropping our references frees the cache and the previous activations
+      if layer_caches is not None:
+        layer_caches.append(cache)
+      del cache
       prev_a = next_a
 
-    out = prev_a
-    cache = (start, end, layer_caches)
+    out = self._convert_layout(prev_a, nhwc, False)
+    cache = (start, end, layer_caches, channels_last, need_param_grads)
     return out, cache
 
 
-  def backward(self, dout, cache):
+  def _convert_layout(self, a, from_nhwc, to_nhwc):
+    """
+    Convert activations or their gradients between the (N, C, H, W) layout
+    and the (N, H, W, C) layout used by the conv layers with channels_last.
+    """
+    if from_nhwc == to_nhwc:
+      return a
+    if to_nhwc:
+      return np.ascontiguousarray(a.transpose(0, 2, 3, 1))
+    return np.ascontiguousarray(a.transpose(0, 3, 1, 2))
+
+
+  def _fused_forward(self, X, start, end, channels_last=False):
+    """
+    Test-time forward pass of forward with fused=True.
+    """
+    folded = self.folded_params
+    if folded is None:
+      folded = self.fold_batchnorm()
+    prev_a = X
+    nhwc = False
+    for i in xrange(start, end + 1):
+      i1 = i + 1
+      w, b = folded['W%d' % i1], folded['b%d' % i1]
+      is_conv = 0 <= i < len(self.conv_params)
+      prev_a = self._convert_layout(prev_a, nhwc, channels_last and is_conv)
+      nhwc = channels_last and is_conv
+      if is_conv:
+        prev_a = conv_relu_inference_forward(prev_a, w, b, self.conv_params[i],
+                                             channels_last=channels_last)
+      elif i == len(self.conv_params):
+        prev_a = affine_relu_inference_forward(prev_a, w, b)
+      elif i == len(self.conv_params) + 1:
+        prev_a, _ = affine_forward(prev_a, w, b)
+      else:
+        raise ValueError('Invalid layer index %d' % i)
+    return self._convert_layout(prev_a, nhwc, False)
+
+
+  def extract_features(self, X, layers, batch_size=100, out_dir=None,
+                       fused=False):
+    """
+    Compute the test-time activations of several layers in a single forward
+    pass over a (possibly large) array of images, one batch at a time.
+
+    Inputs:
+    - X: Array of shape (N, 3, 64, 64) of images; anything that can be
+      sliced into batches works, such as a memory-mapped array.
+    - layers: Sequence of layer indices, as in self.forward.
+    - batch_size: Number of images run forward at a time.
+    - out_dir: If not None, write the activations of layer i to the file
+      layer_<i>.npy in this directory and return them as memory-mapped
+      arrays, so they never have to fit in memory.
+    - fused: Whether to run the layers with batchnorm folded into the
+      weights; see self.forward.
+
+    Returns:
+    - features: Dictionary mapping each index in layers to an array of shape
+      (N, ...) of the activations of that layer.
+    """
+    layers = sorted(set(layers))
+    if out_dir is not None and not os.path.isdir(out_dir):
+      os.makedirs(out_dir)
+    N = X.shape[0]
+    features = {}
+    for start in xrange(0, N, batch_size):
+      a = X[start:start + batch_size]
+      for i in xrange(layers[-1] + 1):
+        a, _ = self.forward(a, start=i, end=i, fused=fused, keep_cache=False)
+        if i not in layers:
+          continue
+        if i not in features:
+          # Allocate the output once the shape of the layer is known
+          shape = (N,) + a.shape[1:]
+          if out_dir is None:
+            features[i] = np.empty(shape, dtype=a.dtype)
+          else:
+            out_file = os.path.join(out_dir, 'layer_%d.npy' % i)
+            features[i] = np.lib.format.open_memmap(out_file, mode='w+',
+                                                    dtype=a.dtype, shape=shape)
+        features[i][start:start + a.shape[0]] = a
+    if out_dir is not None:
+      for v in features.itervalues():
+        v.flush()
+    return features
+
+
+  def backward(self, dout, cache, need_param_grads=True):
     """
     Run the model backward over a sequence of layers that were previously run
     forward using the self.forward method.
@@ -180,6 +392,9 @@ class PretrainedCNN(object):
     - dout: Gradient with respect to the ending layer; this should have the same
       shape as the out variable returned from the corresponding call to forward.
     - cache: A cache object returned from self.forward.
+    - need_param_grads: If False, only compute dX and return an empty grads
+      dictionary; this skips the weight gradient matrix multiplies of every
+      layer, which is all that is needed to optimize an input image.
 
     Returns:
     - dX: Gradient with respect to the start layer. This will have the same
@@ -191,27 +406,40 @@ class PretrainedCNN(object):
       layers. The grads dictionary will therefore contain a subset of the keys
       of self.params, and grads[k] and self.params[k] will have the same shape.
     """
-    start, end, layer_caches = cache
+    start, end, layer_caches, channels_last, has_param_caches = cache
+    if layer_caches is None:
+      raise ValueError('forward was run with keep_cache=False or fused=True')
+    if need_param_grads and not has_param_caches:
+      raise ValueError('forward was run with need_param_grads=False')
     dnext_a = dout
     grads = {}
+    nhwc = False
     for i in reversed(range(start, end + 1)):
       i1 = i + 1
+      # Gradients follow the layout of the activations in forward
+      is_conv = 0 <= i < len(self.conv_params)
+      dnext_a = self._convert_layout(dnext_a, nhwc, channels_last and is_conv)
+      nhwc = channels_last and is_conv
       if i == len(self.conv_params) + 1:
         # This is the last fully-connected layer
-        dprev_a, dw, db = affine_backward(dnext_a, layer_caches.pop())
+        dprev_a, dw, db = affine_backward(dnext_a, layer_caches.pop(),
+                                          need_param_grads=need_param_grads)
         grads['W%d' % i1] = dw
         grads['b%d' % i1] = db
       elif i == len(self.conv_params):
         # This is the fully-connected hidden layer
-        temp = affine_bn_relu_backward(dnext_a, layer_caches.pop())
+        temp = affine_bn_relu_backward(dnext_a, layer_caches.pop(),
+                                       need_param_grads=need_param_grads)
         dprev_a, dw, db, dgamma, dbeta = temp
         grads['W%d' % i1] = dw
         grads['b%d' % i1] = db
         grads['gamma%d' % i1] = dgamma
         grads['beta%d' % i1] = dbeta
-      elif 0 <= i < len(self.conv_params):
+      elif is_conv:
         # This is a conv layer
-        temp = conv_bn_relu_backward(dnext_a, layer_caches.pop())
+        temp = conv_bn_relu_backward(dnext_a, layer_caches.pop(),
+                                     channels_last=channels_last,
+                                     need_param_grads=need_param_grads)
         dprev_a, dw, db, dgamma, dbeta = temp
         grads['W%d' % i1] = dw
         grads['b%d' % i1] = db
@@ -221,7 +449,9 @@ class PretrainedCNN(object):
         raise ValueError('Invalid layer index %d' % i)
       dnext_a = dprev_a
 
-    dX = dnext_a
+    dX = self._convert_layout(dnext_a, nhwc, False)
+    if not need_param_grads:
+      grads = {}
     return dX, grads
 
 
@@ -242,10 +472,11 @@ class PretrainedCNN(object):
     - grads: Dictionary of gradients, with the same keys as self.params.
     """
     # Note that we implement this by just caling self.forward and self.backward
-    mode = 'test' if y is None else 'train'
-    scores, cache = self.forward(X, mode=mode)
-    if mode == 'test':
+    if y is None:
+      scores, _ = self.forward(X, mode='test', keep_cache=False)
       return scores
+    mode = 'train'
+    scores, cache = self.forward(X, mode=mode)
     loss, dscores = softmax_loss(scores, y)
     dX, grads = self.backward(dscores, cache)
     return loss, grads
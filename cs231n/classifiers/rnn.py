@@ -17,7 +17,8 @@ class CaptioningRNN(object):
   """
   
   def __init__(self, word_to_idx, input_dim=512, wordvec_dim=128,
-               hidden_dim=128, cell_type='rnn', dtype=np.float32):
+               hidden_dim=128, cell_type='rnn', dtype=np.float32,
+               sparse_embed=False):
     """
     Construct a new CaptioningRNN instance.
 
@@ -30,12 +31,16 @@ class CaptioningRNN(object):
     - cell_type: What type of RNN to use; either 'rnn' or 'lstm'.
     - dtype: numpy datatype to use; use float32 for training and float64 for
       numeric gradient checking.
+    - sparse_embed: If True, the gradient of W_embed is returned as a tuple
+      (rows, drows) holding only the rows of the words in the minibatch; see
+      word_embedding_backward_sparse.
     """
     if cell_type not in {'rnn', 'lstm'}:
       raise ValueError('Invalid cell_type "%s"' % cell_type)
     
     self.cell_type = cell_type
     self.dtype = dtype
+    self.sparse_embed = sparse_embed
     self.word_to_idx = word_to_idx
     self.idx_to_word = {i: w for w, i in word_to_idx.iteritems()}
     self.params = {}
@@ -73,7 +78,7 @@ class CaptioningRNN(object):
       self.params[k] = v.astype(self.dtype)
 
 
-  def loss(self, features, captions):
+  def loss(self, features, captions, image_idxs=None):
     """
     Compute training-time loss for the RNN. We input image features and
     ground-truth captions for those images, and use an RNN (or LSTM) to compute
@@ -83,11 +88,36 @@ class CaptioningRNN(object):
     - features: Input image features, of shape (N, D)
     - captions: Ground-truth captions; an integer array of shape (N, T) where
       each element is in the range 0 <= y[i, t] < V
+    - image_idxs: Optional; see self.forward.
       
     Returns a tuple of:
     - loss: Scalar loss
     - grads: Dictionary of gradients parallel to self.params
     """
+    # Note that we implement this by just calling self.forward and self.backward
+    loss, cache = self.forward(features, captions, image_idxs)
+    grads = self.backward(cache)
+    return loss, grads
+
+
+  def forward(self, features, captions, image_idxs=None):
+    """
+    Run the training-time forward pass of the RNN, computing the loss and the
+    values needed to backpropagate it.
+
+    Inputs:
+    - features: Input image features, of shape (N, D)
+    - captions: Ground-truth captions; an integer array of shape (N, T) where
+      each element is in the range 0 <= y[i, t] < V
+    - image_idxs: Optional integer array of shape (N,). If given, features
+      instead has shape (M, D) and holds each image of the minibatch once,
+      and caption i is of image image_idxs[i]. Each image is then projected
+      to a hidden state only once, however many captions it has.
+
+    Returns a tuple of:
+    - loss: Scalar loss
+    - cache: A cache object that can be passed to self.backward.
+    """
     # Cut captions into two pieces: captions_in has everything but the last word
     # and will be input to the RNN; captions_out has everything but the first
     # word and this is what we will expect the RNN to generate. These are offset
@@ -95,7 +125,7 @@ class CaptioningRNN(object):
     # after receiving word t. The first element of captions_in will be the START
     # token, and the first element of captions_out will be the first word.
     
-    N = features.shape[0]
+    M = features.shape[0]
     D = features.shape[1]
     T = captions.shape[1]
     
@@ -125,11 +155,14 @@ class CaptioningRNN(object):
     # In the forward pass you will need to do the following:                   #
     # (1) Use an affine transformation to compute the initial hidden state     #
     #     from the image features. This should produce an array of shape (N, H)#
-    features2 = np.zeros((N,1,D))
+    features2 = np.zeros((M,1,D))
     features2[:,0,:] = features
     h0, cache_proj = temporal_affine_forward(features2, W_proj, b_proj)
     
-    h0 = np.squeeze(h0)
+    h0 = h0[:, 0, :]
+    if image_idxs is not None:
+      # Look up the hidden state of each caption's image
+      h0 = h0[image_idxs]
     # (2) Use a word embedding layer to transform the words in captions_in     #
     #     from indices to vectors, giving an array of shape (N, T, W).         #
     
@@ -154,8 +187,27 @@ class CaptioningRNN(object):
     #     the points where the output word is <NULL> using the mask above.     #
     
     loss,dloss = temporal_softmax_loss(scores, captions_out, mask, verbose=False)
-    
-    
+
+    cache = (dloss, cache_scores, cache_rnn, cache_proj, cache_embed,
+             image_idxs)
+    return loss, cache
+
+
+  def backward(self, cache):
+    """
+    Run the backward pass of the RNN over a forward pass previously made with
+    self.forward.
+
+    Inputs:
+    - cache: A cache object returned from self.forward.
+
+    Returns:
+    - grads: Dictionary of gradients parallel to self.params. If
+      self.sparse_embed is True then grads['W_embed'] is a tuple (rows, drows).
+    """
+    dloss, cache_scores, cache_rnn, cache_proj, cache_embed, image_idxs = cache
+    grads = {}
+    ############################################################################
     #                                                                          #
     # In the backward pass you will need to compute the gradient of the loss   #
     # with respect to all model parameters. Use the loss and grads variables   #
@@ -171,11 +223,22 @@ class CaptioningRNN(object):
       dx, dh0, dWx, dWh, db = rnn_backward(dxin, cache_rnn)    
     
     
+    if image_idxs is not None:
+      # The lookup of h0 by image is an embedding of the image indices, so
+      # its backward sums the gradients of the captions of each image.
+      rows, drows = word_embedding_backward_sparse(dh0, (image_idxs, None))
+      M = cache_proj[0].shape[0]
+      dh0 = np.zeros((M, dh0.shape[1]), dtype=dh0.dtype)
+      dh0[rows] = drows
+
     f2 = np.zeros((dh0.shape[0],1,dh0.shape[1]))
     f2[:,0,:] = dh0
     
     dx2, dW_proj, db_proj = temporal_affine_backward(f2, cache_proj)
-    dW_embed = word_embedding_backward(dx, cache_embed)
+    if self.sparse_embed:
+      dW_embed = word_embedding_backward_sparse(dx, cache_embed)
+    else:
+      dW_embed = word_embedding_backward(dx, cache_embed)
     
     
     
@@ -184,7 +247,7 @@ class CaptioningRNN(object):
     #                             END OF YOUR CODE                             #
     ############################################################################
     
-    return loss, grads
+    return grads
 
 
   def sample(self, features, max_length=30):
@@ -229,13 +292,13 @@ class CaptioningRNN(object):
     # (1) Embed the previous word using the learned word embeddings           #
     
     h0 = np.dot(features,W_proj) + b_proj
-    x0ind = self._start * np.ones((features.shape[0],1)) 
-    print x0ind.shape
+    x0ind = self._start * np.ones((features.shape[0],1), dtype=np.int32)
     c0 = np.zeros(h0.shape)
     for i in range(0,max_length):
      
-      emb, _ = word_embedding_forward(x0ind, W_embed)
-      emb = np.squeeze(emb)
+      # Index the embedding matrix directly; word_embedding_forward builds a
+      # one-hot (N, 1, V) array at every step, which dominates sampling time.
+      emb = W_embed[x0ind[:, 0]]
       if self.cell_type == 'lstm':
         
         h0,c0, _ = lstm_step_forward(emb, h0, c0, Wx, Wh, b)
@@ -246,11 +309,7 @@ class CaptioningRNN(object):
       
       
 
-      f2 = np.zeros((h0.shape[0],1,h0.shape[1]))
-
-      f2[:,0,:] = h0
-      scores, _ = temporal_affine_forward(f2, W_vocab, b_vocab)
-      scores = np.squeeze(scores)
+      scores = h0.dot(W_vocab) + b_vocab
       maxind = np.argmax(scores,axis=1)
       captions[:,i]=maxind
       x0ind[:,0] = maxind
@@ -1,30 +1,71 @@
-import os, json
+import os, json, time
 import numpy as np
 import h5py
 
+from cs231n.array_cache import (ARRAY_CACHE_VERSION, load_array_cache,
+                                start_array_cache, finish_array_cache)
+
 
 def load_coco_data(base_dir='cs231n/datasets/coco_captioning',
                    max_train=None,
-                   pca_features=True):
+                   pca_features=True,
+                   lazy=False,
+                   cache_dir=None,
+                   compact=False,
+                   feature_storage=None,
+                   verbose=False):
+  """
+  Load the COCO captioning data.
+
+  Inputs:
+  - base_dir: Directory containing the COCO captioning files.
+  - max_train: If not None, randomly subsample this many training captions.
+  - pca_features: Whether to load PCA-reduced image features instead of the
+    raw VGG-16 fc7 features. If an integer, load the features of that many
+    dimensions written by feature_pca.make_pca_features. To use the raw
+    4096-d features without reading them all into memory, set this to False
+    and lazy to True.
+  - lazy: If True, load the data from a cache of .npy files in cache_dir,
+    building the cache on first use (see _load_coco_cache). The arrays in
+    the returned dictionary are then read-only memory-mapped arrays: only the
+    rows that are actually indexed get read from disk, and processes that
+    load the same cache share their pages.
+  - cache_dir: Directory for the cache used when lazy is True; defaults to
+    base_dir/npy_cache.
+  - compact: If True, store the captions of each split as CompactCaptions and
+    the URLs as CompactStrings instead of padded arrays.
+  - feature_storage: If 'float16' or 'int8', store the image features of
+    each split, in memory and in the cache, as CompressedFeatures of that
+    dtype; minibatches are upcast to float32 when they are gathered.
+  - verbose: With lazy, whether to print how long building or loading the
+    cache took.
+
+  Returns: A dictionary with the captions, image indices, features and URLs
+  of the train and val splits, along with the vocabulary.
+  """
+  if lazy:
+    if cache_dir is None:
+      cache_dir = os.path.join(base_dir, 'npy_cache')
+    data = _load_coco_cache(base_dir, max_train, pca_features, cache_dir,
+                            feature_storage, verbose=verbose)
+    if compact:
+      _compact_coco_data(data)
+    return data
+
   data = {}
   caption_file = os.path.join(base_dir, 'coco2014_captions.h5')
   with h5py.File(caption_file, 'r') as f:
     for k, v in f.iteritems():
       data[k] = np.asarray(v)
 
-  if pca_features:
-    train_feat_file = os.path.join(base_dir, 'train2014_vgg16_fc7_pca.h5')
-  else:
-    train_feat_file = os.path.join(base_dir, 'train2014_vgg16_fc7.h5')
-  with h5py.File(train_feat_file, 'r') as f:
-    data['train_features'] = np.asarray(f['features'])
-
-  if pca_features:
-    val_feat_file = os.path.join(base_dir, 'val2014_vgg16_fc7_pca.h5')
-  else:
-    val_feat_file = os.path.join(base_dir, 'val2014_vgg16_fc7.h5')
-  with h5py.File(val_feat_file, 'r') as f:
-    data['val_features'] = np.asarray(f['features'])
+  train_feat_file, val_feat_file = _feature_files(base_dir, pca_features)
+  for k, feat_file in [('train_features', train_feat_file),
+                       ('val_features', val_feat_file)]:
+    with h5py.File(feat_file, 'r') as f:
+      if feature_storage is None:
+        data[k] = np.asarray(f['features'])
+      else:
+        data[k] = CompressedFeatures.encode(f['features'], feature_storage)
 
   dict_file = os.path.join(base_dir, 'coco2014_vocab.json')
   with open(dict_file, 'r') as f:
@@ -49,36 +90,728 @@ def load_coco_data(base_dir='cs231n/datasets/coco_captioning',
     data['train_captions'] = data['train_captions'][mask]
     data['train_image_idxs'] = data['train_image_idxs'][mask]
 
+  if compact:
+    _compact_coco_data(data)
+  return data
+
+
+def _compact_coco_data(data):
+  """
+  Replace the padded captions and fixed-width URLs of a data dictionary by
+  compact stores.
+  """
+  null_idx = data['word_to_idx']['<NULL>']
+  for split in ['train', 'val']:
+    data['%s_captions' % split] = CompactCaptions.from_padded(
+                                     data['%s_captions' % split], null_idx)
+    data['%s_urls' % split] = CompactStrings(data['%s_urls' % split])
+
+
+def _feature_files(base_dir, pca_features):
+  """
+  Return the paths of the train and val feature files.
+  """
+  if pca_features is True:
+    suffix = '_pca'
+  elif pca_features:
+    suffix = '_pca%d' % pca_features
+  else:
+    suffix = ''
+  train_feat_file = os.path.join(base_dir, 'train2014_vgg16_fc7%s.h5' % suffix)
+  val_feat_file = os.path.join(base_dir, 'val2014_vgg16_fc7%s.h5' % suffix)
+  return train_feat_file, val_feat_file
+
+
+def _load_coco_cache(base_dir, max_train, pca_features, cache_dir,
+                     feature_storage=None, chunk_rows=4096, verbose=False):
+  """
+  Load the COCO data from an array cache (see cs231n.array_cache), building
+  the cache first if needed.
+
+  Each combination of load options gets its own subdirectory of cache_dir,
+  holding one .npy file per array of the data dictionary, the vocabulary as
+  vocab.json, and a manifest.json whose fingerprint records the options, the
+  cache format version, and the size and modification time of every source
+  file. The cache is used only if the fingerprint matches the current source
+  files and options; otherwise it is rebuilt.
+
+  With feature_storage the features are stored as float16 or int8 codes,
+  with the int8 scale and offset of each split in <split>_features_scale.npy
+  and <split>_features_offset.npy, and are returned as CompressedFeatures
+  over the memory-mapped codes.
+
+  Note that with max_train the subsample is drawn when the cache is built,
+  so later loads with the same options get the same subsample.
+  """
+  start_time = time.time()
+  train_feat_file, val_feat_file = _feature_files(base_dir, pca_features)
+  sources = {
+    'captions': os.path.join(base_dir, 'coco2014_captions.h5'),
+    'train_features': train_feat_file,
+    'val_features': val_feat_file,
+    'vocab': os.path.join(base_dir, 'coco2014_vocab.json'),
+    'train_urls': os.path.join(base_dir, 'train2014_urls.txt'),
+    'val_urls': os.path.join(base_dir, 'val2014_urls.txt'),
+  }
+  fingerprint = {
+    'version': ARRAY_CACHE_VERSION,
+    'sources': {k: [os.path.getsize(v), os.path.getmtime(v)]
+                for k, v in sources.iteritems()},
+    'options': {'max_train': max_train, 'pca_features': pca_features,
+                'feature_storage': feature_storage},
+  }
+  options_name = 'pca%d_max%s' % (pca_features, max_train or 'all')
+  if feature_storage is not None:
+    options_name += '_%s' % feature_storage
+  cache_dir = os.path.join(cache_dir, options_name)
+  vocab_file = os.path.join(cache_dir, 'vocab.json')
+
+  data = load_array_cache(cache_dir, fingerprint)
+  cold = data is None
+  if cold:
+    start_array_cache(cache_dir)
+    data = {}
+
+    with h5py.File(sources['captions'], 'r') as f:
+      for k, v in f.iteritems():
+        data[k] = np.asarray(v)
+    if max_train is not None:
+      num_train = data['train_captions'].shape[0]
+      mask = np.random.randint(num_train, size=max_train)
+      data['train_captions'] = data['train_captions'][mask]
+      data['train_image_idxs'] = data['train_image_idxs'][mask]
+
+    for k in ['train_features', 'val_features']:
+      with h5py.File(sources[k], 'r') as f:
+        dset = f['features']
+        # Features are written straight into the cache, a chunk at a time
+        out = np.lib.format.open_memmap(os.path.join(cache_dir, '%s.npy' % k),
+                                        mode='w+',
+                                        dtype=feature_storage or dset.dtype,
+                                        shape=dset.shape)
+        if feature_storage is None:
+          for start in xrange(0, dset.shape[0], chunk_rows):
+            out[start:start + chunk_rows] = dset[start:start + chunk_rows]
+        else:
+          feats = CompressedFeatures.encode(dset, feature_storage,
+                                            chunk_rows=chunk_rows, out=out)
+          if feats.scale is not None:
+            data['%s_scale' % k] = feats.scale
+            data['%s_offset' % k] = feats.offset
+          del feats
+        out.flush()
+        data[k] = out
+        del out
+
+    for k in ['train_urls', 'val_urls']:
+      with open(sources[k], 'r') as f:
+        data[k] = np.asarray([line.strip() for line in f])
+
+    with open(sources['vocab'], 'r') as f:
+      vocab = json.load(f)
+    with open(vocab_file, 'w') as f:
+      json.dump(vocab, f)
+
+    finish_array_cache(cache_dir, fingerprint, data)
+    data = load_array_cache(cache_dir, fingerprint)
+
+  if feature_storage is not None:
+    for k in ['train_features', 'val_features']:
+      scale = data.pop('%s_scale' % k, None)
+      offset = data.pop('%s_offset' % k, None)
+      if scale is not None:
+        scale, offset = np.array(scale), np.array(offset)
+      data[k] = CompressedFeatures(data[k], scale, offset)
+  with open(vocab_file, 'r') as f:
+    for k, v in json.load(f).iteritems():
+      data[k] = v
+
+  if verbose:
+    print '%s COCO data cache %s in %.3f seconds' % (
+          'Built' if cold else 'Loaded', cache_dir, time.time() - start_time)
   return data
 
 
-def decode_captions(captions, idx_to_word):
+def build_vocab_table(idx_to_word):
+  """
+  Build numpy lookup tables for a vocabulary, for decode_captions and
+  decode_caption_tokens. Building them takes about as long as decoding a
+  minibatch, so callers that decode many batches can build them once and pass
+  them in.
+
+  Inputs:
+  - idx_to_word: List or dictionary mapping integers to words.
+
+  Returns a tuple of:
+  - words: Object array where words[i] is the word with index i.
+  - is_null, is_end, is_start: Boolean arrays marking the indices of the
+    <NULL>, <END> and <START> tokens.
+  """
+  if isinstance(idx_to_word, dict):
+    words = np.empty(max(idx_to_word) + 1, dtype=object)
+    for i, w in idx_to_word.iteritems():
+      words[i] = w
+  else:
+    words = np.empty(len(idx_to_word), dtype=object)
+    words[:] = idx_to_word
+  return words, words == '<NULL>', words == '<END>', words == '<START>'
+
+
+def _caption_keep_mask(captions, is_null, is_end):
+  """
+  Find which tokens of each caption are printed: everything up to and
+  including the first <END>, except for <NULL> tokens.
+  """
+  N, T = captions.shape
+  ends = is_end[captions]
+  has_end = ends.any(axis=1)
+  cutoff = np.where(has_end, ends.argmax(axis=1) + 1, T)
+  return (np.arange(T)[None] < cutoff[:, None]) & ~is_null[captions]
+
+
+def _kept_words(captions, keep, words):
+  """
+  Look up the kept tokens of all captions at once and split them into one
+  list of words per caption.
+  """
+  kept = words[captions[keep]].tolist()
+  rows, start = [], 0
+  for n in keep.sum(axis=1).tolist():
+    rows.append(kept[start:start + n])
+    start += n
+  return rows
+
+
+def decode_captions(captions, idx_to_word, vocab_table=None):
   singleton = False
   if captions.ndim == 1:
     singleton = True
     captions = captions[None]
-  decoded = []
-  N, T = captions.shape
-  for i in xrange(N):
-    words = []
-    for t in xrange(T):
-      word = idx_to_word[captions[i, t]]
-      if word != '<NULL>':
-        words.append(word)
-      if word == '<END>':
-        break
-    decoded.append(' '.join(words))
+  if vocab_table is None:
+    vocab_table = build_vocab_table(idx_to_word)
+  words, is_null, is_end, _ = vocab_table
+  keep = _caption_keep_mask(captions, is_null, is_end)
+  decoded = [' '.join(w) for w in _kept_words(captions, keep, words)]
   if singleton:
     decoded = decoded[0]
   return decoded
 
 
-def sample_coco_minibatch(data, batch_size=100, split='train'):
+def decode_caption_tokens(captions, idx_to_word, vocab_table=None):
+  """
+  Decode a batch of captions into lists of words, as used for BLEU scoring.
+  Unlike decode_captions this skips the <START> and <END> tokens and builds
+  no strings.
+
+  Inputs:
+  - captions: Integer array of shape (N, T)
+  - idx_to_word: List or dictionary mapping integers to words.
+  - vocab_table: Optional tables from build_vocab_table(idx_to_word), to
+    avoid building them on every call.
+
+  Returns:
+  - tokens: List of N lists of words.
+  """
+  if vocab_table is None:
+    vocab_table = build_vocab_table(idx_to_word)
+  words, is_null, is_end, is_start = vocab_table
+  keep = _caption_keep_mask(captions, is_null, is_end)
+  keep &= ~is_end[captions] & ~is_start[captions]
+  return _kept_words(captions, keep, words)
+
+
+def sample_coco_minibatch(data, batch_size=100, split='train',
+                          unique_images=False):
   split_size = data['%s_captions' % split].shape[0]
   mask = np.random.choice(split_size, batch_size)
   captions = data['%s_captions' % split][mask]
   image_idxs = data['%s_image_idxs' % split][mask]
+  if unique_images:
+    return _unique_image_minibatch(data, split, captions, image_idxs)
   image_features = data['%s_features' % split][image_idxs]
   urls = data['%s_urls' % split][image_idxs]
   return captions, image_features, urls
 
+
+def _unique_image_minibatch(data, split, captions, image_idxs):
+  """
+  Gather the features and URLs of each distinct image of a minibatch once.
+
+  Returns a tuple of captions, image_features, urls, image_idxs where
+  image_features and urls have one row per distinct image, and caption i is
+  of image image_idxs[i] of the minibatch; this is the format taken by the
+  image_idxs argument of CaptioningRNN.loss.
+  """
+  images, image_idxs = np.unique(image_idxs, return_inverse=True)
+  image_features = data['%s_features' % split][images]
+  urls = data['%s_urls' % split][images]
+  return captions, image_features, urls, image_idxs
+
+
+def caption_lengths(captions, null_idx):
+  """
+  Compute the length of each caption, counting everything up to and including
+  its last non-<NULL> token.
+
+  Inputs:
+  - captions: Integer array of shape (N, T)
+  - null_idx: Index of the <NULL> token
+
+  Returns:
+  - lengths: Integer array of shape (N,)
+  """
+  if isinstance(captions, CompactCaptions):
+    return captions.lengths()
+  T = captions.shape[1]
+  not_null = np.asarray(captions) != null_idx
+  lengths = T - np.argmax(not_null[:, ::-1], axis=1)
+  lengths[~not_null.any(axis=1)] = 0
+  return lengths
+
+
+class BucketedCaptionSampler(object):
+  """
+  A BucketedCaptionSampler draws minibatches like sample_coco_minibatch, but
+  each minibatch only contains captions of similar length, and its captions
+  array is trimmed to the longest caption in the minibatch. Since captions
+  are stored padded to a fixed width, this lets the RNN run fewer timesteps
+  on minibatches of short captions.
+
+  Caption lengths are computed once, and the captions of the split are sorted
+  by length and cut into num_buckets buckets of roughly equal size. To draw a
+  minibatch we pick a bucket with probability proportional to its size and
+  then draw batch_size captions from it uniformly with replacement. Every
+  caption is therefore still drawn with the same probability as by
+  sample_coco_minibatch.
+
+  Example usage:
+
+  sampler = BucketedCaptionSampler(data, batch_size=100, num_buckets=8)
+  captions, features, urls = sampler.sample()
+  """
+
+  def __init__(self, data, batch_size=100, split='train', num_buckets=8):
+    """
+    Inputs:
+    - data: A dictionary of data from load_coco_data
+    - batch_size: Size of the minibatches to draw
+    - split: Which split of the data to draw from
+    - num_buckets: Number of length buckets
+    """
+    self.data = data
+    self.batch_size = batch_size
+    self.split = split
+
+    captions = data['%s_captions' % split]
+    self.max_length = captions.shape[1]
+    self.lengths = caption_lengths(captions, data['word_to_idx']['<NULL>'])
+    order = np.argsort(self.lengths, kind='mergesort')
+    num_buckets = min(num_buckets, order.shape[0])
+    self.buckets = [b for b in np.array_split(order, num_buckets) if b.size]
+    sizes = np.array([b.shape[0] for b in self.buckets], dtype=np.float64)
+    self.bucket_probs = sizes / sizes.sum()
+
+
+  def sample_idxs(self):
+    """
+    Draw the caption indices of a minibatch.
+
+    Returns:
+    - idxs: Integer array of shape (batch_size,)
+    """
+    b = np.random.choice(len(self.buckets), p=self.bucket_probs)
+    return np.random.choice(self.buckets[b], self.batch_size)
+
+
+  def sample(self):
+    """
+    Draw a minibatch.
+
+    Returns a tuple of captions, image_features, urls like
+    sample_coco_minibatch, except that captions has shape (batch_size, L),
+    where L is the length of the longest caption in the minibatch.
+    """
+    split = self.split
+    mask = self.sample_idxs()
+    length = max(self.lengths[mask].max(), 2)
+    captions = self.data['%s_captions' % split]
+    if isinstance(captions, CompactCaptions):
+      captions = captions.materialize_batch(mask, length)
+    else:
+      captions = captions[mask][:, :length]
+    image_idxs = self.data['%s_image_idxs' % split][mask]
+    image_features = self.data['%s_features' % split][image_idxs]
+    urls = self.data['%s_urls' % split][image_idxs]
+    return captions, image_features, urls
+
+
+  def benchmark(self, num_epochs=1):
+    """
+    Count how many recurrent timesteps bucketing saves over training epochs,
+    by drawing the minibatch indices of num_epochs epochs of
+    num_captions / batch_size iterations each, as CaptioningSolver does.
+
+    Returns a dictionary with the number of iterations per epoch
+    ('iterations') and the total number of RNN timesteps per epoch, averaged
+    over the epochs:
+    - 'padded_steps': Without bucketing, where every minibatch runs over the
+      full padded width of the captions.
+    - 'unbucketed_steps': Minibatches drawn uniformly as by
+      sample_coco_minibatch, each trimmed to its longest caption.
+    - 'bucketed_steps': Minibatches drawn from the buckets and trimmed.
+    - 'reduction': Fraction of the padded timesteps saved by bucketing.
+    """
+    num_captions = self.lengths.shape[0]
+    iterations = max(num_captions / self.batch_size, 1)
+    num_batches = num_epochs * iterations
+    unbucketed = bucketed = 0
+    for i in xrange(num_batches):
+      idxs = np.random.choice(num_captions, self.batch_size)
+      unbucketed += max(self.lengths[idxs].max(), 2) - 1
+      bucketed += max(self.lengths[self.sample_idxs()].max(), 2) - 1
+    padded = float(iterations * (self.max_length - 1))
+    bucketed = bucketed / float(num_epochs)
+    return {
+      'iterations': iterations,
+      'padded_steps': padded,
+      'unbucketed_steps': unbucketed / float(num_epochs),
+      'bucketed_steps': bucketed,
+      'reduction': 1.0 - bucketed / padded,
+    }
+
+
+class ImageGroupedCaptionSampler(object):
+  """
+  An ImageGroupedCaptionSampler draws minibatches in which the captions of
+  each image are kept together, so that a minibatch of batch_size captions
+  only holds about batch_size / 5 distinct COCO images. Minibatches are in
+  the format of sample_coco_minibatch with unique_images=True, so each image
+  feature is gathered and projected once.
+
+  Every epoch the images of the split are shuffled, their captions are laid
+  out image by image, and the result is cut into consecutive minibatches;
+  every caption is seen once per epoch.
+
+  Example usage:
+
+  sampler = ImageGroupedCaptionSampler(data, batch_size=100)
+  captions, features, urls, image_idxs = sampler.sample()
+  loss, grads = model.loss(features, captions, image_idxs)
+  """
+
+  def __init__(self, data, batch_size=100, split='train'):
+    """
+    Inputs:
+    - data: A dictionary of data from load_coco_data
+    - batch_size: Size of the minibatches to draw
+    - split: Which split of the data to draw from
+    """
+    self.data = data
+    self.batch_size = batch_size
+    self.split = split
+
+    image_idxs = np.asarray(data['%s_image_idxs' % split])
+    self.order = np.argsort(image_idxs, kind='mergesort')
+    self.counts = np.bincount(image_idxs)
+    self.starts = np.cumsum(self.counts) - self.counts
+    self.num_captions = image_idxs.shape[0]
+    self._epoch_order = np.zeros(0, dtype=np.int64)
+    self._pos = 0
+
+
+  def _shuffle(self):
+    """
+    Lay out the captions of all images in a new random image order.
+    """
+    images = np.random.permutation(self.counts.shape[0])
+    counts = self.counts[images]
+    firsts = np.repeat(self.starts[images] - (np.cumsum(counts) - counts),
+                       counts)
+    self._epoch_order = self.order[firsts + np.arange(self.num_captions)]
+    self._pos = 0
+
+
+  def sample_idxs(self):
+    """
+    Take the caption indices of the next minibatch.
+
+    Returns:
+    - idxs: Integer array of shape (batch_size,)
+    """
+    if self._pos + self.batch_size > self._epoch_order.shape[0]:
+      rest = self._epoch_order[self._pos:]
+      self._shuffle()
+      self._pos = self.batch_size - rest.shape[0]
+      return np.concatenate([rest, self._epoch_order[:self._pos]])
+    self._pos += self.batch_size
+    return self._epoch_order[self._pos - self.batch_size:self._pos]
+
+
+  def sample(self):
+    """
+    Draw a minibatch.
+
+    Returns a tuple of captions, image_features, urls, image_idxs; see
+    sample_coco_minibatch with unique_images=True.
+    """
+    split = self.split
+    mask = self.sample_idxs()
+    captions = self.data['%s_captions' % split][mask]
+    image_idxs = self.data['%s_image_idxs' % split][mask]
+    return _unique_image_minibatch(self.data, split, captions, image_idxs)
+
+
+def _ragged_gather(values, offsets, idxs, width, fill):
+  """
+  Gather rows of a ragged array into a padded array.
+
+  Inputs:
+  - values: 1D array holding all rows back to back.
+  - offsets: 1D array of length R + 1; row i is values[offsets[i]:offsets[i+1]].
+  - idxs: Integer array of shape (N,) giving the rows to gather.
+  - width: Width of the output; longer rows are truncated.
+  - fill: Value used to pad shorter rows.
+
+  Returns:
+  - out: Array of shape (N, width) and the same dtype as values.
+  """
+  idxs = np.asarray(idxs, dtype=np.int64)
+  starts = offsets[idxs].astype(np.int64)
+  lengths = np.minimum(offsets[idxs + 1].astype(np.int64) - starts, width)
+  out = np.empty((idxs.shape[0], width), dtype=values.dtype)
+  out.fill(fill)
+  cols = np.arange(width)
+  valid = cols[None] < lengths[:, None]
+  out[valid] = values[(starts[:, None] + cols[None])[valid]]
+  return out
+
+
+def _index_array(idx, n):
+  """
+  Turn an integer, slice or array index into an array of indices into a
+  sequence of length n.
+  """
+  if isinstance(idx, slice):
+    return np.arange(n)[idx]
+  idx = np.asarray(idx)
+  if idx.dtype == np.bool_:
+    return np.nonzero(idx)[0]
+  return np.where(idx < 0, idx + n, idx)
+
+
+class CompactCaptions(object):
+  """
+  A compact, read-only store of padded captions. The tokens of all captions,
+  without their trailing <NULL> padding, are concatenated into one array of
+  the smallest unsigned dtype that fits the vocabulary, and an offsets array
+  marks where each caption starts.
+
+  Indexing a CompactCaptions with an integer, slice or index array gives the
+  same padded int32 array as indexing the original padded array would, and
+  np.asarray gives back the whole padded array, so it can be used in place of
+  the padded captions of a data dictionary. Use materialize_batch to get a
+  minibatch padded to a different width.
+  """
+
+  def __init__(self, tokens, offsets, width, null_idx, dtype=np.int32):
+    """
+    Inputs:
+    - tokens: 1D array of the tokens of all captions
+    - offsets: 1D array of length N + 1 giving the start of each caption in
+      tokens, followed by the total number of tokens.
+    - width: Width T of the padded captions.
+    - null_idx: Index of the <NULL> token used for padding.
+    - dtype: Integer dtype of materialized captions.
+    """
+    self.tokens = tokens
+    self.offsets = offsets
+    self.width = width
+    self.null_idx = null_idx
+    self.dtype = dtype
+    self.shape = (offsets.shape[0] - 1, width)
+
+
+  @classmethod
+  def from_padded(cls, captions, null_idx):
+    """
+    Build a CompactCaptions from a padded integer array of shape (N, T).
+    """
+    captions = np.asarray(captions)
+    N, T = captions.shape
+    lengths = caption_lengths(captions, null_idx)
+    keep = np.arange(T)[None] < lengths[:, None]
+    token_dtype = np.min_scalar_type(max(captions.max(), null_idx, 0))
+    tokens = captions[keep].astype(token_dtype)
+    offsets = np.zeros(N + 1, dtype=np.min_scalar_type(tokens.shape[0]))
+    offsets[1:] = np.cumsum(lengths)
+    return cls(tokens, offsets, T, null_idx, dtype=captions.dtype)
+
+
+  def lengths(self):
+    """
+    Return an integer array of shape (N,) with the length of each caption.
+    """
+    return np.diff(self.offsets.astype(np.int64))
+
+
+  def materialize_batch(self, idxs, max_len=None):
+    """
+    Build a padded array of captions.
+
+    Inputs:
+    - idxs: Integer array of shape (M,) giving the captions to materialize.
+    - max_len: Width of the output; defaults to the padded width T. Captions
+      longer than max_len are truncated.
+
+    Returns:
+    - captions: Array of shape (M, max_len), padded with <NULL>.
+    """
+    if max_len is None:
+      max_len = self.width
+    out = _ragged_gather(self.tokens, self.offsets, idxs, max_len,
+                         self.null_idx)
+    return out.astype(self.dtype)
+
+
+  def __len__(self):
+    return self.shape[0]
+
+
+  def __getitem__(self, idx):
+    if isinstance(idx, (int, long, np.integer)):
+      return self.materialize_batch(_index_array([idx], self.shape[0]))[0]
+    return self.materialize_batch(_index_array(idx, self.shape[0]))
+
+
+  def __array__(self, dtype=None):
+    out = self.materialize_batch(np.arange(self.shape[0]))
+    return out if dtype is None else out.astype(dtype)
+
+
+class CompactStrings(object):
+  """
+  A compact, read-only store of strings: all strings are concatenated into
+  one bytes blob, and an offsets array marks where each one starts.
+
+  Indexing with an integer gives a string; indexing with a slice or index
+  array gives a numpy array of fixed-width strings, as indexing a numpy
+  string array would.
+  """
+
+  def __init__(self, strings):
+    """
+    Inputs:
+    - strings: Sequence of N strings
+    """
+    strings = [str(x) for x in strings]
+    lengths = np.array([len(x) for x in strings], dtype=np.int64)
+    self.blob = np.frombuffer(''.join(strings), dtype=np.uint8)
+    self.offsets = np.zeros(len(strings) + 1,
+                            dtype=np.min_scalar_type(self.blob.shape[0]))
+    self.offsets[1:] = np.cumsum(lengths)
+    self.shape = (len(strings),)
+
+
+  def __len__(self):
+    return self.shape[0]
+
+
+  def __getitem__(self, idx):
+    if isinstance(idx, (int, long, np.integer)):
+      if idx < 0:
+        idx += self.shape[0]
+      return self.blob[self.offsets[idx]:self.offsets[idx + 1]].tostring()
+    idxs = _index_array(idx, self.shape[0])
+    lengths = self.offsets[idxs + 1].astype(np.int64) - self.offsets[idxs]
+    width = max(int(lengths.max()) if idxs.shape[0] else 0, 1)
+    out = _ragged_gather(self.blob, self.offsets, idxs, width, 0)
+    return out.view('S%d' % width).reshape(idxs.shape[0])
+
+
+  def __array__(self, dtype=None):
+    out = self[np.arange(self.shape[0])]
+    return out if dtype is None else out.astype(dtype)
+
+
+class CompressedFeatures(object):
+  """
+  A read-only store of image features in a smaller dtype: either float16, or
+  int8 codes with a per-column scale and offset, so that column j of row i is
+  codes[i, j] * scale[j] + offset[j].
+
+  Indexing a CompressedFeatures returns the selected rows upcast to dtype
+  (float32 by default), so only the rows of a minibatch are ever expanded and
+  it can be used in place of the features of a data dictionary.
+  """
+
+  def __init__(self, codes, scale=None, offset=None, dtype=np.float32):
+    """
+    Inputs:
+    - codes: Array of shape (N, D) of float16 features or int8 codes
+    - scale, offset: Arrays of shape (D,) for int8 codes; None for float16.
+    - dtype: Floating point dtype of the returned features.
+    """
+    self.codes = codes
+    self.scale = scale
+    self.offset = offset
+    self.dtype = np.dtype(dtype)
+    self.shape = codes.shape
+
+
+  @classmethod
+  def encode(cls, features, storage, chunk_rows=4096, out=None):
+    """
+    Compress features one chunk of rows at a time.
+
+    Inputs:
+    - features: Array or HDF5 dataset of shape (N, D)
+    - storage: Either 'float16' or 'int8'
+    - chunk_rows: Number of rows converted at a time
+    - out: Optional array of shape (N, D) and the dtype of storage in which to
+      write the codes, such as a memory-mapped file.
+
+    Returns:
+    - A CompressedFeatures with the codes in out.
+    """
+    if storage not in ['float16', 'int8']:
+      raise ValueError('Unknown feature storage "%s"' % storage)
+    N, D = features.shape
+    if out is None:
+      out = np.empty((N, D), dtype=storage)
+    if storage == 'float16':
+      for start in xrange(0, N, chunk_rows):
+        out[start:start + chunk_rows] = features[start:start + chunk_rows]
+      return cls(out)
+
+    # Map the range of each column onto the 256 int8 codes.
+    lo = np.full(D, np.inf, dtype=np.float32)
+    hi = np.full(D, -np.inf, dtype=np.float32)
+    for start in xrange(0, N, chunk_rows):
+      X = np.asarray(features[start:start + chunk_rows])
+      lo = np.minimum(lo, X.min(axis=0))
+      hi = np.maximum(hi, X.max(axis=0))
+    scale = (hi - lo) / 255
+    scale[scale == 0] = 1
+    offset = lo + 128 * scale
+    for start in xrange(0, N, chunk_rows):
+      X = np.asarray(features[start:start + chunk_rows], dtype=np.float32)
+      codes = np.rint((X - offset) / scale)
+      out[start:start + chunk_rows] = np.clip(codes, -128, 127)
+    return cls(out, scale, offset)
+
+
+  def __len__(self):
+    return self.shape[0]
+
+
+  def __getitem__(self, idx):
+    X = self.codes[idx].astype(self.dtype)
+    if self.scale is not None:
+      X *= self.scale
+      X += self.offset
+    return X
+
+
+  def __array__(self, dtype=None):
+    out = self[:]
+    return out if dtype is None else out.astype(dtype)
@@ -0,0 +1,102 @@
+"""
+Compare training with the image features stored as float32, float16 and int8
+(see the feature_storage option of load_coco_data).
+
+For each storage the script reports the memory taken by the train and val
+features, the error of the decoded features relative to float32, and the
+final training loss and validation BLEU of a small captioning model trained
+from the same initialization on the same minibatches.
+
+Run it from the assignment directory:
+
+python -m cs231n.compare_feature_storage [base_dir]
+"""
+
+import sys
+import numpy as np
+
+from cs231n.coco_utils import load_coco_data
+from cs231n.classifiers.rnn import CaptioningRNN
+from cs231n.captioning_solver import CaptioningSolver
+
+
+def _feature_bytes(feats):
+  if isinstance(feats, np.ndarray):
+    return feats.nbytes
+  total = feats.codes.nbytes
+  if feats.scale is not None:
+    total += feats.scale.nbytes + feats.offset.nbytes
+  return total
+
+
+def compare_feature_storage(base_dir='cs231n/datasets/coco_captioning',
+                            storages=(None, 'float16', 'int8'),
+                            max_train=50000, seed=0, model_kwargs=None,
+                            solver_kwargs=None):
+  """
+  Train one model per feature storage and collect the results.
+
+  Inputs:
+  - base_dir: Directory containing the COCO captioning files
+  - storages: Values of feature_storage to compare; None is float32.
+  - max_train: Number of training captions to use
+  - seed: Seed used for the training subsample, the model initialization and
+    the minibatches of every run.
+  - model_kwargs, solver_kwargs: Extra arguments for CaptioningRNN and
+    CaptioningSolver.
+
+  Returns:
+  - results: List with one dictionary per storage, holding the storage, the
+    feature bytes, the maximum absolute feature error, the mean of the last
+    10 training losses, and the final validation BLEU-1 to BLEU-4.
+  """
+  model_kwargs = dict({'wordvec_dim': 256, 'hidden_dim': 512,
+                       'cell_type': 'lstm'}, **(model_kwargs or {}))
+  solver_kwargs = dict({'update_rule': 'adam', 'num_epochs': 1,
+                        'batch_size': 100,
+                        'optim_config': {'learning_rate': 5e-3},
+                        'check_bleu': True, 'num_val_samples': 1000,
+                        'verbose': False},
+                       **(solver_kwargs or {}))
+
+  np.random.seed(seed)
+  reference = load_coco_data(base_dir, max_train=max_train)
+  train_idxs = (reference['train_captions'], reference['train_image_idxs'])
+
+  results = []
+  for storage in storages:
+    data = load_coco_data(base_dir, feature_storage=storage)
+    data['train_captions'], data['train_image_idxs'] = train_idxs
+
+    error = 0.0
+    for k in ['train_features', 'val_features']:
+      for start in xrange(0, reference[k].shape[0], 4096):
+        diff = data[k][start:start + 4096] - reference[k][start:start + 4096]
+        error = max(error, np.abs(diff).max())
+
+    np.random.seed(seed)
+    model = CaptioningRNN(data['word_to_idx'],
+                          input_dim=data['train_features'].shape[1],
+                          **model_kwargs)
+    solver = CaptioningSolver(model, data, **solver_kwargs)
+    solver.train()
+    results.append({
+      'storage': storage or 'float32',
+      'feature_bytes': sum(_feature_bytes(data[k])
+                           for k in ['train_features', 'val_features']),
+      'max_feature_error': error,
+      'final_loss': np.mean(solver.loss_history[-10:]),
+      'val_bleu': solver.val_acc_history[-1],
+    })
+  return results
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:2]
+  results = compare_feature_storage(*args)
+  print '%-8s %12s %10s %10s %8s %8s' % ('storage', 'feature MB', 'max error',
+                                          'loss', 'BLEU-1', 'BLEU-4')
+  for r in results:
+    print '%-8s %12.1f %10.4f %10.4f %8.4f %8.4f' % (
+          r['storage'], r['feature_bytes'] / 2.0 ** 20, r['max_feature_error'],
+          r['final_loss'], r['val_bleu'][0], r['val_bleu'][-1])
@@ -0,0 +1,144 @@
+"""
+Compare running the conv layers of a PretrainedCNN on channels-first
+(N, C, H, W) activations with running them on channels-last (N, H, W, C)
+activations (the channels_last option of PretrainedCNN.forward).
+
+With channels-first activations every conv-batchnorm-relu layer copies its
+output into a new layout several times: conv_forward_strides transposes the
+result of its matrix multiply, spatial_batchnorm_forward transposes to
+channels-last to normalize, and on the way back conv_backward_strides and
+spatial_batchnorm_backward transpose their upstream gradients again. With
+channels-last activations none of these copies happen; the only conversions
+are of the input of the first conv layer and of the output of the last one.
+
+For each layout the script times a test-time forward pass, a fused forward
+pass and a forward and backward pass, and reports an analytic estimate of
+the bytes moved by these layout copies. The estimate is computed from the
+layer shapes by layout_copy_bytes; the copies themselves are not measured,
+since most of them happen inside numpy reshapes of transposed arrays.
+
+Run it from the assignment directory:
+
+python -m cs231n.compare_layouts path/to/pretrained_model.h5 [N]
+"""
+
+import sys, time
+import numpy as np
+
+from cs231n.classifiers.pretrained_cnn import PretrainedCNN
+
+
+def layout_copy_bytes(model, N):
+  """
+  Estimate the bytes of the full-tensor layout copies made by one pass over
+  the whole model, for each layout. The estimate counts one copy of the
+  output of every conv layer for each transpose listed in the module
+  docstring, and is computed from the layer shapes alone; nothing is run.
+
+  Inputs:
+  - model: A PretrainedCNN
+  - N: Number of images in the batch
+
+  Returns:
+  - copies: Dictionary mapping (layout, pass) to bytes copied, where layout
+    is 'NCHW' or 'NHWC' and pass is 'forward', 'fused' or 'backward'.
+  """
+  itemsize = np.dtype(model.dtype).itemsize
+  size = model.input_size
+  # Bytes of the output of every conv layer
+  out_bytes = []
+  for conv_param, f, num_filters in zip(model.conv_params, model.filter_sizes,
+                                       model.num_filters):
+    size = (size + 2 * conv_param['pad'] - f) / conv_param['stride'] + 1
+    out_bytes.append(N * num_filters * size * size * itemsize)
+  in_bytes = N * 3 * model.input_size * model.input_size * itemsize
+
+  copies = {}
+  # The conv output transpose, and the transpose into batchnorm
+  copies['NCHW', 'forward'] = 2 * sum(out_bytes)
+  copies['NCHW', 'fused'] = sum(out_bytes)
+  # The upstream gradient transposes of batchnorm and conv
+  copies['NCHW', 'backward'] = 2 * sum(out_bytes)
+  # Only the model boundary: the input and the output of the last conv layer
+  copies['NHWC', 'forward'] = in_bytes + out_bytes[-1]
+  copies['NHWC', 'fused'] = in_bytes + out_bytes[-1]
+  copies['NHWC', 'backward'] = in_bytes + out_bytes[-1]
+  return copies
+
+
+def _best_time(f, num_runs):
+  best = None
+  for _ in xrange(num_runs):
+    t0 = time.time()
+    f()
+    elapsed = time.time() - t0
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def compare_layouts(model, X, num_runs=3):
+  """
+  Time the passes of the model in both layouts and check that they agree.
+
+  Inputs:
+  - model: A PretrainedCNN
+  - X: Array of shape (N, 3, H, W) of inputs
+  - num_runs: Each timing is the best of this many runs
+
+  Returns:
+  - results: List with one dictionary per layout, holding the layout, the
+    seconds of the 'forward', 'fused' and 'backprop' (forward and backward)
+    passes, the estimated bytes of layout copies of each pass (see
+    layout_copy_bytes), and the maximum absolute
+    difference of the scores and input gradients from the channels-first
+    layout.
+  """
+  N = X.shape[0]
+  copies = layout_copy_bytes(model, N)
+  dscores = np.random.RandomState(0).randn(N, model.num_classes)
+  dscores = dscores.astype(model.dtype)
+  results = []
+  for layout, channels_last in [('NCHW', False), ('NHWC', True)]:
+    def forward():
+      return model.forward(X, keep_cache=False, channels_last=channels_last)[0]
+    def fused():
+      return model.forward(X, fused=True, channels_last=channels_last)[0]
+    def backprop():
+      # Test mode keeps the batchnorm running averages of the model unchanged
+      scores, cache = model.forward(X, channels_last=channels_last)
+      return model.backward(dscores, cache)[0]
+    fused()
+    results.append({
+      'layout': layout,
+      'forward': _best_time(forward, num_runs),
+      'fused': _best_time(fused, num_runs),
+      'backprop': _best_time(backprop, num_runs),
+      'forward_copy_bytes': copies[layout, 'forward'],
+      'fused_copy_bytes': copies[layout, 'fused'],
+      'backprop_copy_bytes': (copies[layout, 'forward'] +
+                              copies[layout, 'backward']),
+      'scores': forward(),
+      'dX': backprop(),
+    })
+  ref_scores, ref_dX = results[0].pop('scores'), results[0].pop('dX')
+  for r in results:
+    r['max_score_error'] = np.abs(r.pop('scores', ref_scores) - ref_scores).max()
+    r['max_dX_error'] = np.abs(r.pop('dX', ref_dX) - ref_dX).max()
+  return results
+
+
+if __name__ == '__main__':
+  N = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+  model = PretrainedCNN(h5_file=sys.argv[1])
+  X = np.random.randn(N, 3, model.input_size, model.input_size)
+  X = X.astype(model.dtype)
+  results = compare_layouts(model, X)
+  print '%-6s %-8s %10s %14s' % ('layout', 'pass', 'seconds', 'est. copy MB')
+  for r in results:
+    for k in ['forward', 'fused', 'backprop']:
+      print '%-6s %-8s %10.3f %14.1f' % (r['layout'], k, r[k],
+                                         r[k + '_copy_bytes'] / 2.0 ** 20)
+  print 'copy sizes are analytic estimates from the layer shapes, not measured'
+  print 'max score error %.2e, max dX error %.2e' % (
+        results[1]['max_score_error'], results[1]['max_dX_error'])
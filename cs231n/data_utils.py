@@ -1,8 +1,14 @@
 import cPickle as pickle
 import numpy as np
-import os
+import os, time
+from collections import OrderedDict
+from multiprocessing import Pool
 from scipy.misc import imread
 
+from cs231n.array_cache import (ARRAY_CACHE_VERSION, load_array_cache,
+                                start_array_cache, finish_array_cache)
+
+
 def load_CIFAR_batch(filename):
   """ load single batch of cifar """
   with open(filename, 'rb') as f:
@@ -29,39 +35,113 @@ def load_CIFAR10(ROOT):
   return Xtr, Ytr, Xte, Yte
 
 
+def load_CIFAR10_uint8(ROOT, cache_dir=None):
+  """
+  Load all of CIFAR-10 as uint8 images in (N, 3, 32, 32) layout, without ever
+  holding more than one batch in any other format; the pickled batches are
+  already stored channels first, so no transpose is needed.
+
+  Inputs:
+  - ROOT: Directory containing the CIFAR-10 python batches.
+  - cache_dir: If not None, convert the batches once into .npy files in this
+    directory, with a manifest.json recording the batch files they were
+    converted from, and return read-only memory maps of them; later calls
+    just map the files again.
+
+  Returns a tuple of X_train, y_train, X_test, y_test.
+  """
+  train_files = [os.path.join(ROOT, 'data_batch_%d' % b) for b in range(1, 6)]
+  test_files = [os.path.join(ROOT, 'test_batch')]
+  fingerprint = {
+    'version': ARRAY_CACHE_VERSION,
+    'sources': [[os.path.basename(f), os.path.getsize(f), os.path.getmtime(f)]
+                for f in train_files + test_files],
+  }
+  keys = ['X_train', 'y_train', 'X_test', 'y_test']
+  if cache_dir is not None:
+    data = load_array_cache(cache_dir, fingerprint)
+    if data is not None:
+      return tuple(data[k] for k in keys)
+    start_array_cache(cache_dir)
+
+  data = {}
+  for split, files in [('train', train_files), ('test', test_files)]:
+    shape = (10000 * len(files), 3, 32, 32)
+    if cache_dir is not None:
+      X = np.lib.format.open_memmap(os.path.join(cache_dir, 'X_%s.npy' % split),
+                                    mode='w+', dtype=np.uint8, shape=shape)
+    else:
+      X = np.empty(shape, dtype=np.uint8)
+    y = np.empty(shape[0], dtype=np.int64)
+    for i, filename in enumerate(files):
+      with open(filename, 'rb') as f:
+        datadict = pickle.load(f)
+      X[i * 10000:(i + 1) * 10000] = datadict['data'].reshape(10000, 3, 32, 32)
+      y[i * 10000:(i + 1) * 10000] = datadict['labels']
+      del datadict
+    data['X_%s' % split], data['y_%s' % split] = X, y
+
+  if cache_dir is not None:
+    for k in ['X_train', 'X_test']:
+      data[k].flush()
+    finish_array_cache(cache_dir, fingerprint, data)
+    data = load_array_cache(cache_dir, fingerprint)
+  return tuple(data[k] for k in keys)
+
+
 def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
-                     subtract_mean=True):
+                     subtract_mean=True, dtype=np.float64, lazy=False,
+                     cache_dir=None):
     """
     Load the CIFAR-10 dataset from disk and perform preprocessing to prepare
     it for classifiers. These are the same steps as we used for the SVM, but
     condensed to a single function.
+
+    The data is loaded with load_CIFAR10_uint8, and the splits are slices of
+    the uint8 arrays, so only the returned arrays themselves are ever
+    allocated in dtype.
+
+    Inputs:
+    - num_training, num_validation, num_test: Sizes of the splits
+    - subtract_mean: Whether to subtract the mean training image
+    - dtype: Floating point dtype of the returned images
+    - lazy: If True, return X_train, X_val and X_test as LazyNormalizedImages
+      over the uint8 data, which convert to dtype and subtract the mean image
+      only for the rows that are indexed.
+    - cache_dir: Passed to load_CIFAR10_uint8; with lazy, the uint8 data then
+      stays memory-mapped.
     """
     # Load the raw CIFAR-10 data
     cifar10_dir = 'cs231n/datasets/cifar-10-batches-py'
-    X_train, y_train, X_test, y_test = load_CIFAR10(cifar10_dir)
+    X_train, y_train, X_test, y_test = load_CIFAR10_uint8(cifar10_dir,
+                                                          cache_dir)
         
     # Subsample the data
-    mask = range(num_training, num_training + num_validation)
-    X_val = X_train[mask]
-    y_val = y_train[mask]
-    mask = range(num_training)
-    X_train = X_train[mask]
-    y_train = y_train[mask]
-    mask = range(num_test)
-    X_test = X_test[mask]
-    y_test = y_test[mask]
-
-    # Normalize the data: subtract the mean image
+    X_val = X_train[num_training:num_training + num_validation]
+    y_val = y_train[num_training:num_training + num_validation]
+    X_train = X_train[:num_training]
+    y_train = y_train[:num_training]
+    X_test = X_test[:num_test]
+    y_test = y_test[:num_test]
+
+    # Normalize the data: subtract the mean image, accumulated in float64 one
+    # block of images at a time
+    mean_image = None
     if subtract_mean:
-      mean_image = np.mean(X_train, axis=0)
-      X_train -= mean_image
-      X_val -= mean_image
-      X_test -= mean_image
-    
-    # Transpose so that channels come first
-    X_train = X_train.transpose(0, 3, 1, 2).copy()
-    X_val = X_val.transpose(0, 3, 1, 2).copy()
-    X_test = X_test.transpose(0, 3, 1, 2).copy()
+      mean_image = np.zeros(X_train.shape[1:])
+      for start in xrange(0, X_train.shape[0], 5000):
+        mean_image += X_train[start:start + 5000].sum(axis=0, dtype=np.float64)
+      mean_image = (mean_image / max(X_train.shape[0], 1)).astype(dtype)
+
+    splits = [X_train, X_val, X_test]
+    for i, X in enumerate(splits):
+      if lazy:
+        splits[i] = LazyNormalizedImages(X, mean_image, dtype)
+      else:
+        splits[i] = np.array(X, dtype=dtype)
+        if subtract_mean:
+          splits[i] -= mean_image
+    X_train, X_val, X_test = splits
 
     # Package data into a dictionary
     return {
@@ -71,7 +151,8 @@ def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
     }
     
 
-def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
+def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True,
+                       num_workers=1, cache_dir=None, keep_uint8=False):
   """
   Load TinyImageNet. Each of TinyImageNet-100-A, TinyImageNet-100-B, and
   TinyImageNet-200 have the same directory structure, so this can be used
@@ -81,6 +162,15 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
   - path: String giving path to the directory to load.
   - dtype: numpy datatype used to load the data.
   - subtract_mean: Whether to subtract the mean training image.
+  - num_workers: Number of processes used to decode the images into one
+    preallocated uint8 array.
+  - cache_dir: If not None, keep the decoded uint8 images and the labels as
+    .npy files in this directory, with a manifest.json recording the
+    dataset files they were decoded from; later calls load them from there
+    instead of decoding the images again.
+  - keep_uint8: If True, keep the images as uint8 and return X_train, X_val
+    and X_test as LazyNormalizedImages, which convert to dtype and subtract
+    the mean image only for the rows that are indexed.
 
   Returns: A dictionary with the following entries:
   - class_names: A list where class_names[i] is a list of strings giving the
@@ -108,64 +198,95 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
       wnid_to_words[wnid] = [w.strip() for w in words.split(',')]
   class_names = [wnid_to_words[wnid] for wnid in wnids]
 
-  # Next load training data.
-  X_train = []
-  y_train = []
-  for i, wnid in enumerate(wnids):
-    if (i + 1) % 20 == 0:
-      print 'loading training data for synset %d / %d' % (i + 1, len(wnids))
-    # To figure out the filenames we need to open the boxes file
+  data = None
+  if cache_dir is not None:
+    fingerprint = _tiny_imagenet_fingerprint(path, wnids)
+    data = load_array_cache(cache_dir, fingerprint)
+  if data is None:
+    files = _tiny_imagenet_files(path, wnids, wnid_to_label)
+    if cache_dir is not None:
+      start_array_cache(cache_dir)
+    data = {}
+    for split in ['train', 'val', 'test']:
+      img_files, labels = files[split]
+      out_file = None
+      if cache_dir is not None:
+        out_file = os.path.join(cache_dir, 'X_%s.npy' % split)
+      data['X_%s' % split] = _decode_images(img_files, out_file, num_workers)
+      data['y_%s' % split] = labels
+    if cache_dir is not None:
+      finish_array_cache(cache_dir, fingerprint, data)
+      data = load_array_cache(cache_dir, fingerprint)
+
+  if keep_uint8:
+    # Accumulate the mean in float64, one block of images at a time
+    X_train = data['X_train']
+    mean_image = np.zeros(X_train.shape[1:])
+    for start in xrange(0, X_train.shape[0], 1000):
+      mean_image += X_train[start:start + 1000].sum(axis=0, dtype=np.float64)
+    mean_image = (mean_image / max(X_train.shape[0], 1)).astype(dtype)
+  else:
+    # Take the mean in dtype, exactly as when the images were decoded
+    # straight into dtype arrays
+    for split in ['train', 'val', 'test']:
+      data['X_%s' % split] = np.array(data['X_%s' % split], dtype=dtype)
+    mean_image = data['X_train'].mean(axis=0)
+
+  for split in ['train', 'val', 'test']:
+    X = data['X_%s' % split]
+    if keep_uint8:
+      X = LazyNormalizedImages(X, mean_image if subtract_mean else None, dtype)
+    elif subtract_mean:
+      X -= mean_image[None]
+    data['X_%s' % split] = X
+
+  return {
+    'class_names': class_names,
+    'X_train': data['X_train'],
+    'y_train': data['y_train'],
+    'X_val': data['X_val'],
+    'y_val': data['y_val'],
+    'X_test': data['X_test'],
+    'y_test': data['y_test'],
+    'class_names': class_names,
+    'mean_image': mean_image,
+  }
+
+
+def _tiny_imagenet_files(path, wnids, wnid_to_label):
+  """
+  List the image files of each split of TinyImageNet with their labels.
+
+  Returns: A dictionary mapping 'train', 'val' and 'test' to tuples
+  (img_files, labels), where labels is None for a test set without labels.
+  """
+  files = {}
+
+  # To figure out the filenames of the training images we need to open the
+  # boxes files
+  img_files, labels = [], []
+  for wnid in wnids:
     boxes_file = os.path.join(path, 'train', wnid, '%s_boxes.txt' % wnid)
     with open(boxes_file, 'r') as f:
       filenames = [x.split('\t')[0] for x in f]
-    num_images = len(filenames)
-    
-    X_train_block = np.zeros((num_images, 3, 64, 64), dtype=dtype)
-    y_train_block = wnid_to_label[wnid] * np.ones(num_images, dtype=np.int64)
-    for j, img_file in enumerate(filenames):
-      img_file = os.path.join(path, 'train', wnid, 'images', img_file)
-      img = imread(img_file)
-      if img.ndim == 2:
-        ## grayscale file
-        img.shape = (64, 64, 1)
-      X_train_block[j] = img.transpose(2, 0, 1)
-    X_train.append(X_train_block)
-    y_train.append(y_train_block)
-      
-  # We need to concatenate all training data
-  X_train = np.concatenate(X_train, axis=0)
-  y_train = np.concatenate(y_train, axis=0)
-  
-  # Next load validation data
+    img_files.extend(os.path.join(path, 'train', wnid, 'images', img_file)
+                     for img_file in filenames)
+    labels.extend([wnid_to_label[wnid]] * len(filenames))
+  files['train'] = (img_files, np.array(labels, dtype=np.int64))
+
   with open(os.path.join(path, 'val', 'val_annotations.txt'), 'r') as f:
-    img_files = []
-    val_wnids = []
+    img_files, labels = [], []
     for line in f:
       img_file, wnid = line.split('\t')[:2]
-      img_files.append(img_file)
-      val_wnids.append(wnid)
-    num_val = len(img_files)
-    y_val = np.array([wnid_to_label[wnid] for wnid in val_wnids])
-    X_val = np.zeros((num_val, 3, 64, 64), dtype=dtype)
-    for i, img_file in enumerate(img_files):
-      img_file = os.path.join(path, 'val', 'images', img_file)
-      img = imread(img_file)
-      if img.ndim == 2:
-        img.shape = (64, 64, 1)
-      X_val[i] = img.transpose(2, 0, 1)
-
-  # Next load test images
+      img_files.append(os.path.join(path, 'val', 'images', img_file))
+      labels.append(wnid_to_label[wnid])
+  files['val'] = (img_files, np.array(labels))
+
   # Students won't have test labels, so we need to iterate over files in the
   # images directory.
-  img_files = os.listdir(os.path.join(path, 'test', 'images'))
-  X_test = np.zeros((len(img_files), 3, 64, 64), dtype=dtype)
-  for i, img_file in enumerate(img_files):
-    img_file = os.path.join(path, 'test', 'images', img_file)
-    img = imread(img_file)
-    if img.ndim == 2:
-      img.shape = (64, 64, 1)
-    X_test[i] = img.transpose(2, 0, 1)
-
+  test_files = os.listdir(os.path.join(path, 'test', 'images'))
+  img_files = [os.path.join(path, 'test', 'images', img_file)
+               for img_file in test_files]
   y_test = None
   y_test_file = os.path.join(path, 'test', 'test_annotations.txt')
   if os.path.isfile(y_test_file):
@@ -174,46 +295,448 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
       for line in f:
         line = line.split('\t')
         img_file_to_wnid[line[0]] = line[1]
-    y_test = [wnid_to_label[img_file_to_wnid[img_file]] for img_file in img_files]
+    y_test = [wnid_to_label[img_file_to_wnid[img_file]]
+              for img_file in test_files]
     y_test = np.array(y_test)
-  
-  mean_image = X_train.mean(axis=0)
-  if subtract_mean:
-    X_train -= mean_image[None]
-    X_val -= mean_image[None]
-    X_test -= mean_image[None]
+  files['test'] = (img_files, y_test)
+  return files
+
 
+def _tiny_imagenet_fingerprint(path, wnids):
+  """
+  Describe the TinyImageNet files cheaply enough to check on every load: the
+  size and modification time of the index files and image directories.
+  """
+  paths = [os.path.join(path, 'wnids.txt'),
+           os.path.join(path, 'val', 'val_annotations.txt'),
+           os.path.join(path, 'val', 'images'),
+           os.path.join(path, 'test', 'images')]
+  paths += [os.path.join(path, 'train', wnid, 'images') for wnid in wnids]
+  y_test_file = os.path.join(path, 'test', 'test_annotations.txt')
+  if os.path.isfile(y_test_file):
+    paths.append(y_test_file)
   return {
-    'class_names': class_names,
-    'X_train': X_train,
-    'y_train': y_train,
-    'X_val': X_val,
-    'y_val': y_val,
-    'X_test': X_test,
-    'y_test': y_test,
-    'class_names': class_names,
-    'mean_image': mean_image,
+    'version': ARRAY_CACHE_VERSION,
+    'sources': [[os.path.relpath(p, path), os.path.getsize(p),
+                 os.path.getmtime(p)] for p in paths],
   }
 
 
-def load_models(models_dir):
+_decode_state = None
+
+
+def _set_decode_state(img_files, X):
+  """
+  Set the images decoded by _decode_range and the array they are written
+  into, or clear them with (None, None).
+  """
+  global _decode_state
+  _decode_state = None if img_files is None else (img_files, X)
+
+
+def _init_decode_worker(img_files, out_file):
+  X = None
+  if out_file is not None:
+    X = np.load(out_file, mmap_mode='r+')
+  _set_decode_state(img_files, X)
+
+
+def _decode_range(args):
+  """
+  Decode images start:stop. They are written into the array of the decode
+  state if there is one; otherwise they are returned as a new array.
+  """
+  start, stop = args
+  img_files, X = _decode_state
+  out = X[start:stop] if X is not None else np.empty((stop - start, 3, 64, 64),
+                                                     dtype=np.uint8)
+  for i in xrange(start, stop):
+    img = imread(img_files[i])
+    if img.ndim == 2:
+      ## grayscale file
+      img.shape = (64, 64, 1)
+    out[i - start] = img.transpose(2, 0, 1)
+  if X is None:
+    return out
+
+
+def _decode_images(img_files, out_file=None, num_workers=1, chunk_size=256):
   """
-  Load saved models from disk. This will attempt to unpickle all files in a
-  directory; any files that give errors on unpickling (such as README.txt) will
-  be skipped.
+  Decode 64x64 images into a preallocated uint8 array of shape (N, 3, 64, 64).
+
+  Inputs:
+  - img_files: List of N image paths
+  - out_file: If not None, the array is a .npy file created at this path and
+    memory-mapped; otherwise it is in memory.
+  - num_workers: If greater than 1, decode chunks of images in a process pool
+    of this size. With out_file the workers write straight into the .npy
+    file; otherwise they send back each decoded chunk, which is copied into
+    the array. Neither depends on the workers being forked.
+  - chunk_size: Number of images decoded per pool task
+
+  Returns:
+  - X: uint8 array of shape (N, 3, 64, 64)
+  """
+  start_time = time.time()
+  shape = (len(img_files), 3, 64, 64)
+  if out_file is not None:
+    X = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.uint8,
+                                  shape=shape)
+    X.flush()
+  else:
+    X = np.zeros(shape, dtype=np.uint8)
+
+  chunks = [(i, min(i + chunk_size, shape[0]))
+            for i in xrange(0, shape[0], chunk_size)]
+  if num_workers > 1:
+    pool = Pool(num_workers, initializer=_init_decode_worker,
+                initargs=(img_files, out_file))
+    try:
+      for (start, stop), out in zip(chunks, pool.imap(_decode_range, chunks)):
+        if out is not None:
+          X[start:stop] = out
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    _set_decode_state(img_files, X)
+    try:
+      for chunk in chunks:
+        _decode_range(chunk)
+    finally:
+      # Don't keep the array alive through the module
+      _set_decode_state(None, None)
+
+  if out_file is not None:
+    X.flush()
+  print 'Decoded %d images in %.3f seconds' % (shape[0],
+                                              time.time() - start_time)
+  return X
+
+
+class LazyNormalizedImages(object):
+  """
+  A read-only store of uint8 images that are converted to a floating point
+  dtype, and have the mean image subtracted, only when they are indexed. It
+  can be used in place of a float image array when the images are only ever
+  used a minibatch at a time, and takes a quarter of the memory of float32.
+  """
+
+  def __init__(self, X, mean_image=None, dtype=np.float32):
+    """
+    Inputs:
+    - X: uint8 array of shape (N, ...) of images
+    - mean_image: Optional array of shape X.shape[1:] subtracted from every
+      image
+    - dtype: Floating point dtype of the returned images
+    """
+    self.X = X
+    self.mean_image = mean_image
+    self.dtype = np.dtype(dtype)
+    self.shape = X.shape
+
+
+  def __len__(self):
+    return self.shape[0]
+
+
+  def __getitem__(self, idx):
+    out = self.X[idx].astype(self.dtype)
+    if self.mean_image is not None:
+      out -= self.mean_image
+    return out
+
+
+  def __array__(self, dtype=None):
+    out = self[:]
+    return out if dtype is None else out.astype(dtype)
+
+
+def load_models(models_dir, lazy=False, max_bytes=None):
+  """
+  Load saved models from disk. Files are indexed by their first bytes, and
+  only files that look like pickles (and model directories written by
+  save_model) are unpickled; anything else (such as README.txt) is skipped,
+  as are pickles that give errors on unpickling.
 
   Inputs:
   - models_dir: String giving the path to a directory containing model files.
     Each model file is a pickled dictionary with a 'model' field.
+  - lazy: If True, return a ModelRegistry instead, which only reads a model
+    when it is first used.
+  - max_bytes: With lazy, the memory budget of the registry's cache of
+    loaded models.
 
   Returns:
   A dictionary mapping model file names to models.
   """
+  registry = ModelRegistry(models_dir, max_bytes=max_bytes)
+  if lazy:
+    return registry
   models = {}
-  for model_file in os.listdir(models_dir):
-    with open(os.path.join(models_dir, model_file), 'rb') as f:
-      try:
-        models[model_file] = pickle.load(f)['model']
-      except pickle.UnpicklingError:
-        continue
+  for name in registry:
+    try:
+      models[name] = registry.load(name)
+    except pickle.UnpicklingError:
+      continue
   return models
+
+
+def _scan_models(models_dir):
+  """
+  Build an index of the model files in a directory from their names and
+  first bytes, without unpickling anything.
+
+  Returns: A dictionary mapping names to dictionaries with the path, the
+  format ('pickle' or 'arrays', see save_model) and the size on disk.
+  """
+  index = {}
+  for name in sorted(os.listdir(models_dir)):
+    path = os.path.join(models_dir, name)
+    if os.path.isdir(path):
+      if not os.path.isfile(os.path.join(path, 'model.pkl')):
+        continue
+      size = sum(os.path.getsize(os.path.join(path, f))
+                 for f in os.listdir(path))
+      index[name] = {'path': path, 'format': 'arrays', 'size': size}
+      continue
+    with open(path, 'rb') as f:
+      header = f.read(2)
+    # A pickled dictionary starts with the protocol 2 marker, or with the
+    # MARK or EMPTY_DICT opcodes of protocols 0 and 1.
+    if header[:1] not in ('\x80', '(', '}'):
+      continue
+    index[name] = {'path': path, 'format': 'pickle',
+                   'size': os.path.getsize(path)}
+  return index
+
+
+def save_model(model, path, min_array_bytes=4096):
+  """
+  Save a model in a format whose arrays can be memory-mapped when loaded: a
+  directory holding the pickled dictionary {'model': model} as model.pkl,
+  with every numpy array of at least min_array_bytes stored separately as
+  array_<i>.npy instead of inside the pickle.
+
+  Models saved this way load with load_models and ModelRegistry, with their
+  large arrays as copy-on-write memory maps, so loading doesn't copy them;
+  pages are only read as they are used, and changes to the arrays are never
+  written back.
+  """
+  if not os.path.isdir(path):
+    os.makedirs(path)
+  arrays = []
+
+  def persistent_id(obj):
+    if isinstance(obj, np.ndarray) and obj.nbytes >= min_array_bytes:
+      name = 'array_%d.npy' % len(arrays)
+      np.save(os.path.join(path, name), obj)
+      arrays.append(name)
+      return name
+    return None
+
+  with open(os.path.join(path, 'model.pkl'), 'wb') as f:
+    pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump({'model': model})
+
+
+def _load_model_entry(entry):
+  """
+  Load one model of an index built by _scan_models.
+  """
+  if entry['format'] == 'pickle':
+    with open(entry['path'], 'rb') as f:
+      return pickle.load(f)['model']
+  path = entry['path']
+  with open(os.path.join(path, 'model.pkl'), 'rb') as f:
+    unpickler = pickle.Unpickler(f)
+    unpickler.persistent_load = lambda name: np.load(os.path.join(path, name),
+                                                     mmap_mode='c')
+    return unpickler.load()['model']
+
+
+def _model_bytes(obj, seen=None):
+  """
+  Count the bytes of the numpy arrays reachable from a model through its
+  attributes, dictionaries, lists and tuples. Memory-mapped arrays are
+  counted at their mapped size, since reading them brings them into memory.
+  """
+  if seen is None:
+    seen = set()
+  if id(obj) in seen:
+    return 0
+  seen.add(id(obj))
+  if isinstance(obj, np.ndarray):
+    return obj.nbytes
+  if isinstance(obj, dict):
+    return sum(_model_bytes(v, seen) for v in obj.itervalues())
+  if isinstance(obj, (list, tuple)):
+    return sum(_model_bytes(v, seen) for v in obj)
+  if hasattr(obj, '__dict__'):
+    return _model_bytes(obj.__dict__, seen)
+  return 0
+
+
+class ModelRegistry(object):
+  """
+  A read-only dictionary of the models in a directory that reads them only
+  when they are used.
+
+  Creating a registry only scans the file names and first bytes of the
+  directory (see _scan_models). Indexing it gives a LazyModel proxy, which
+  loads the model the first time one of its attributes is used. Loaded
+  models are kept in a cache, and when the arrays of the cached models
+  exceed max_bytes, the least recently used models are dropped from it.
+
+  A proxy keeps the model it loaded for as long as the proxy exists, and
+  while any proxy holds a model it is pinned: it is never dropped from the
+  cache, and every proxy of the same name gets the same model object. Changes
+  made through a proxy, including in-place changes to its arrays, are
+  therefore never lost while the proxy is alive. Pinned models count towards
+  max_bytes, but only unpinned models are dropped, so holding proxies to
+  more models than fit in the budget keeps them all in memory.
+
+  Example usage:
+
+  models = ModelRegistry('path/to/models', max_bytes=2 * 1024 ** 3)
+  print models.keys()
+  scores = models['checkpoint_10.pkl'].loss(X)
+  """
+
+  def __init__(self, models_dir, max_bytes=None):
+    """
+    Inputs:
+    - models_dir: Directory containing the model files
+    - max_bytes: Memory budget of the cache of loaded models; None for no
+      limit. The most recently used model is always kept.
+    """
+    self.models_dir = models_dir
+    self.max_bytes = max_bytes
+    self.index = _scan_models(models_dir)
+    self._cache = OrderedDict()
+    self._pins = {}
+    self.cached_bytes = 0
+
+
+  def load(self, name):
+    """
+    Return the model called name, loading it unless it is cached.
+    """
+    if name in self._cache:
+      entry = self._cache.pop(name)
+    else:
+      model = _load_model_entry(self.index[name])
+      entry = (model, _model_bytes(model))
+      self.cached_bytes += entry[1]
+    self._cache[name] = entry
+    self._evict(keep=name)
+    return entry[0]
+
+
+  def _evict(self, keep=None):
+    """
+    Drop the least recently used unpinned models until the cache fits in
+    max_bytes, never dropping the model called keep.
+    """
+    if self.max_bytes is None:
+      return
+    for name in list(self._cache):
+      if self.cached_bytes <= self.max_bytes:
+        break
+      if name == keep or self._pins.get(name):
+        continue
+      _, nbytes = self._cache.pop(name)
+      self.cached_bytes -= nbytes
+
+
+  def _pin(self, name):
+    """
+    Load the model called name for a proxy and pin it.
+    """
+    model = self.load(name)
+    self._pins[name] = self._pins.get(name, 0) + 1
+    return model
+
+
+  def _unpin(self, name):
+    self._pins[name] -= 1
+    if not self._pins[name]:
+      del self._pins[name]
+      self._evict()
+
+
+  def __getitem__(self, name):
+    if name not in self.index:
+      raise KeyError(name)
+    return LazyModel(self, name)
+
+
+  def __contains__(self, name):
+    return name in self.index
+
+
+  def __iter__(self):
+    return iter(sorted(self.index))
+
+
+  def __len__(self):
+    return len(self.index)
+
+
+  def keys(self):
+    return sorted(self.index)
+
+
+  def iteritems(self):
+    for name in self:
+      yield name, self[name]
+
+
+  def items(self):
+    return list(self.iteritems())
+
+
+class LazyModel(object):
+  """
+  A proxy for one model of a ModelRegistry. Getting or setting any attribute
+  of the proxy loads the model through the registry and forwards to it. The
+  proxy keeps its model, which the registry does not drop while the proxy
+  exists. The proxy's own names all start with an underscore, so that they
+  don't hide attributes of the model; use registry.load(name) to get the
+  model itself.
+  """
+
+  def __init__(self, registry, name):
+    self.__dict__['_registry'] = registry
+    self.__dict__['_name'] = name
+    self.__dict__['_model'] = None
+
+
+  def _load_model(self):
+    """
+    Return the model itself.
+    """
+    if self._model is None:
+      self.__dict__['_model'] = self._registry._pin(self._name)
+    else:
+      # Mark the model as recently used
+      self._registry.load(self._name)
+    return self._model
+
+
+  def __del__(self):
+    if self.__dict__.get('_model') is not None:
+      self._registry._unpin(self._name)
+
+
+  def __getattr__(self, attr):
+    return getattr(self._load_model(), attr)
+
+
+  def __setattr__(self, attr, value):
+    setattr(self._load_model(), attr, value)
+
+
+  def __repr__(self):
+    return '<LazyModel %s>' % self._name
@@ -10,10 +10,11 @@ except ImportError:
 from cs231n.im2col import *
 
 
-def conv_forward_im2col(x, w, b, conv_param):
+def conv_forward_im2col(x, w, b, conv_param, need_param_grads=True):
   """
   A fast implementation of the forward pass for a convolutional layer
-  based on im2col and col2im.
+  based on im2col and col2im. If need_param_grads is False, the im2col
+  matrix, which is only needed for dw, is not kept in the cache.
   """
   N, C, H, W = x.shape
   num_filters, _, filter_height, filter_width = w.shape
@@ -35,11 +36,13 @@ def conv_forward_im2col(x, w, b, conv_param):
   out = res.reshape(w.shape[0], out.shape[2], out.shape[3], x.shape[0])
   out = out.transpose(3, 0, 1, 2)
 
+  if not need_param_grads:
+    x_cols = None
   cache = (x, w, b, conv_param, x_cols)
   return out, cache
 
 
-def conv_forward_strides(x, w, b, conv_param):
+def conv_forward_strides(x, w, b, conv_param, need_param_grads=True):
   N, C, H, W = x.shape
   F, _, HH, WW = w.shape
   stride, pad = conv_param['stride'], conv_param['pad']
@@ -79,11 +82,14 @@ def conv_forward_strides(x, w, b, conv_param):
   # comparison we won't either
   out = np.ascontiguousarray(out)
 
+  # The im2col matrix is only needed for dw
+  if not need_param_grads:
+    x_cols = None
   cache = (x, w, b, conv_param, x_cols)
   return out, cache
   
 
-def conv_backward_strides(dout, cache):
+def conv_backward_strides(dout, cache, need_param_grads=True):
   x, w, b, conv_param, x_cols = cache
   stride, pad = conv_param['stride'], conv_param['pad']
 
@@ -91,10 +97,12 @@ def conv_backward_strides(dout, cache):
   F, _, HH, WW = w.shape
   _, _, out_h, out_w = dout.shape
 
-  db = np.sum(dout, axis=(0, 2, 3))
-
+  # Without parameter gradients we skip db and the dw matrix multiply
+  dw, db = None, None
   dout_reshaped = dout.transpose(1, 0, 2, 3).reshape(F, -1)
-  dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
+  if need_param_grads:
+    db = np.sum(dout, axis=(0, 2, 3))
+    dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
 
   dx_cols = w.reshape(F, -1).T.dot(dout_reshaped)
   dx_cols.shape = (C, HH, WW, N, out_h, out_w)
@@ -103,19 +111,21 @@ def conv_backward_strides(dout, cache):
   return dx, dw, db
 
 
-def conv_backward_im2col(dout, cache):
+def conv_backward_im2col(dout, cache, need_param_grads=True):
   """
   A fast implementation of the backward pass for a convolutional layer
-  based on im2col and col2im.
+  based on im2col and col2im. If need_param_grads is False, dw and db are
+  not computed and are returned as None.
   """
   x, w, b, conv_param, x_cols = cache
   stride, pad = conv_param['stride'], conv_param['pad']
 
-  db = np.sum(dout, axis=(0, 2, 3))
-
+  dw, db = None, None
   num_filters, _, filter_height, filter_width = w.shape
   dout_reshaped = dout.transpose(1, 2, 3, 0).reshape(num_filters, -1)
-  dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
+  if need_param_grads:
+    db = np.sum(dout, axis=(0, 2, 3))
+    dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
 
   dx_cols = w.reshape(num_filters, -1).T.dot(dout_reshaped)
   # dx = col2im_indices(dx_cols, x.shape, filter_height, filter_width, pad, stride)
@@ -125,6 +135,105 @@ def conv_backward_im2col(dout, cache):
   return dx, dw, db
 
 
+def conv_forward_nhwc(x, w, b, conv_param, need_param_grads=True):
+  """
+  A fast implementation of the forward pass for a convolutional layer on
+  channels-last data, in the manner of conv_forward_strides.
+
+  The im2col matrix has one row per output position, so the matrix multiply
+  produces the output directly in (N, H', W', F) order and no transpose of
+  the activations is needed. Its columns are in (HH, WW, C) order, so that
+  im2col copies runs of C contiguous values; only the much smaller weights
+  are reordered to match.
+
+  Inputs:
+  - x: Input data of shape (N, H, W, C)
+  - w: Filter weights of shape (F, C, HH, WW)
+  - b: Biases, of shape (F,)
+  - conv_param: Dictionary with the keys 'stride' and 'pad'
+  - need_param_grads: If False, the im2col matrix, which is only needed for
+    dw, is not kept in the cache, and x_cols in the cache is None.
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, H', W', F)
+  - cache: (x, w, b, conv_param, x_cols)
+  """
+  N, H, W, C = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+
+  p = pad
+  x_padded = np.pad(x, ((0, 0), (p, p), (p, p), (0, 0)), mode='constant')
+  H += 2 * pad
+  W += 2 * pad
+  out_h = (H - HH) / stride + 1
+  out_w = (W - WW) / stride + 1
+
+  shape = (N, out_h, out_w, HH, WW, C)
+  strides = (H * W * C, stride * W * C, stride * C, W * C, C, 1)
+  strides = x.itemsize * np.array(strides)
+  x_stride = np.lib.stride_tricks.as_strided(x_padded,
+                shape=shape, strides=strides)
+  x_cols = np.ascontiguousarray(x_stride)
+  x_cols.shape = (N * out_h * out_w, HH * WW * C)
+
+  w_rows = w.transpose(0, 2, 3, 1).reshape(F, -1)
+  res = x_cols.dot(w_rows.T)
+  res += b
+  out = res.reshape(N, out_h, out_w, F)
+
+  if not need_param_grads:
+    x_cols = None
+  cache = (x, w, b, conv_param, x_cols)
+  return out, cache
+
+
+def conv_backward_nhwc(dout, cache, need_param_grads=True):
+  """
+  A fast implementation of the backward pass for a convolutional layer on
+  channels-last data. If need_param_grads is False, dw and db are not
+  computed and are returned as None.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, H', W', F)
+  - cache: Cache from conv_forward_nhwc
+
+  Returns a tuple of:
+  - dx: Gradient with respect to x, of shape (N, H, W, C)
+  - dw: Gradient with respect to w, of shape (F, C, HH, WW)
+  - db: Gradient with respect to b, of shape (F,)
+  """
+  x, w, b, conv_param, x_cols = cache
+  stride, pad = conv_param['stride'], conv_param['pad']
+
+  N, H, W, C = x.shape
+  F, _, HH, WW = w.shape
+  _, out_h, out_w, _ = dout.shape
+
+  dw, db = None, None
+  dout_reshaped = dout.reshape(-1, F)
+  if need_param_grads:
+    db = np.sum(dout_reshaped, axis=0)
+    dw = dout_reshaped.T.dot(x_cols).reshape(F, HH, WW, C)
+    dw = np.ascontiguousarray(dw.transpose(0, 3, 1, 2))
+
+  w_rows = w.transpose(0, 2, 3, 1).reshape(F, -1)
+  dx_cols = dout_reshaped.dot(w_rows)
+  dx_cols.shape = (N, out_h, out_w, HH, WW, C)
+
+  # Scatter the columns back one filter position at a time
+  dx_padded = np.zeros((N, H + 2 * pad, W + 2 * pad, C), dtype=dx_cols.dtype)
+  for i in xrange(HH):
+    for j in xrange(WW):
+      dx_padded[:, i:i + stride * out_h:stride, j:j + stride * out_w:stride] += (
+          dx_cols[:, :, :, i, j])
+  dx = dx_padded[:, pad:pad + H, pad:pad + W]
+  if pad:
+    dx = np.ascontiguousarray(dx)
+
+  return dx, dw, db
+
+
 conv_forward_fast = conv_forward_strides
 conv_backward_fast = conv_backward_strides
 
@@ -0,0 +1,292 @@
+"""
+A pipeline that turns a collection of image files into a feature file, like
+the *_vgg16_fc7.h5 files read by load_coco_data, using a PretrainedCNN.
+
+The pipeline has three stages connected by bounded queues:
+
+- read: worker processes decode, resize and preprocess batches of images
+  with preprocess_image;
+- forward: the model runs each batch forward in the main process;
+- write: a thread appends the features of each batch to the output file.
+
+The number of rows already written is recorded in the output file after
+every flush, so an interrupted extraction picks up where it stopped when run
+again with the same arguments.
+
+Example usage:
+
+model = PretrainedCNN(h5_file='cs231n/datasets/pretrained_model.h5')
+stats = extract_dataset_features(model, img_files, 'train_features.h5',
+                                 data['mean_image'], num_workers=4)
+"""
+
+import os, json, time, threading, Queue
+from collections import deque
+from multiprocessing import Pool
+
+import numpy as np
+import h5py
+from scipy.misc import imread, imresize
+
+from cs231n.image_utils import preprocess_image
+
+
+_reader_state = None
+
+
+def _init_reader(img_files, mean_img, mean, size):
+  global _reader_state
+  _reader_state = (img_files, mean_img, mean, size)
+
+
+def _read_batch(args):
+  """
+  Decode and preprocess the images of one batch in a worker process.
+
+  Returns a tuple of the batch of shape (B, 3, size, size) and the seconds
+  spent making it.
+  """
+  start, stop = args
+  t0 = time.time()
+  img_files, mean_img, mean, size = _reader_state
+  X = np.empty((stop - start, 3, size, size), dtype=np.float32)
+  for i in xrange(start, stop):
+    img = imread(img_files[i])
+    if img.ndim == 2:
+      img = np.repeat(img[:, :, None], 3, axis=2)
+    if img.shape[:2] != (size, size):
+      img = imresize(img, (size, size))
+    X[i - start] = preprocess_image(img[:, :, :3], mean_img, mean)[0]
+  return X, time.time() - t0
+
+
+class _FeatureWriter(object):
+  """
+  Appends rows of features to an .h5 or .npy file and records how many rows
+  have been written: as the num_rows attribute of the HDF5 dataset, or in a
+  <file>.progress.json file next to the .npy file, which is kept once the
+  file is complete so that running again does nothing.
+  """
+
+  def __init__(self, out_file, num_rows, dim, dtype, chunk_rows):
+    self.out_file = out_file
+    self.h5 = out_file.endswith('.h5')
+    shape = (num_rows, dim)
+    if self.h5:
+      self.f = h5py.File(out_file, 'a')
+      if 'features' not in self.f:
+        # HDF5 can't chunk an empty dataset
+        chunks = (min(chunk_rows, num_rows), dim) if num_rows else None
+        self.f.create_dataset('features', shape=shape, dtype=dtype,
+                              chunks=chunks)
+        self.f['features'].attrs['num_rows'] = 0
+      self.dset = self.f['features']
+      self.rows = int(self.dset.attrs['num_rows'])
+    else:
+      self.progress_file = out_file + '.progress.json'
+      self.rows = 0
+      if os.path.isfile(out_file) and os.path.isfile(self.progress_file):
+        self.dset = np.load(out_file, mmap_mode='r+')
+        with open(self.progress_file, 'r') as f:
+          self.rows = json.load(f)['num_rows']
+      else:
+        self.dset = np.lib.format.open_memmap(out_file, mode='w+',
+                                              dtype=dtype, shape=shape)
+        self._record()
+    if self.dset.shape != shape:
+      raise ValueError('%s has shape %s but %s was expected' %
+                       (out_file, self.dset.shape, shape))
+
+
+  def _record(self):
+    if self.h5:
+      self.f.flush()
+      self.dset.attrs['num_rows'] = self.rows
+      self.f.flush()
+    else:
+      self.dset.flush()
+      tmp_file = self.progress_file + '.tmp'
+      with open(tmp_file, 'w') as f:
+        json.dump({'num_rows': self.rows}, f)
+      os.rename(tmp_file, self.progress_file)
+
+
+  def append(self, features):
+    self.dset[self.rows:self.rows + features.shape[0]] = features
+    self.rows += features.shape[0]
+    self._record()
+
+
+  def close(self):
+    if self.h5:
+      self.f.close()
+    else:
+      del self.dset
+
+
+def _written_rows(out_file):
+  """
+  Read how many rows an existing output records as written, without opening
+  it for writing. Returns a tuple of that number and the number of rows of
+  the output, or (0, None) if there is no output yet.
+  """
+  if out_file.endswith('.h5'):
+    if not os.path.isfile(out_file):
+      return 0, None
+    with h5py.File(out_file, 'r') as f:
+      if 'features' not in f:
+        return 0, None
+      return int(f['features'].attrs['num_rows']), f['features'].shape[0]
+  progress_file = out_file + '.progress.json'
+  if not (os.path.isfile(out_file) and os.path.isfile(progress_file)):
+    return 0, None
+  with open(progress_file, 'r') as f:
+    rows = json.load(f)['num_rows']
+  return rows, np.load(out_file, mmap_mode='r').shape[0]
+
+
+def extract_dataset_features(model, img_files, out_file, mean_img, layer=None,
+                             mean='image', batch_size=100, num_workers=2,
+                             queue_size=4, fused=True, verbose=True):
+  """
+  Extract the features of one layer of a PretrainedCNN for a list of images
+  and write them to a file.
+
+  Inputs:
+  - model: A PretrainedCNN
+  - img_files: List of N image paths. Images are resized to the input size of
+    the model if needed.
+  - out_file: Path of the output; a file ending in .h5 gets a 'features'
+    dataset of shape (N, D), chunked by batch, and any other file is a .npy
+    array of shape (N, D). If a partial output of an interrupted run exists,
+    extraction resumes after its last written row.
+  - mean_img: Mean image passed to preprocess_image
+  - layer: Index of the layer whose activations are the features, as in
+    model.forward; default is the fully-connected hidden layer. Activations
+    of conv layers are flattened.
+  - mean: Passed to preprocess_image
+  - batch_size: Number of images per batch
+  - num_workers: Number of reader processes
+  - queue_size: Maximum number of batches waiting between two stages
+  - fused: Whether to run the model with batchnorm folded into its weights
+  - verbose: Whether to print the throughput of each stage at the end
+
+  Returns:
+  - stats: Dictionary with the number of images processed ('images') and,
+    for each of the 'read', 'forward' and 'write' stages, its throughput in
+    images per second of busy time; read time is summed over the workers
+    and divided by their number. 'wait' is the seconds the forward stage
+    spent waiting for the readers, and 'total' the images per second of the
+    whole run.
+  """
+  if layer is None:
+    layer = len(model.conv_params)
+  N = len(img_files)
+  size = model.input_size
+  start_time = time.time()
+
+  # A complete output needs neither the readers nor the model
+  rows, total = _written_rows(out_file)
+  if rows == N and total == N:
+    if verbose:
+      print 'Extracted 0 images (%d already done)' % N
+    return {'images': 0, 'read': 0.0, 'forward': 0.0, 'write': 0.0,
+            'wait': 0.0, 'total': 0.0}
+
+  writer = write_thread = None
+  write_queue = Queue.Queue(maxsize=queue_size)
+  write_time = [0.0]
+  errors = []
+
+  def write_loop():
+    # After an error keep draining the queue so the forward stage never
+    # blocks on it; the error is raised in the main thread.
+    while True:
+      features = write_queue.get()
+      if features is None:
+        return
+      if errors:
+        continue
+      t0 = time.time()
+      try:
+        writer.append(features)
+      except Exception as e:
+        errors.append(e)
+      write_time[0] += time.time() - t0
+
+  # Fork the readers before the output file is opened and the writer thread
+  # is started, so that the workers inherit neither
+  pool = Pool(num_workers, initializer=_init_reader,
+              initargs=(img_files, mean_img, mean, size))
+  read_time = forward_time = wait_time = 0.0
+  try:
+    # Run one input forward to find the size of the features
+    probe = np.zeros((1, 3, size, size), dtype=np.float32)
+    probe, _ = model.forward(probe, end=layer, fused=fused, keep_cache=False)
+    dim = int(np.prod(probe.shape[1:]))
+    writer = _FeatureWriter(out_file, N, dim, probe.dtype, batch_size)
+    first = writer.rows
+    batches = [(i, min(i + batch_size, N))
+               for i in xrange(first, N, batch_size)]
+
+    write_thread = threading.Thread(target=write_loop)
+    write_thread.daemon = True
+    write_thread.start()
+
+    # At most queue_size batches are being read or waiting to be run forward
+    pending = deque()
+    for b in batches:
+      pending.append(pool.apply_async(_read_batch, (b,)))
+      if len(pending) < queue_size:
+        continue
+      read_time, forward_time, wait_time = _forward_batch(model, pending,
+          write_queue, errors, layer, fused, read_time, forward_time,
+          wait_time)
+    while pending:
+      read_time, forward_time, wait_time = _forward_batch(model, pending,
+          write_queue, errors, layer, fused, read_time, forward_time,
+          wait_time)
+  finally:
+    pool.terminate()
+    pool.join()
+    if write_thread is not None:
+      write_queue.put(None)
+      write_thread.join()
+    if writer is not None:
+      writer.close()
+    if errors:
+      raise errors[0]
+
+  num_images = N - first
+  stats = {
+    'images': num_images,
+    'read': num_images * num_workers / max(read_time, 1e-9),
+    'forward': num_images / max(forward_time, 1e-9),
+    'write': num_images / max(write_time[0], 1e-9),
+    'wait': wait_time,
+    'total': num_images / (time.time() - start_time),
+  }
+  if verbose:
+    print ('Extracted %d images (%d already done): read %.1f, forward %.1f, '
+           'write %.1f, total %.1f images/sec; waited %.2f seconds for '
+           'reads') % (num_images, first, stats['read'], stats['forward'],
+                       stats['write'], stats['total'], wait_time)
+  return stats
+
+
+def _forward_batch(model, pending, write_queue, errors, layer, fused,
+                   read_time, forward_time, wait_time):
+  """
+  Take the oldest batch from the readers, run it forward and queue its
+  features for writing. Returns the updated stage times.
+  """
+  t0 = time.time()
+  X, t_read = pending.popleft().get()
+  t1 = time.time()
+  features, _ = model.forward(X, end=layer, fused=fused, keep_cache=False)
+  features = features.reshape(X.shape[0], -1)
+  t2 = time.time()
+  if errors:
+    raise errors[0]
+  write_queue.put(features)
+  return read_time + t_read, forward_time + t2 - t1, wait_time + t1 - t0
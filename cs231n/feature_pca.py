@@ -0,0 +1,169 @@
+"""
+Produce PCA-reduced image features from the raw VGG-16 fc7 features without
+ever loading the full feature matrix.
+
+The projection is fit in one streaming pass over the training features, by
+accumulating the sum and the Gram matrix X^T X chunk by chunk; this gives the
+exact covariance of the full matrix, so the result is the same as ordinary
+PCA. Projecting is then a blocked matrix multiply, one chunk at a time, which
+can be spread over a process pool.
+
+The usual workflow is:
+
+make_pca_features('cs231n/datasets/coco_captioning', dim=256)
+data = load_coco_data(pca_features=256)
+"""
+
+import os
+import numpy as np
+import h5py
+from multiprocessing import Pool
+
+
+def fit_incremental_pca(feature_file, chunk_rows=4096):
+  """
+  Fit PCA to the features of an HDF5 file, reading them in chunks.
+
+  Inputs:
+  - feature_file: Path of an HDF5 file with a 'features' dataset of shape
+    (N, D).
+  - chunk_rows: Number of rows read at a time; memory use is about
+    chunk_rows * D + D * D floats.
+
+  Returns a dictionary with:
+  - mean: Array of shape (D,) giving the mean feature
+  - components: Array of shape (D, D) whose columns are the principal
+    directions, sorted by decreasing variance
+  - explained_variance: Array of shape (D,) giving the variance along each
+    principal direction
+  """
+  with h5py.File(feature_file, 'r') as f:
+    dset = f['features']
+    N, D = dset.shape
+    # Accumulate about the mean of the first chunk rather than about zero, so
+    # that subtracting the mean at the end doesn't lose precision.
+    shift = None
+    total = np.zeros(D)
+    gram = np.zeros((D, D))
+    for start in xrange(0, N, chunk_rows):
+      X = np.asarray(dset[start:start + chunk_rows], dtype=np.float64)
+      if shift is None:
+        shift = X.mean(axis=0)
+      X -= shift
+      total += X.sum(axis=0)
+      gram += X.T.dot(X)
+
+  mu = total / N
+  cov = (gram - N * np.outer(mu, mu)) / max(N - 1, 1)
+  variance, components = np.linalg.eigh(cov)
+  order = np.argsort(variance)[::-1]
+  return {
+    'mean': (mu + shift).astype(np.float32),
+    'components': components[:, order].astype(np.float32),
+    'explained_variance': np.maximum(variance[order], 0),
+  }
+
+
+def _project_chunk(X, mean, W):
+  """
+  Project one chunk of features onto the columns of W.
+  """
+  return (X - mean).dot(W).astype(np.float32)
+
+
+_worker_state = None
+
+
+def _init_worker(in_file, mean, W):
+  global _worker_state
+  _worker_state = (h5py.File(in_file, 'r')['features'], mean, W)
+
+
+def _worker_project(args):
+  start, stop = args
+  dset, mean, W = _worker_state
+  return _project_chunk(np.asarray(dset[start:stop], dtype=np.float32),
+                        mean, W)
+
+
+def project_features(in_file, out_file, pca, dim, chunk_rows=4096,
+                     num_workers=1):
+  """
+  Project the features of an HDF5 file onto the top principal directions and
+  write them to a new HDF5 file, one chunk at a time.
+
+  Inputs:
+  - in_file: Path of an HDF5 file with a 'features' dataset of shape (N, D)
+  - out_file: Path of the HDF5 file to write; its 'features' dataset has
+    shape (N, dim).
+  - pca: Dictionary returned by fit_incremental_pca
+  - dim: Number of principal directions to keep
+  - chunk_rows: Number of rows projected at a time
+  - num_workers: If greater than 1, project chunks in a process pool of this
+    size; each worker reads its own chunks, and chunks are written in order.
+  """
+  mean = pca['mean']
+  W = np.ascontiguousarray(pca['components'][:, :dim])
+  with h5py.File(in_file, 'r') as f:
+    N = f['features'].shape[0]
+  chunks = [(start, min(start + chunk_rows, N))
+            for start in xrange(0, N, chunk_rows)]
+
+  # Start the workers before opening the output file, so that they are not
+  # forked with an open HDF5 file.
+  pool = None
+  if num_workers > 1:
+    pool = Pool(num_workers, initializer=_init_worker,
+                initargs=(in_file, mean, W))
+  try:
+    with h5py.File(out_file, 'w') as f:
+      out = f.create_dataset('features', shape=(N, dim), dtype=np.float32)
+      if pool is None:
+        with h5py.File(in_file, 'r') as fin:
+          dset = fin['features']
+          for start, stop in chunks:
+            X = np.asarray(dset[start:stop], dtype=np.float32)
+            out[start:stop] = _project_chunk(X, mean, W)
+      else:
+        for (start, stop), Y in zip(chunks, pool.imap(_worker_project, chunks)):
+          out[start:stop] = Y
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+
+def make_pca_features(base_dir='cs231n/datasets/coco_captioning', dim=512,
+                      chunk_rows=4096, num_workers=1):
+  """
+  Fit PCA to the raw train fc7 features of the COCO captioning data and write
+  the reduced train and val features next to them, as
+  train2014_vgg16_fc7_pca<dim>.h5 and val2014_vgg16_fc7_pca<dim>.h5, which
+  load_coco_data reads when passed pca_features=dim. The fitted projection is
+  saved as vgg16_fc7_pca.npz and reused on later calls, so producing other
+  dimensions only costs the projection.
+
+  Inputs:
+  - base_dir: Directory containing the COCO captioning files
+  - dim: Number of dimensions of the reduced features
+  - chunk_rows, num_workers: Passed to project_features
+
+  Returns:
+  - pca: Dictionary returned by fit_incremental_pca
+  """
+  pca_file = os.path.join(base_dir, 'vgg16_fc7_pca.npz')
+  train_file = os.path.join(base_dir, 'train2014_vgg16_fc7.h5')
+  if (os.path.isfile(pca_file) and
+      os.path.getmtime(pca_file) >= os.path.getmtime(train_file)):
+    with np.load(pca_file) as f:
+      pca = dict(f)
+  else:
+    pca = fit_incremental_pca(train_file, chunk_rows=chunk_rows)
+    np.savez(pca_file, **pca)
+
+  for split in ['train', 'val']:
+    in_file = os.path.join(base_dir, '%s2014_vgg16_fc7.h5' % split)
+    out_file = os.path.join(base_dir, '%s2014_vgg16_fc7_pca%d.h5' % (split, dim))
+    project_features(in_file, out_file, pca, dim, chunk_rows=chunk_rows,
+                     num_workers=num_workers)
+  return pca
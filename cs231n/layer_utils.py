@@ -30,7 +30,8 @@ def affine_relu_backward(dout, cache):
   return dx, dw, db
 
 
-def affine_bn_relu_forward(x, w, b, gamma, beta, bn_param):
+def affine_bn_relu_forward(x, w, b, gamma, beta, bn_param,
+                           need_param_grads=True):
   """
   Convenience layer that performs an affine transform, batch normalization,
   and ReLU.
@@ -42,26 +43,32 @@ def affine_bn_relu_forward(x, w, b, gamma, beta, bn_param):
   - gamma, beta: Arrays of shape (D2,) and (D2,) giving scale and shift
     parameters for batch normalization.
   - bn_param: Dictionary of parameters for batch normalization.
+  - need_param_grads: If False, keep only what the backward pass needs for
+    dx.
 
   Returns:
   - out: Output from ReLU, of shape (N, D2)
   - cache: Object to give to the backward pass.
   """
   a, fc_cache = affine_forward(x, w, b)
-  a_bn, bn_cache = batchnorm_forward(a, gamma, beta, bn_param)
+  a_bn, bn_cache = batchnorm_forward(a, gamma, beta, bn_param,
+                                     need_param_grads=need_param_grads)
   out, relu_cache = relu_forward(a_bn)
   cache = (fc_cache, bn_cache, relu_cache)
   return out, cache
 
 
-def affine_bn_relu_backward(dout, cache):
+def affine_bn_relu_backward(dout, cache, need_param_grads=True):
   """
-  Backward pass for the affine-batchnorm-relu convenience layer.
+  Backward pass for the affine-batchnorm-relu convenience layer. If
+  need_param_grads is False, only dx is computed.
   """
   fc_cache, bn_cache, relu_cache = cache
   da_bn = relu_backward(dout, relu_cache)
-  da, dgamma, dbeta = batchnorm_backward(da_bn, bn_cache)
-  dx, dw, db = affine_backward(da, fc_cache)
+  da, dgamma, dbeta = batchnorm_backward(da_bn, bn_cache,
+                                         need_param_grads=need_param_grads)
+  dx, dw, db = affine_backward(da, fc_cache,
+                               need_param_grads=need_param_grads)
   return dx, dw, db, dgamma, dbeta  
 
 
@@ -93,19 +100,35 @@ def conv_relu_backward(dout, cache):
   return dx, dw, db
 
 
-def conv_bn_relu_forward(x, w, b, gamma, beta, conv_param, bn_param):
-  a, conv_cache = conv_forward_fast(x, w, b, conv_param)
-  an, bn_cache = spatial_batchnorm_forward(a, gamma, beta, bn_param)
+def conv_bn_relu_forward(x, w, b, gamma, beta, conv_param, bn_param,
+                         channels_last=False, need_param_grads=True):
+  if channels_last:
+    a, conv_cache = conv_forward_nhwc(x, w, b, conv_param,
+                                      need_param_grads=need_param_grads)
+  else:
+    a, conv_cache = conv_forward_fast(x, w, b, conv_param,
+                                      need_param_grads=need_param_grads)
+  an, bn_cache = spatial_batchnorm_forward(a, gamma, beta, bn_param,
+                                           channels_last=channels_last,
+                                           need_param_grads=need_param_grads)
   out, relu_cache = relu_forward(an)
   cache = (conv_cache, bn_cache, relu_cache)
   return out, cache
 
 
-def conv_bn_relu_backward(dout, cache):
+def conv_bn_relu_backward(dout, cache, channels_last=False,
+                          need_param_grads=True):
   conv_cache, bn_cache, relu_cache = cache
   dan = relu_backward(dout, relu_cache)
-  da, dgamma, dbeta = spatial_batchnorm_backward(dan, bn_cache)
-  dx, dw, db = conv_backward_fast(da, conv_cache)
+  da, dgamma, dbeta = spatial_batchnorm_backward(
+      dan, bn_cache, channels_last=channels_last,
+      need_param_grads=need_param_grads)
+  if channels_last:
+    dx, dw, db = conv_backward_nhwc(da, conv_cache,
+                                    need_param_grads=need_param_grads)
+  else:
+    dx, dw, db = conv_backward_fast(da, conv_cache,
+                                    need_param_grads=need_param_grads)
   return dx, dw, db, dgamma, dbeta
 
 
@@ -139,3 +162,56 @@ def conv_relu_pool_backward(dout, cache):
   dx, dw, db = conv_backward_fast(da, conv_cache)
   return dx, dw, db
 
+
+
+def fold_batchnorm(w, b, gamma, beta, bn_param):
+  """
+  Fold test-time batch normalization into the preceding affine or
+  convolutional layer, so that layer(x, w_fold, b_fold) gives the same result
+  as batchnorm(layer(x, w, b)) with the running averages of bn_param.
+
+  Inputs:
+  - w, b: Weights and bias of the layer; w has shape (D1, D2) for an affine
+    layer or (F, C, HH, WW) for a convolutional layer.
+  - gamma, beta: Batchnorm scale and shift, of shape (D2,) or (F,)
+  - bn_param: Dictionary of batchnorm parameters with running averages; as
+    in batchnorm_forward, missing running averages are taken to be zero.
+
+  Returns a tuple of:
+  - w_fold, b_fold: Folded weights and bias, of the dtype of w
+  """
+  eps = bn_param.get('eps', 1e-5)
+  D = gamma.shape[0]
+  running_mean = bn_param.get('running_mean', np.zeros(D, dtype=w.dtype))
+  running_var = bn_param.get('running_var', np.zeros(D, dtype=w.dtype))
+  scale = gamma / np.sqrt(running_var + eps)
+  if w.ndim == 4:
+    w_fold = w * scale[:, None, None, None]
+  else:
+    w_fold = w * scale
+  b_fold = (b - running_mean) * scale + beta
+  return w_fold.astype(w.dtype), b_fold.astype(w.dtype)
+
+
+def affine_relu_inference_forward(x, w, b):
+  """
+  Test-time affine-relu layer that keeps no cache and applies the ReLU in
+  place; with weights from fold_batchnorm it computes affine-batchnorm-relu.
+  """
+  out, _ = affine_forward(x, w, b)
+  np.maximum(out, 0, out=out)
+  return out
+
+
+def conv_relu_inference_forward(x, w, b, conv_param, channels_last=False):
+  """
+  Test-time conv-relu layer that keeps no cache and applies the ReLU in
+  place; with weights from fold_batchnorm it computes conv-batchnorm-relu.
+  If channels_last is True, x and out have shape (N, H, W, C).
+  """
+  if channels_last:
+    out, _ = conv_forward_nhwc(x, w, b, conv_param)
+  else:
+    out, _ = conv_forward_fast(x, w, b, conv_param)
+  np.maximum(out, 0, out=out)
+  return out
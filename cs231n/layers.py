@@ -23,7 +23,7 @@ def affine_forward(x, w, b):
   return out, cache
 
 
-def affine_backward(dout, cache):
+def affine_backward(dout, cache, need_param_grads=True):
   """
   Computes the backward pass for an affine layer.
 
@@ -32,6 +32,8 @@ def affine_backward(dout, cache):
   - cache: Tuple of:
     - x: Input data, of shape (N, d_1, ... d_k)
     - w: Weights, of shape (D, M)
+  - need_param_grads: If False, only compute dx, and return None for dw and
+    db.
 
   Returns a tuple of:
   - dx: Gradient with respect to x, of shape (N, d1, ..., d_k)
@@ -40,6 +42,8 @@ def affine_backward(dout, cache):
   """
   x, w, b = cache
   dx = dout.dot(w.T).reshape(x.shape)
+  if not need_param_grads:
+    return dx, None, None
   dw = x.reshape(x.shape[0], -1).T.dot(dout)
   db = np.sum(dout, axis=0)
   return dx, dw, db
@@ -77,7 +81,7 @@ def relu_backward(dout, cache):
   return dx
 
 
-def batchnorm_forward(x, gamma, beta, bn_param):
+def batchnorm_forward(x, gamma, beta, bn_param, need_param_grads=True):
   """
   Forward pass for batch normalization.
   
@@ -110,6 +114,8 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     - momentum: Constant for running mean / variance.
     - running_mean: Array of shape (D,) giving running mean of features
     - running_var Array of shape (D,) giving running variance of features
+  - need_param_grads: If False, the cache only holds what is needed for dx,
+    and can't be used to compute dgamma and dbeta.
 
   Returns a tuple of:
   - out: of shape (N, D)
@@ -133,7 +139,8 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     xn = xc / std
     out = gamma * xn + beta
 
-    cache = (mode, x, gamma, xc, std, xn, out)
+    # The normalized input is only needed for dgamma
+    cache = (mode, x, gamma, xc, std, xn if need_param_grads else None, out)
 
     # Update running average of mean
     running_mean *= momentum
@@ -147,6 +154,8 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     std = np.sqrt(running_var + eps)
     xn = (x - running_mean) / std
     out = gamma * xn + beta
+    if not need_param_grads:
+      xn = None
     cache = (mode, x, xn, gamma, beta, std)
   else:
     raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
@@ -158,7 +167,7 @@ def batchnorm_forward(x, gamma, beta, bn_param):
   return out, cache
 
 
-def batchnorm_backward(dout, cache):
+def batchnorm_backward(dout, cache, need_param_grads=True):
   """
   Backward pass for batch normalization.
   
@@ -169,6 +178,8 @@ def batchnorm_backward(dout, cache):
   Inputs:
   - dout: Upstream derivatives, of shape (N, D)
   - cache: Variable of intermediates from batchnorm_forward.
+  - need_param_grads: If False, only compute dx, and return None for dgamma
+    and dbeta.
   
   Returns a tuple of:
   - dx: Gradient with respect to inputs x, of shape (N, D)
@@ -176,12 +187,14 @@ def batchnorm_backward(dout, cache):
   - dbeta: Gradient with respect to shift parameter beta, of shape (D,)
   """
   mode = cache[0]
+  dgamma, dbeta = None, None
   if mode == 'train':
     mode, x, gamma, xc, std, xn, out = cache
 
     N = x.shape[0]
-    dbeta = dout.sum(axis=0)
-    dgamma = np.sum(xn * dout, axis=0)
+    if need_param_grads:
+      dbeta = dout.sum(axis=0)
+      dgamma = np.sum(xn * dout, axis=0)
     dxn = gamma * dout
     dxc = dxn / std
     dstd = -np.sum((dxn * xc) / (std * std), axis=0)
@@ -191,8 +204,9 @@ def batchnorm_backward(dout, cache):
     dx = dxc - dmu / N
   elif mode == 'test':
     mode, x, xn, gamma, beta, std = cache
-    dbeta = dout.sum(axis=0)
-    dgamma = np.sum(xn * dout, axis=0)
+    if need_param_grads:
+      dbeta = dout.sum(axis=0)
+      dgamma = np.sum(xn * dout, axis=0)
     dxn = gamma * dout
     dx = dxn / std
   else:
@@ -201,7 +215,8 @@ def batchnorm_backward(dout, cache):
   return dx, dgamma, dbeta
 
 
-def spatial_batchnorm_forward(x, gamma, beta, bn_param):
+def spatial_batchnorm_forward(x, gamma, beta, bn_param, channels_last=False,
+                              need_param_grads=True):
   """
   Computes the forward pass for spatial batch normalization.
   
@@ -218,34 +233,55 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
       default of momentum=0.9 should work well in most situations.
     - running_mean: Array of shape (D,) giving running mean of features
     - running_var Array of shape (D,) giving running variance of features
+  - channels_last: If True, x and out have shape (N, H, W, C) instead, and
+    are normalized without any transposes.
+  - need_param_grads: If False, keep only what the backward pass needs for
+    dx; see batchnorm_forward.
     
   Returns a tuple of:
   - out: Output data, of shape (N, C, H, W)
   - cache: Values needed for the backward pass
   """
+  if channels_last:
+    N, H, W, C = x.shape
+    out_flat, cache = batchnorm_forward(x.reshape(-1, C), gamma, beta,
+                                        bn_param,
+                                        need_param_grads=need_param_grads)
+    return out_flat.reshape(N, H, W, C), cache
   N, C, H, W = x.shape
   x_flat = x.transpose(0, 2, 3, 1).reshape(-1, C)
-  out_flat, cache = batchnorm_forward(x_flat, gamma, beta, bn_param)
+  out_flat, cache = batchnorm_forward(x_flat, gamma, beta, bn_param,
+                                      need_param_grads=need_param_grads)
   out = out_flat.reshape(N, H, W, C).transpose(0, 3, 1, 2)
   return out, cache
 
 
-def spatial_batchnorm_backward(dout, cache):
+def spatial_batchnorm_backward(dout, cache, channels_last=False,
+                               need_param_grads=True):
   """
   Computes the backward pass for spatial batch normalization.
   
   Inputs:
   - dout: Upstream derivatives, of shape (N, C, H, W)
   - cache: Values from the forward pass
+  - channels_last: If True, dout and dx have shape (N, H, W, C) instead.
+  - need_param_grads: If False, only compute dx, and return None for dgamma
+    and dbeta.
   
   Returns a tuple of:
   - dx: Gradient with respect to inputs, of shape (N, C, H, W)
   - dgamma: Gradient with respect to scale parameter, of shape (C,)
   - dbeta: Gradient with respect to shift parameter, of shape (C,)
   """
+  if channels_last:
+    N, H, W, C = dout.shape
+    dx_flat, dgamma, dbeta = batchnorm_backward(
+        dout.reshape(-1, C), cache, need_param_grads=need_param_grads)
+    return dx_flat.reshape(N, H, W, C), dgamma, dbeta
   N, C, H, W = dout.shape
   dout_flat = dout.transpose(0, 2, 3, 1).reshape(-1, C)
-  dx_flat, dgamma, dbeta = batchnorm_backward(dout_flat, cache)
+  dx_flat, dgamma, dbeta = batchnorm_backward(
+      dout_flat, cache, need_param_grads=need_param_grads)
   dx = dx_flat.reshape(N, H, W, C).transpose(0, 3, 1, 2)
   return dx, dgamma, dbeta
 
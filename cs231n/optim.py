@@ -57,29 +57,121 @@ def adam(x, dx, config=None):
   - m: Moving average of gradient.
   - v: Moving average of squared gradient.
   - t: Iteration number.
+  - scratch: Work array of the same shape as x.
   """
   if config is None: config = {}
   config.setdefault('learning_rate', 1e-3)
   config.setdefault('beta1', 0.9)
   config.setdefault('beta2', 0.999)
   config.setdefault('epsilon', 1e-8)
-  config.setdefault('m', np.zeros_like(x))
-  config.setdefault('v', np.zeros_like(x))
   config.setdefault('t', 0)
+  # setdefault would evaluate its default, and so allocate, on every call
+  if 'm' not in config: config['m'] = np.zeros_like(x)
+  if 'v' not in config: config['v'] = np.zeros_like(x)
+  if 'scratch' not in config: config['scratch'] = np.empty_like(x)
   
   next_x = None
   beta1, beta2, eps = config['beta1'], config['beta2'], config['epsilon']
   t, m, v = config['t'], config['m'], config['v']
-  m = beta1 * m + (1 - beta1) * dx
-  v = beta2 * v + (1 - beta2) * (dx * dx)
   t += 1
   alpha = config['learning_rate'] * np.sqrt(1 - beta2 ** t) / (1 - beta1 ** t)
-  x -= alpha * (m / (np.sqrt(v) + eps))
+
+  # Update the moments and the weights in place, using a single scratch array
+  # for all intermediate values so that no temporaries are allocated.
+  s = config['scratch']
+  np.multiply(dx, 1 - beta1, out=s)
+  m *= beta1
+  m += s
+  np.multiply(dx, dx, out=s)
+  s *= 1 - beta2
+  v *= beta2
+  v += s
+  np.sqrt(v, out=s)
+  s += eps
+  np.divide(m, s, out=s)
+  s *= alpha
+  x -= s
   config['t'] = t
-  config['m'] = m
-  config['v'] = v
   next_x = x
   
   return next_x, config
 
-  
+
+"""
+Sparse update rules are used for parameters such as word embedding matrices,
+where only a few rows of the gradient are nonzero on each iteration. They have
+the same interface as the update rules above, except that the gradient dw is
+a tuple (rows, drows): rows is an array of K distinct row indices of w, and
+drows is an array of K rows giving the gradient for those rows. Gradient rows
+that are not listed are zero. The cost of an update scales with K rather than
+with the number of rows of w.
+"""
+
+
+def sparse_sgd(w, dw, config=None):
+  """
+  Vanilla stochastic gradient descent on the listed rows of w. This gives
+  exactly the same result as sgd on the equivalent dense gradient.
+
+  config format:
+  - learning_rate: Scalar learning rate.
+  """
+  if config is None: config = {}
+  config.setdefault('learning_rate', 1e-2)
+
+  rows, drows = dw
+  w[rows] -= config['learning_rate'] * drows
+  return w, config
+
+
+def sparse_adam(x, dx, config=None):
+  """
+  A lazy version of Adam that only updates the listed rows of x and of its
+  moving averages.
+
+  The moving averages of a row are decayed lazily: we remember the iteration
+  at which each row was last updated, and the next time the row has a nonzero
+  gradient we first apply all of the decay it missed in the meantime, which
+  gives the same moving averages as dense Adam. Unlike dense Adam, rows are
+  not moved on iterations where their gradient is zero.
+
+  config format:
+  - learning_rate: Scalar learning rate.
+  - beta1: Decay rate for moving average of first moment of gradient.
+  - beta2: Decay rate for moving average of second moment of gradient.
+  - epsilon: Small scalar used for smoothing to avoid dividing by zero.
+  - m: Moving average of gradient.
+  - v: Moving average of squared gradient.
+  - t: Iteration number.
+  - last_t: Integer array giving, for each row, the iteration at which its
+    moving averages were last updated.
+  """
+  if config is None: config = {}
+  config.setdefault('learning_rate', 1e-3)
+  config.setdefault('beta1', 0.9)
+  config.setdefault('beta2', 0.999)
+  config.setdefault('epsilon', 1e-8)
+  config.setdefault('t', 0)
+  if 'm' not in config: config['m'] = np.zeros_like(x)
+  if 'v' not in config: config['v'] = np.zeros_like(x)
+  if 'last_t' not in config:
+    config['last_t'] = np.zeros(x.shape[0], dtype=np.int64)
+
+  rows, drows = dx
+  beta1, beta2, eps = config['beta1'], config['beta2'], config['epsilon']
+  t, m, v = config['t'], config['m'], config['v']
+  t += 1
+  alpha = config['learning_rate'] * np.sqrt(1 - beta2 ** t) / (1 - beta1 ** t)
+
+  # Decay by the iterations since each row was last updated, including this
+  # one, then add in the new gradient.
+  skipped = (t - config['last_t'][rows]).reshape((-1,) + (1,) * (x.ndim - 1))
+  m_rows = m[rows] * beta1 ** skipped + (1 - beta1) * drows
+  v_rows = v[rows] * beta2 ** skipped + (1 - beta2) * (drows * drows)
+  x[rows] -= alpha * (m_rows / (np.sqrt(v_rows) + eps))
+  m[rows] = m_rows
+  v[rows] = v_rows
+  config['last_t'][rows] = t
+  config['t'] = t
+
+  return x, config
@@ -113,11 +113,11 @@ def rnn_forward(x, h0, Wx, Wh, b):
   ##############################################################################
   h = np.zeros((x.shape[0],T,Wh.shape[0]))
   cache = []
-  h1, cache1 = rnn_step_forward(np.squeeze(x[:,0,:]), h0, Wx, Wh, b)
+  h1, cache1 = rnn_step_forward(x[:,0,:], h0, Wx, Wh, b)
   h[:,0,:] = h1
   cache.append(cache1)
   for i in range(1,T):    
-    h1, cache1 = rnn_step_forward(np.squeeze(x[:,i,:]), h1, Wx, Wh, b)
+    h1, cache1 = rnn_step_forward(x[:,i,:], h1, Wx, Wh, b)
     h[:,i,:] = h1
     cache.append(cache1)
   ##############################################################################
@@ -158,7 +158,7 @@ def rnn_backward(dh, cache):
   # sequence of data. You should use the rnn_step_backward function that you   #
   # defined above.                                                             #
   ##############################################################################
-  dx[:,T-1,:], dprev_h0, dWx, dWh, db = rnn_step_backward(np.squeeze(dh[:,T-1,:]), cache.pop())
+  dx[:,T-1,:], dprev_h0, dWx, dWh, db = rnn_step_backward(dh[:,T-1,:], cache.pop())
   
   for i in range(0,T-1):
     dprev_h0 = dprev_h0 + dh[:,T-i-2,:]
@@ -202,29 +202,16 @@ def word_embedding_forward(x, W):
   - cache: Values needed for the backward pass
   """
   out, cache = None, None
-  V = W.shape[0]
-  N = x.shape[0]
-  T = x.shape[1]
-  D = W.shape[1]
-  out = np.zeros((N,T,D))
-  emb = np.zeros((N,T,V))
-  for i in range(0,N):
-    for j in range(0,T):
-      #emb[i,j,:] = np.zeros((V,))
-      emb[i,j, x[i,j]]=1
-      vec2 = np.dot(np.squeeze(emb[i,j,:]),W)
-      out[i,j,:]=vec2
-  
   ##############################################################################
   # TODO: Implement the forward pass for word embeddings.                      #
   #                                                                            #
   # HINT: This should be very simple.                                          #
   ##############################################################################
-  
+  out = W[x]
   ##############################################################################
   #                               END OF YOUR CODE                             #
   ##############################################################################
-  cache = (emb,W)
+  cache = (x, W)
   return out, cache
 
 
@@ -244,29 +231,49 @@ def word_embedding_backward(dout, cache):
   - dW: Gradient of word embedding matrix, of shape (V, D).
   """
   dW = None
-  T = dout.shape[1]
   ##############################################################################
   # TODO: Implement the backward pass for word embeddings.                     #
   #                                                                            #
   # HINT: Look up the function np.add.at                                       #
   ##############################################################################
-  emb , w = cache
-  V = emb.shape[2]
-  D = dout.shape[2]
-  dW = np.zeros((V,D))
-  for i in range(0,T):
-  
-    emb2 = np.squeeze(emb[:,i,:])
-    dout2 = np.squeeze(dout[:,i,:])
-    dW += np.dot(np.transpose(emb2), dout2)
-    
-  
+  x, W = cache
+  rows, drows = word_embedding_backward_sparse(dout, cache)
+  dW = np.zeros(W.shape, dtype=drows.dtype)
+  dW[rows] = drows
   ##############################################################################
   #                               END OF YOUR CODE                             #
   ##############################################################################
   return dW
 
 
+def word_embedding_backward_sparse(dout, cache):
+  """
+  Backward pass for word embeddings that only returns the rows of the gradient
+  of the word embedding matrix that can be nonzero, namely the rows of the
+  words that appear in the minibatch.
+
+  Inputs:
+  - dout: Upstream gradients of shape (N, T, D)
+  - cache: Values from the forward pass
+
+  Returns a tuple of:
+  - rows: Sorted array of shape (K,) giving the distinct word indices in the
+    minibatch.
+  - drows: Array of shape (K, D) where drows[i] is the gradient with respect to
+    the word vector W[rows[i]]; all other rows of the gradient are zero.
+  """
+  x, W = cache
+  D = dout.shape[-1]
+  rows, inverse = np.unique(x, return_inverse=True)
+
+  # Sum the upstream gradients of each word by sorting them by word and
+  # reducing over each run; this is much faster than np.add.at.
+  order = np.argsort(inverse, kind='mergesort')
+  starts = np.searchsorted(inverse[order], np.arange(rows.shape[0]))
+  drows = np.add.reduceat(dout.reshape(-1, D)[order], starts, axis=0)
+  return rows, drows
+
+
 def sigmoid(x):
   """
   A numerically stable version of the logistic sigmoid function.
@@ -478,7 +485,7 @@ def lstm_backward(dh, cache):
   T = dh.shape[1]
   c0 = np.zeros( ( dh.shape[0], dh.shape[2]) )  
   cache2 = cache.pop()
-  dx0 , dprev_h, dprev_c, dWx, dWh, db = lstm_step_backward( np.squeeze(dh[:,T-1,:]), c0, cache2 )
+  dx0 , dprev_h, dprev_c, dWx, dWh, db = lstm_step_backward( dh[:,T-1,:], c0, cache2 )
   N,D = dx0.shape
   dx = np.zeros((N,T,D))
   dx[:,T-1,:] = dx0
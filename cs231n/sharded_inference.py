@@ -0,0 +1,249 @@
+"""
+Batch inference with a PretrainedCNN split over several processes that share
+a single copy of the weights.
+
+The weights, the batchnorm running averages and, for fused inference, the
+folded weights are copied once into a block of shared memory, and the model
+is pointed at views of that block. Worker processes inherit the block when
+they are forked, so they all read the same physical pages instead of each
+holding its own copy. Every batch is copied into a shared input array and cut
+into one contiguous shard per worker; each worker runs its shard forward and
+writes the result into its rows of a shared output array.
+
+Each worker is a separate process, so set OMP_NUM_THREADS (or the variable of
+your BLAS library) to 1 before starting Python to keep the workers from
+competing for cores.
+
+Example usage:
+
+model = PretrainedCNN(h5_file='cs231n/datasets/pretrained_model.h5')
+runner = ShardedInference(model, num_workers=8)
+scores = runner.forward(X)
+runner.close()
+
+The benchmark can be run from the assignment directory:
+
+python -m cs231n.sharded_inference path/to/pretrained_model.h5 [N]
+"""
+
+import sys, time
+import numpy as np
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+
+
+def _share_arrays(arrays):
+  """
+  Copy a dictionary of arrays into one block of shared memory.
+
+  Returns a tuple of the shared block and a dictionary mapping each key to a
+  view of the block holding a copy of its array.
+  """
+  layout, offset = [], 0
+  for k in sorted(arrays):
+    v = np.asarray(arrays[k])
+    layout.append((k, offset, v.shape, v.dtype))
+    # Keep every array aligned to a cache line
+    offset += (v.nbytes + 63) // 64 * 64
+  block = RawArray('B', max(offset, 1))
+  views = {}
+  for k, start, shape, dtype in layout:
+    size = int(np.prod(shape)) * dtype.itemsize
+    view = np.frombuffer(block, dtype=np.uint8, count=size, offset=start)
+    views[k] = view.view(dtype).reshape(shape)
+    views[k][...] = arrays[k]
+  return block, views
+
+
+_worker_state = None
+
+
+def _init_worker(model, X_block, out_block):
+  global _worker_state
+  _worker_state = (model, X_block, out_block)
+
+
+def _worker_forward(args):
+  """
+  Run rows start:stop of the shared input forward in a worker process.
+  """
+  start, stop, end, fused, in_shape, out_dim = args
+  model, X_block, out_block = _worker_state
+  X = np.frombuffer(X_block, dtype=model.dtype).reshape((-1,) + in_shape)
+  out = np.frombuffer(out_block, dtype=model.dtype).reshape(-1, out_dim)
+  scores, _ = model.forward(X[start:stop], end=end, fused=fused,
+                            keep_cache=False)
+  out[start:stop] = scores.reshape(stop - start, -1)
+
+
+class ShardedInference(object):
+  """
+  Runs a PretrainedCNN in test mode over a pool of worker processes that
+  share its weights.
+
+  The weights of the model are moved into shared memory: after construction
+  model.params, the running averages in model.bn_params and, if fused is
+  True, model.folded_params are views of the shared block. The model can
+  still be used directly in the parent process, but weights changed or
+  loaded afterwards are not seen by the workers; make a new ShardedInference
+  after changing them.
+  """
+
+  def __init__(self, model, num_workers=4, end=None, fused=True,
+               max_batch=1000):
+    """
+    Inputs:
+    - model: A PretrainedCNN
+    - num_workers: Number of worker processes
+    - end: Index of the layer whose output is returned, as in model.forward;
+      default is the class scores. Outputs of conv layers are flattened.
+    - fused: Whether to run the model with batchnorm folded into its weights
+    - max_batch: Maximum number of inputs run in one round over the workers;
+      larger inputs are run in several rounds. The shared input and output
+      arrays are sized for this many inputs.
+    """
+    if end is None:
+      end = len(model.conv_params) + 1
+    self.model = model
+    self.num_workers = num_workers
+    self.end = end
+    self.fused = fused
+    self.max_batch = max_batch
+
+    arrays = dict(model.params)
+    for i, bn_param in enumerate(model.bn_params):
+      # Missing running averages are zero, as in batchnorm_forward
+      zeros = np.zeros_like(model.params['gamma%d' % (i + 1)])
+      arrays['running_mean%d' % i] = bn_param.get('running_mean', zeros)
+      arrays['running_var%d' % i] = bn_param.get('running_var', zeros)
+    if fused:
+      folded = model.folded_params
+      if folded is None:
+        folded = model.fold_batchnorm()
+      for k, v in folded.iteritems():
+        arrays['folded_' + k] = v
+    self.weight_block, views = _share_arrays(arrays)
+    self.weight_bytes = len(self.weight_block)
+
+    for k in model.params:
+      model.params[k] = views[k]
+    for i, bn_param in enumerate(model.bn_params):
+      bn_param['running_mean'] = views['running_mean%d' % i]
+      bn_param['running_var'] = views['running_var%d' % i]
+    if fused:
+      model.folded_params = dict((k, views['folded_' + k]) for k in folded)
+
+    # Find the size of the output with one input
+    size = model.input_size
+    self.in_shape = (3, size, size)
+    probe = np.zeros((1,) + self.in_shape, dtype=model.dtype)
+    probe, _ = model.forward(probe, end=end, fused=fused, keep_cache=False)
+    self.out_dim = int(np.prod(probe.shape[1:]))
+
+    itemsize = np.dtype(model.dtype).itemsize
+    self.X_block = RawArray('B', max_batch * int(np.prod(self.in_shape)) * itemsize)
+    self.out_block = RawArray('B', max_batch * self.out_dim * itemsize)
+    self.X_shared = np.frombuffer(self.X_block, dtype=model.dtype)
+    self.X_shared = self.X_shared.reshape((max_batch,) + self.in_shape)
+    self.out_shared = np.frombuffer(self.out_block, dtype=model.dtype)
+    self.out_shared = self.out_shared.reshape(max_batch, self.out_dim)
+
+    self.pool = Pool(num_workers, initializer=_init_worker,
+                     initargs=(model, self.X_block, self.out_block))
+
+
+  def forward(self, X):
+    """
+    Run a batch of inputs forward over the workers.
+
+    Inputs:
+    - X: Array of shape (N, 3, H, W) of preprocessed images
+
+    Returns:
+    - out: Array of shape (N, D) of outputs of layer end
+    """
+    N = X.shape[0]
+    out = np.empty((N, self.out_dim), dtype=self.model.dtype)
+    for start in xrange(0, N, self.max_batch):
+      stop = min(start + self.max_batch, N)
+      B = stop - start
+      self.X_shared[:B] = X[start:stop]
+      bounds = np.linspace(0, B, min(self.num_workers, B) + 1).astype(int)
+      shards = [(lo, hi, self.end, self.fused, self.in_shape, self.out_dim)
+                for lo, hi in zip(bounds[:-1], bounds[1:])]
+      self.pool.map(_worker_forward, shards, chunksize=1)
+      out[start:stop] = self.out_shared[:B]
+    return out
+
+
+  def close(self):
+    """
+    Stop the worker processes.
+    """
+    self.pool.close()
+    self.pool.join()
+
+
+def benchmark_sharded_inference(model, X, worker_counts=(1, 2, 4, 8, 16),
+                                end=None, fused=True, num_runs=3):
+  """
+  Time ShardedInference on a batch for several numbers of workers, and check
+  its output against running the model in a single process.
+
+  Inputs:
+  - model: A PretrainedCNN
+  - X: Array of shape (N, 3, H, W) of inputs
+  - worker_counts: Numbers of workers to try
+  - end, fused: Passed to ShardedInference
+  - num_runs: Each timing is the best of this many runs
+
+  Returns:
+  - results: List with one dictionary per number of workers, holding the
+    number of workers, the best time in seconds, the images per second, the
+    speedup over one worker, and the maximum absolute difference from the
+    single-process output.
+  """
+  end_layer = end
+  if end_layer is None:
+    end_layer = len(model.conv_params) + 1
+  expected, _ = model.forward(X, end=end_layer, fused=fused, keep_cache=False)
+  expected = expected.reshape(X.shape[0], -1)
+
+  results = []
+  for num_workers in worker_counts:
+    runner = ShardedInference(model, num_workers=num_workers, end=end,
+                              fused=fused, max_batch=X.shape[0])
+    try:
+      runner.forward(X[:num_workers])
+      best = None
+      for _ in xrange(num_runs):
+        t0 = time.time()
+        out = runner.forward(X)
+        elapsed = time.time() - t0
+        if best is None or elapsed < best:
+          best = elapsed
+    finally:
+      runner.close()
+    results.append({
+      'num_workers': num_workers,
+      'seconds': best,
+      'images_per_sec': X.shape[0] / best,
+      'speedup': results[0]['seconds'] / best if results else 1.0,
+      'max_error': np.abs(out - expected).max(),
+    })
+  return results
+
+
+if __name__ == '__main__':
+  from cs231n.classifiers.pretrained_cnn import PretrainedCNN
+  N = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+  model = PretrainedCNN(h5_file=sys.argv[1])
+  X = np.random.randn(N, 3, model.input_size, model.input_size)
+  X = X.astype(model.dtype)
+  results = benchmark_sharded_inference(model, X)
+  print '%8s %10s %12s %8s %10s' % ('workers', 'seconds', 'images/sec',
+                                     'speedup', 'max error')
+  for r in results:
+    print '%8d %10.3f %12.1f %8.2f %10.2e' % (
+          r['num_workers'], r['seconds'], r['images_per_sec'], r['speedup'],
+          r['max_error'])